@@ -0,0 +1,503 @@
+import bisect
+import os
+import queue
+import threading
+import time
+
+from collections import OrderedDict
+
+import numpy as np
+
+# Append only columnar archive of everything an experiment computes.
+#
+# The archive directory contains one subdirectory per stream (peaks,
+# averages, scans, beamcurrent) holding numbered shards. Each shard is a
+# directory of .npy files, one per column (a new shard is written into a
+# temporary directory and renamed when complete). Shards are complete once
+# they hold shardRecords records or shardBytes of data. Records that are
+# older than flushInterval are written into a partial shard before, it is
+# rewritten with the additional records until it's complete. Columns of a
+# partial shard are replaced one by one, the old and the new version both
+# contain all records listed in the index.
+#
+# Every stream directory contains an index (index.npy) with one row per
+# shard: shard number, number of records, first and last time. It is
+# replaced after every written shard, readers locate records by the index
+# and only memory map the columns they access. Only a bounded number of
+# columns are kept mapped so long archives neither take long to open nor
+# run out of file descriptors.
+#
+# Peak matrices and the per point statistics have varying sizes. They are
+# stored as flat columns, the per peak columns matrixOffset / pointOffset
+# point into them (relative to the shard):
+#
+#   peaks          timestamp, kind (0 peak, 1 zero peak), n, rows, cols,
+#                  matrixOffset, pointOffset
+#                  matrix (flat), I, sigI, sigQ, errI, errQ (flat, errors
+#                  are NaN if there is only one iteration)
+#   averages       timestamp, kind (0 signal, 1 zero peak average), samples
+#                  (number of samples averaged), generation (incremented on every reset), points,
+#                  pointOffset
+#                  I, sigI, sigQ, errI, errQ (flat, NaN for grid points
+#                  without samples)
+#   scans          start, end, duration (UNIX timestamps / seconds)
+#   beamcurrent    timestamp, current, kind (0 estimate, 1 measurement)
+
+PEAK_SIGNAL = 0
+PEAK_ZERO = 1
+
+BEAMCURRENT_ESTIMATE = 0
+BEAMCURRENT_MEASUREMENT = 1
+
+_columnTypes = {
+    'peaks' : {
+        'timestamp' : np.float64,
+        'kind' : np.int8,
+        'n' : np.int32,
+        'rows' : np.int32,
+        'cols' : np.int32,
+        'matrixOffset' : np.int64,
+        'pointOffset' : np.int64,
+        'matrix' : np.float64,
+        'I' : np.float64,
+        'sigI' : np.float64,
+        'sigQ' : np.float64,
+        'errI' : np.float64,
+        'errQ' : np.float64
+    },
+    'averages' : {
+        'timestamp' : np.float64,
+        'kind' : np.int8,
+        'samples' : np.int64,
+        'generation' : np.int32,
+        'points' : np.int32,
+        'pointOffset' : np.int64,
+        'I' : np.float64,
+        'sigI' : np.float64,
+        'sigQ' : np.float64,
+        'errI' : np.float64,
+        'errQ' : np.float64
+    },
+    'scans' : {
+        'start' : np.float64,
+        'end' : np.float64,
+        'duration' : np.float64
+    },
+    'beamcurrent' : {
+        'timestamp' : np.float64,
+        'current' : np.float64,
+        'kind' : np.int8
+    }
+}
+
+# Columns of flat per point data, all other columns hold one value per
+# record
+_flatColumns = {
+    'peaks' : ('matrix', 'I', 'sigI', 'sigQ', 'errI', 'errQ'),
+    'averages' : ('I', 'sigI', 'sigQ', 'errI', 'errQ'),
+    'scans' : (),
+    'beamcurrent' : ()
+}
+
+_timeColumns = {
+    'peaks' : 'timestamp',
+    'averages' : 'timestamp',
+    'scans' : 'start',
+    'beamcurrent' : 'timestamp'
+}
+
+def _shardNumbers(streamDirectory):
+    try:
+        names = os.listdir(streamDirectory)
+    except FileNotFoundError:
+        return []
+    return sorted(int(name) for name in names if name.isdigit())
+
+def _shardDirectory(streamDirectory, number):
+    return os.path.join(streamDirectory, "{:08d}".format(number))
+
+def _indexRow(number, times):
+    if len(times) == 0:
+        return (number, 0, np.inf, -np.inf)
+    return (number, len(times), float(times[0]), float(times[-1]))
+
+def _loadIndex(streamDirectory):
+    try:
+        rows = np.load(os.path.join(streamDirectory, "index.npy"))
+    except FileNotFoundError:
+        return None
+    return [ (int(number), int(records), first, last) for number, records, first, last in rows.tolist() ]
+
+def _saveIndex(streamDirectory, rows):
+    path = os.path.join(streamDirectory, "index.npy")
+    with open(path + ".tmp", 'wb') as f:
+        np.save(f, np.asarray(rows, dtype = np.float64).reshape((-1, 4)))
+    os.replace(path + ".tmp", path)
+
+def _indexShards(streamDirectory, stream, rows):
+    # Adds shards after the last one in rows (written without index by an
+    # older version or before a crash) by reading their time column once
+    rows = list(rows)
+    last = rows[-1][0] if len(rows) > 0 else -1
+    for number in _shardNumbers(streamDirectory):
+        if number > last:
+            times = np.load(os.path.join(_shardDirectory(streamDirectory, number), _timeColumns[stream] + ".npy"))
+            rows.append(_indexRow(number, times))
+    return rows
+
+class ArchiveWriter:
+    def __init__(self, directory, shardRecords = 256, flushInterval = 60.0, shardBytes = 16 * 1024 * 1024):
+        self.directory = directory
+        self._shardRecords = shardRecords
+        self._shardBytes = shardBytes
+        self._flushInterval = flushInterval
+        self._lock = threading.Lock()
+
+        self._streams = {}
+        self._index = {}
+        for stream in _columnTypes:
+            streamDirectory = os.path.join(directory, stream)
+            os.makedirs(streamDirectory, exist_ok = True)
+            known = _loadIndex(streamDirectory)
+            index = _indexShards(streamDirectory, stream, known if known is not None else [])
+            if (known is None) or (len(index) > len(known)):
+                _saveIndex(streamDirectory, index)
+            self._index[stream] = index
+            self._streams[stream] = {
+                'directory' : streamDirectory,
+                'next' : index[-1][0] + 1 if len(index) > 0 else 0,
+                'total' : sum(row[1] for row in index),
+                'records' : 0,
+                'written' : 0,
+                'bytes' : 0,
+                'started' : None,
+                'columns' : { name : [] for name in _columnTypes[stream] },
+                'matrixSize' : 0,
+                'points' : 0
+            }
+
+        # Shards are written by a background thread so the handlers never
+        # wait for the disk. The thread also flushes streams that have been
+        # quiet for flushInterval
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target = self._writeShards, daemon = True)
+        self._thread.start()
+        self._closed = False
+
+    def _writeShards(self):
+        while True:
+            try:
+                job = self._queue.get(timeout = self._flushInterval / 4)
+            except queue.Empty:
+                self._flushDue()
+                continue
+            if job is None:
+                return
+            streamName, number, columns = job
+            streamDirectory = self._streams[streamName]['directory']
+            directory = _shardDirectory(streamDirectory, number)
+            if os.path.isdir(directory):
+                # Partial shard, the index still lists the records of the
+                # previous version until all columns have been replaced
+                for name, values in columns.items():
+                    path = os.path.join(directory, name + ".npy")
+                    with open(path + ".tmp", 'wb') as f:
+                        np.save(f, values)
+                    os.replace(path + ".tmp", path)
+            else:
+                tempDirectory = directory + ".tmp"
+                os.makedirs(tempDirectory, exist_ok = True)
+                for name, values in columns.items():
+                    np.save(os.path.join(tempDirectory, name + ".npy"), values)
+                os.rename(tempDirectory, directory)
+
+            index = self._index[streamName]
+            row = _indexRow(number, columns[_timeColumns[streamName]])
+            if (len(index) > 0) and (index[-1][0] == number):
+                index[-1] = row
+            else:
+                index.append(row)
+            _saveIndex(streamDirectory, index)
+
+    def _flushDue(self):
+        with self._lock:
+            if self._closed:
+                return
+            now = time.monotonic()
+            for streamName, stream in self._streams.items():
+                if (stream['started'] is not None) and ((now - stream['started']) >= self._flushInterval):
+                    self._flushStream(stream, streamName, final = False)
+
+    def _append(self, streamName, **values):
+        stream = self._streams[streamName]
+        for name, value in values.items():
+            stream['columns'][name].append(value)
+            if isinstance(value, np.ndarray):
+                stream['bytes'] = stream['bytes'] + value.nbytes
+        stream['records'] = stream['records'] + 1
+        stream['total'] = stream['total'] + 1
+        if stream['started'] is None:
+            stream['started'] = time.monotonic()
+        if (stream['records'] >= self._shardRecords) or (stream['bytes'] >= self._shardBytes) or ((time.monotonic() - stream['started']) >= self._flushInterval):
+            self._flushStream(stream, streamName, final = False)
+
+    def _flushStream(self, stream, streamName, final = True):
+        # Writes the pending records, the shard stays partial (and is
+        # rewritten with more records later) unless it's full or final
+        complete = final or (stream['records'] >= self._shardRecords) or (stream['bytes'] >= self._shardBytes)
+        if stream['records'] > stream['written']:
+            columns = self._shardColumns(stream, streamName)
+            self._queue.put((streamName, stream['next'], columns))
+        stream['started'] = None
+        if not complete:
+            stream['written'] = stream['records']
+            return
+        if stream['records'] == 0:
+            return
+
+        stream['next'] = stream['next'] + 1
+        stream['records'] = 0
+        stream['written'] = 0
+        stream['bytes'] = 0
+        stream['columns'] = { name : [] for name in stream['columns'] }
+        stream['matrixSize'] = 0
+        stream['points'] = 0
+
+    def _shardColumns(self, stream, streamName):
+        columns = {}
+        for name, parts in stream['columns'].items():
+            if (len(parts) > 0) and isinstance(parts[0], np.ndarray):
+                columns[name] = np.concatenate(parts).astype(_columnTypes[streamName][name], copy = False)
+            else:
+                columns[name] = np.asarray(parts, dtype = _columnTypes[streamName][name])
+        return columns
+
+    def __len__(self):
+        # Number of peaks in the archive including the ones not written yet
+        with self._lock:
+            return self._streams['peaks']['total']
+
+    def peak(self, kind, data, stats, timestamp = None):
+        # data is the peak matrix, stats the result of peakStatistics
+        if timestamp is None:
+            timestamp = time.time()
+        nPoints = len(stats['I'])
+        err = stats['err']
+        noError = np.full(nPoints, np.nan)
+
+        with self._lock:
+            if self._closed:
+                return
+            stream = self._streams['peaks']
+            matrixOffset = stream['matrixSize']
+            pointOffset = stream['points']
+            stream['matrixSize'] = stream['matrixSize'] + data.size
+            stream['points'] = stream['points'] + nPoints
+            self._append(
+                'peaks',
+                timestamp = timestamp,
+                kind = kind,
+                n = stats['n'],
+                rows = data.shape[0],
+                cols = data.shape[1],
+                matrixOffset = matrixOffset,
+                pointOffset = pointOffset,
+                matrix = np.ravel(data),
+                I = np.asarray(stats['I']),
+                sigI = np.asarray(stats['sig']['i']),
+                sigQ = np.asarray(stats['sig']['q']),
+                errI = np.asarray(err['i']) if err['i'] is not None else noError,
+                errQ = np.asarray(err['q']) if err['q'] is not None else noError
+            )
+
+    def average(self, kind, I, signal, error, samples, generation, timestamp = None):
+        # signal and error are the channels of a running average (error may
+        # be None)
+        if timestamp is None:
+            timestamp = time.time()
+        nPoints = len(I)
+        noError = np.full(nPoints, np.nan)
+
+        with self._lock:
+            if self._closed:
+                return
+            stream = self._streams['averages']
+            pointOffset = stream['points']
+            stream['points'] = stream['points'] + nPoints
+            self._append(
+                'averages',
+                timestamp = timestamp,
+                kind = kind,
+                samples = samples,
+                generation = generation,
+                points = nPoints,
+                pointOffset = pointOffset,
+                I = np.asarray(I),
+                sigI = np.asarray(signal['i']),
+                sigQ = np.asarray(signal['q']),
+                errI = np.asarray(error['i']) if error is not None else noError,
+                errQ = np.asarray(error['q']) if error is not None else noError
+            )
+
+    def scan(self, start, end):
+        with self._lock:
+            if not self._closed:
+                self._append('scans', start = start, end = end, duration = end - start)
+
+    def beamCurrent(self, kind, current, timestamp = None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            if not self._closed:
+                self._append('beamcurrent', timestamp = timestamp, current = current, kind = kind)
+
+    def flush(self):
+        with self._lock:
+            for streamName, stream in self._streams.items():
+                self._flushStream(stream, streamName)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            for streamName, stream in self._streams.items():
+                self._flushStream(stream, streamName)
+            self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+class ArchiveReader:
+    def __init__(self, directory, maxColumns = 64):
+        self._directory = directory
+        self._maxColumns = maxColumns
+        self._columns = OrderedDict()
+
+        # Index rows, global index of the first record and first time of
+        # every shard
+        self._index = { stream : [] for stream in _columnTypes }
+        self._starts = { stream : [ 0 ] for stream in _columnTypes }
+        self._firstTimestamps = { stream : [] for stream in _columnTypes }
+        self.refresh()
+
+    def refresh(self):
+        # Picks up shards that have been written since the archive has been
+        # opened (i.e. while a writer is still running)
+        for stream in _columnTypes:
+            streamDirectory = os.path.join(self._directory, stream)
+            known = self._index[stream]
+            index = _loadIndex(streamDirectory)
+            if index is None:
+                index = _indexShards(streamDirectory, stream, known)
+
+            # Columns mapped from a partial shard that has been rewritten
+            # since don't contain the new records
+            for shard in range(len(known)):
+                if (shard >= len(index)) or (index[shard] != known[shard]):
+                    for name in _columnTypes[stream]:
+                        self._columns.pop((stream, shard, name), None)
+
+            starts = [ 0 ]
+            for row in index:
+                starts.append(starts[-1] + row[1])
+            self._index[stream] = index
+            self._starts[stream] = starts
+            self._firstTimestamps[stream] = [ row[2] for row in index ]
+
+    def _path(self, stream, shard, name):
+        return os.path.join(_shardDirectory(os.path.join(self._directory, stream), self._index[stream][shard][0]), name + ".npy")
+
+    def _column(self, stream, shard, name):
+        # Memory mapped columns are kept in a least recently used cache,
+        # every mapping holds a file descriptor until it has been evicted
+        # and no array taken from it is referenced anymore
+        key = (stream, shard, name)
+        column = self._columns.get(key)
+        if column is not None:
+            self._columns.move_to_end(key)
+            return column
+
+        column = np.load(self._path(stream, shard, name), mmap_mode = 'r')
+        self._columns[key] = column
+        while len(self._columns) > self._maxColumns:
+            self._columns.popitem(last = False)
+        return column
+
+    def __len__(self):
+        return self._starts['peaks'][-1]
+
+    def averages(self):
+        # Number of archived running average states
+        return self._starts['averages'][-1]
+
+    def _locate(self, stream, index):
+        # Shard and index within the shard of a record
+        count = self._starts[stream][-1]
+        if index < 0:
+            index = index + count
+        if (index < 0) or (index >= count):
+            raise IndexError("Record {} not in {} of the archive".format(index, stream))
+        shard = bisect.bisect_right(self._starts[stream], index) - 1
+        return shard, index - self._starts[stream][shard]
+
+    def peak(self, index):
+        shard, i = self._locate('peaks', index)
+        rows = int(self._column('peaks', shard, 'rows')[i])
+        cols = int(self._column('peaks', shard, 'cols')[i])
+        matrixOffset = int(self._column('peaks', shard, 'matrixOffset')[i])
+        pointOffset = int(self._column('peaks', shard, 'pointOffset')[i])
+        points = slice(pointOffset, pointOffset + rows)
+
+        errI = self._column('peaks', shard, 'errI')[points]
+        errQ = self._column('peaks', shard, 'errQ')[points]
+        hasError = (rows > 0) and not np.isnan(errI[0])
+        return {
+            'timestamp' : float(self._column('peaks', shard, 'timestamp')[i]),
+            'kind' : int(self._column('peaks', shard, 'kind')[i]),
+            'n' : int(self._column('peaks', shard, 'n')[i]),
+            'matrix' : self._column('peaks', shard, 'matrix')[matrixOffset:matrixOffset + rows * cols].reshape((rows, cols)),
+            'I' : self._column('peaks', shard, 'I')[points],
+            'sig' : { 'i' : self._column('peaks', shard, 'sigI')[points], 'q' : self._column('peaks', shard, 'sigQ')[points] },
+            'err' : { 'i' : errI, 'q' : errQ } if hasError else { 'i' : None, 'q' : None }
+        }
+
+    def average(self, index):
+        # Running average after the index-th averaged peak
+        shard, i = self._locate('averages', index)
+        pointOffset = int(self._column('averages', shard, 'pointOffset')[i])
+        points = slice(pointOffset, pointOffset + int(self._column('averages', shard, 'points')[i]))
+        return {
+            'timestamp' : float(self._column('averages', shard, 'timestamp')[i]),
+            'kind' : int(self._column('averages', shard, 'kind')[i]),
+            'samples' : int(self._column('averages', shard, 'samples')[i]),
+            'generation' : int(self._column('averages', shard, 'generation')[i]),
+            'I' : self._column('averages', shard, 'I')[points],
+            'sig' : { 'i' : self._column('averages', shard, 'sigI')[points], 'q' : self._column('averages', shard, 'sigQ')[points] },
+            'err' : { 'i' : self._column('averages', shard, 'errI')[points], 'q' : self._column('averages', shard, 'errQ')[points] }
+        }
+
+    def peakIndex(self, timestamp):
+        # Index of the last peak archived at or before timestamp (or -1)
+        shard = bisect.bisect_right(self._firstTimestamps['peaks'], timestamp) - 1
+        if shard < 0:
+            return -1
+        timestamps = self._column('peaks', shard, 'timestamp')[:self._index['peaks'][shard][1]]
+        return self._starts['peaks'][shard] + int(np.searchsorted(timestamps, timestamp, side = 'right')) - 1
+
+    def column(self, stream, name):
+        # Memory mapped column of every shard, one shard at a time so only a
+        # bounded number of files is open while iterating
+        for shard in range(len(self._index[stream])):
+            column = self._column(stream, shard, name)
+            yield column if name in _flatColumns[stream] else column[:self._index[stream][shard][1]]
+
+    def table(self, stream):
+        # All columns of a (small) stream concatenated into memory. Columns
+        # are read without mapping them, every file is closed right away
+        table = {}
+        for name, dtype in _columnTypes[stream].items():
+            parts = []
+            for shard, row in enumerate(self._index[stream]):
+                values = np.load(self._path(stream, shard, name))
+                parts.append(values if name in _flatColumns[stream] else values[:row[1]])
+            table[name] = np.concatenate(parts) if len(parts) > 0 else np.empty(0, dtype = dtype)
+        return table
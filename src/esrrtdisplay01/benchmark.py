@@ -0,0 +1,583 @@
+import argparse
+import json
+import logging
+import math
+import platform
+import random
+import subprocess
+import sys
+import time
+import timeit
+
+import numpy as np
+import matplotlib
+
+from esrrtdisplay01.esrrtdisplay01 import MQTTPatternMatcher, QUAKESRRealtimeDisplay, simulatedMessage
+from esrrtdisplay01.peakstats import peakMatrix, peakStatistics
+from esrrtdisplay01.fitting import PARAMETERS, fitResonance, resonanceModel
+from esrrtdisplay01.codec import defaultJSONDecoder, encodeMatrix, decodeMatrix
+from esrrtdisplay01.simmessages import simMessages
+
+# Reference implementation - this is the nested loop version that has been
+# used by the peak handlers before the statistics got vectorized. It's kept
+# here to compare timing and results.
+
+def referencePeakStatistics(payload):
+    currents = []
+    qAvg = []
+    iAvg = []
+    qErr = None
+    iErr = None
+    n = 0
+
+    for ptCurrent in payload:
+        currents.append(ptCurrent[0])
+
+        n = int((len(ptCurrent)-1) / 2)
+        qSum = 0
+        iSum = 0
+        for ptIteration in range(n):
+            iSum = iSum + ptCurrent[1 + ptIteration] / float(n)
+            qSum = qSum + ptCurrent[1 + n + ptIteration] / float(n)
+        qAvg.append(qSum)
+        iAvg.append(iSum)
+
+        qE = 0
+        iE = 0
+        if n > 1:
+            if qErr is None:
+                qErr = []
+                iErr = []
+
+            for ptIteration in range(n):
+                iE = iE + (ptCurrent[1 + ptIteration] - iSum)*(ptCurrent[1 + ptIteration] - iSum) / float(n)
+                qE = qE + (ptCurrent[1 + ptIteration + n] - qSum)*(ptCurrent[1 + ptIteration + n] - qSum) / float(n)
+            iErr.append(math.sqrt(iE))
+            qErr.append(math.sqrt(qE))
+
+    return {
+        'I' : currents,
+        'n' : n,
+        'sig' : { 'i' : iAvg, 'q' : qAvg },
+        'err' : { 'i' : iErr, 'q' : qErr }
+    }
+
+# Reference topic matching - linear scan over all filters as it has been done
+# by MQTTPatternMatcher before the topic trie
+
+def referenceTopicMatch(filter, topic):
+    filterparts = filter.split("/")
+    topicparts = topic.split("/")
+
+    if topicparts[-1] == "":
+        del topicparts[-1]
+    if filterparts[-1] == "":
+        del filterparts[-1]
+
+    if len(filterparts) > len(topicparts):
+        return False
+
+    for i in range(len(filterparts)):
+        if filterparts[i] == '+':
+            continue
+        if filterparts[i] == '#':
+            return True
+        if filterparts[i] != topicparts[i]:
+            return False
+
+    return True
+
+def syntheticFilters(nFilters, basetopic = "quakesr/experiment/"):
+    filters = [
+        f"{basetopic}scan/peak/peakdata",
+        f"{basetopic}scan/peak/zeropeakdata",
+        f"{basetopic}scan/+/start",
+        f"{basetopic}scan/+/done",
+        f"{basetopic}scan/until/+/start",
+        f"{basetopic}scan/until/+/done",
+        f"{basetopic}egun/beamcurrent/+",
+        f"{basetopic}scan/iteration",
+        f"{basetopic}scan/pointdata"
+    ]
+    for i in range(len(filters), nFilters):
+        kind = i % 3
+        if kind == 0:
+            filters.append(f"{basetopic}device{i}/+/value")
+        elif kind == 1:
+            filters.append(f"{basetopic}device{i}/status/#")
+        else:
+            filters.append(f"{basetopic}device{i}/telemetry/temperature")
+    return filters[:nFilters]
+
+def syntheticTopics(nFilters, basetopic = "quakesr/experiment/", nTopics = 2000, seed = 0):
+    rnd = random.Random(seed)
+    topics = []
+    for _ in range(nTopics):
+        i = rnd.randrange(nFilters)
+        kind = rnd.randrange(4)
+        if kind == 0:
+            topics.append(f"{basetopic}device{i}/channel{rnd.randrange(8)}/value")
+        elif kind == 1:
+            topics.append(f"{basetopic}device{i}/status/link/state")
+        elif kind == 2:
+            topics.append(f"{basetopic}device{i}/telemetry/pressure")
+        else:
+            topics.append(f"{basetopic}scan/peak/peakdata")
+    return topics
+
+def benchmarkDispatch(nFilters, repeat = 5, number = 3):
+    filters = syntheticFilters(nFilters)
+    topics = syntheticTopics(nFilters)
+    hits = [ 0 ]
+    def handler(message):
+        hits[0] = hits[0] + 1
+
+    def referenceDispatch():
+        for topic in topics:
+            for f in filters:
+                if referenceTopicMatch(f, topic):
+                    handler(None)
+
+    matchers = {}
+    for name, cacheSize in (('trie', 0), ('trieCached', 4096)):
+        matcher = MQTTPatternMatcher(routeCacheSize = cacheSize)
+        for f in filters:
+            matcher.registerHandler(f, handler)
+        matchers[name] = matcher
+
+    result = { 'filters' : nFilters, 'topics' : len(topics) }
+    result['reference'] = len(topics) / _bestOf(referenceDispatch, repeat, number)
+    for name, matcher in matchers.items():
+        result[name] = len(topics) / _bestOf(lambda: [ matcher.callHandlers(t, None) for t in topics ], repeat, number)
+    return result
+
+def syntheticPeakPayload(points, iterations, seed = 0):
+    rnd = random.Random(seed)
+    payload = []
+    for pt in range(points):
+        current = 1.7 + pt * 0.001
+        row = [ current ]
+        row.extend([ 10.0 + rnd.gauss(0, 1) for _ in range(iterations) ])
+        row.extend([ 5.0 + rnd.gauss(0, 1) for _ in range(iterations) ])
+        payload.append(row)
+    return payload
+
+# Synthetic resonance (complex Lorentzian plus noise) for the fit benchmark
+
+RESONANCE = { 'center' : 1.75, 'width' : 0.012, 'amplitude' : 8.0, 'phase' : 0.6, 'offsetI' : 10.0, 'offsetQ' : 5.0 }
+
+def syntheticResonancePayload(points, iterations, seed = 0, center = RESONANCE['center']):
+    rnd = np.random.default_rng(seed)
+    B = np.linspace(1.7, 1.8, points)
+    i, q = resonanceModel(B, [ center if name == 'center' else RESONANCE[name] for name in PARAMETERS ])
+    return np.column_stack((
+        B,
+        i[:, None] + rnd.normal(0, 1, (points, iterations)),
+        q[:, None] + rnd.normal(0, 1, (points, iterations))
+    )).tolist()
+
+def _bestOf(fn, repeat, number):
+    return min(timeit.repeat(fn, repeat = repeat, number = number)) / number
+
+def benchmarkPeakStatistics(payloads, repeat = 5, number = 10):
+    tReference = _bestOf(lambda: [ referencePeakStatistics(p) for p in payloads ], repeat, number)
+    tVectorized = _bestOf(lambda: [ peakStatistics(p) for p in payloads ], repeat, number)
+    return {
+        'messages' : len(payloads),
+        'reference' : tReference,
+        'vectorized' : tVectorized,
+        'speedup' : tReference / tVectorized if tVectorized > 0 else float('inf')
+    }
+
+# Benchmarks of the display itself. Displays are created without window so
+# all figures are drawn by Agg canvases (full draws, no blitting)
+
+BASETOPIC = "quakesr/experiment/"
+
+def benchmarkDisplay(plotsize = (640, 480)):
+    return QUAKESRRealtimeDisplay(
+        {
+            'broker' : '',
+            'port' : 0,
+            'user' : '',
+            'pass' : '',
+            'basetopic' : BASETOPIC
+        },
+        plotsize = plotsize,
+        blit = False
+    )
+
+def benchmarkHandlers(messages, repeat = 5, number = 3):
+    # Time per message including the running average update
+    peakMessages = [ simulatedMessage(BASETOPIC + "scan/peak/peakdata", msg) for msg in messages ]
+    zeroMessages = [ simulatedMessage(BASETOPIC + "scan/peak/zeropeakdata", msg) for msg in messages ]
+
+    display = benchmarkDisplay()
+    experiment = display.selectedExperiment()
+    result = { 'messages' : len(messages) }
+    result['peakdata'] = _bestOf(lambda: [ experiment._msghandler_received_peakdata(m) for m in peakMessages ], repeat, number) / len(messages)
+    result['zeropeakdata'] = _bestOf(lambda: [ experiment._msghandler_received_zeropeakdata(m) for m in zeroMessages ], repeat, number) / len(messages)
+
+    # Full dispatch path (routing, handler) of the display
+    result['callHandlers'] = _bestOf(lambda: [ display._mqttHandlers.callHandlers(m.topic, m) for m in peakMessages ], repeat, number) / len(messages)
+    return result
+
+def benchmarkRunningAverage(messages, repeat = 5, number = 3):
+    data = [ peakMatrix(msg['payload']) for msg in messages ]
+
+    experiment = benchmarkDisplay().selectedExperiment()
+    result = {
+        'messages' : len(messages),
+        'signal' : _bestOf(lambda: [ experiment._runningAverageUpdate(d, False) for d in data ], repeat, number) / len(messages),
+        'zero' : _bestOf(lambda: [ experiment._runningAverageUpdate(d, True) for d in data ], repeat, number) / len(messages)
+    }
+
+    # Sliding window and exponentially weighted averages (signal peaks)
+    for mode, peaks in (('window', 10), ('window', 1000), ('exponential', 10)):
+        experiment.setAveragingMode(mode, peaks)
+        result[f"{mode}{peaks}"] = _bestOf(lambda: [ experiment._runningAverageUpdate(d, False) for d in data ], repeat, number) / len(messages)
+    return result
+
+def _fillDisplay(display, messages, historyLength = 500):
+    for i, msg in enumerate(messages):
+        display.feedMessage(BASETOPIC + ("scan/peak/peakdata" if (i % 2) == 0 else "scan/peak/zeropeakdata"), msg)
+
+    t0 = 1700000000
+    for i in range(historyLength):
+        display.feedMessage(BASETOPIC + "scan/peak/done", {
+            'starttime' : time.strftime("%Y-%m-%d_%H:%M:%S", time.gmtime(t0 + 60 * i)),
+            'endtime' : time.strftime("%Y-%m-%d_%H:%M:%S", time.gmtime(t0 + 60 * i + 50 + (i % 7)))
+        })
+        display.feedMessage(BASETOPIC + "egun/beamcurrent/estimate", { 'current' : 1.0 + 0.01 * (i % 13) })
+        display.feedMessage(BASETOPIC + "egun/beamcurrent/measurement", { 'current' : 1.1 + 0.01 * (i % 11) })
+
+    I, _, _ = _payloadColumns(messages[0]['payload'])
+    for pt, current in enumerate(I):
+        display.feedMessage(BASETOPIC + "scan/pointdata", { 'I' : current, 'i' : math.sin(pt / 10.0), 'q' : math.cos(pt / 10.0) })
+
+def benchmarkRedraw(messages, repeat = 5, number = 3, plotsize = (640, 480)):
+    # Every redraw is forced by invalidating the drawn snapshot version, so
+    # the same data is pushed into the artists and rendered again
+    display = benchmarkDisplay(plotsize)
+    _fillDisplay(display, messages)
+    display.createFigures()
+    display.redrawAll()
+
+    result = { 'plotsize' : list(plotsize) }
+    for name, redraw in (
+        ('peak', display.redrawPeakData),
+        ('average', display.redrawAveragedData),
+        ('scanDurations', display.redrawScanDurations),
+        ('beamCurrent', display.redrawBeamCurrent),
+        ('pointData', display.redrawPointData)
+    ):
+        def forcedRedraw(name = name, redraw = redraw):
+            display._drawn.invalidate(name)
+            redraw()
+        result[redraw.__name__] = _bestOf(forcedRedraw, repeat, number)
+    return result
+
+def benchmarkFit(points, iterations, repeat = 5, number = 3):
+    # Fit of a peak from scratch and warm started from the fit of the
+    # previous (slightly shifted) peak
+    previous = peakStatistics(peakMatrix(syntheticResonancePayload(points, iterations, seed = 1, center = RESONANCE['center'] - 0.001)))
+    stats = peakStatistics(peakMatrix(syntheticResonancePayload(points, iterations, seed = 2)))
+    args = (stats['I'], stats['sig']['i'], stats['sig']['q'], stats['err']['i'], stats['err']['q'])
+
+    fitPrevious = fitResonance(previous['I'], previous['sig']['i'], previous['sig']['q'], previous['err']['i'], previous['err']['q'])
+    initial = [ fitPrevious['params'][name] for name in PARAMETERS ]
+    cold = fitResonance(*args)
+    warm = fitResonance(*args, initial = initial)
+    return {
+        'points' : points,
+        'cold' : _bestOf(lambda: fitResonance(*args), repeat, number),
+        'warm' : _bestOf(lambda: fitResonance(*args, initial = initial), repeat, number),
+        'coldIterations' : cold['iterations'],
+        'warmIterations' : warm['iterations']
+    }
+
+def benchmarkDecoding(messages, repeat = 5, number = 3):
+    # Peak payloads as JSON text and as packed float64 / float32 matrices
+    # (decoding and conversion into the peak matrix)
+    decoder = defaultJSONDecoder()
+    encoded = {
+        'json' : [ json.dumps(msg).encode('utf-8') for msg in messages ],
+        'float64' : [ encodeMatrix(msg['payload'], np.float64) for msg in messages ],
+        'float32' : [ encodeMatrix(msg['payload'], np.float32) for msg in messages ]
+    }
+    result = { 'messages' : len(messages) }
+    result['bytes'] = { name : sum(len(raw) for raw in raws) / len(messages) for name, raws in encoded.items() }
+    result['json'] = _bestOf(lambda: [ peakMatrix(decoder(raw)['payload']) for raw in encoded['json'] ], repeat, number) / len(messages)
+    for name in ('float64', 'float32'):
+        result[name] = _bestOf(lambda: [ peakMatrix(decodeMatrix(raw)) for raw in encoded[name] ], repeat, number) / len(messages)
+    return result
+
+# Startup is measured in fresh interpreters: importing the display module
+# and creating and drawing the figures of the first tab (headless)
+
+_startupScript = """
+import time
+t0 = time.perf_counter()
+import esrrtdisplay01.esrrtdisplay01
+t1 = time.perf_counter()
+from esrrtdisplay01.benchmark import benchmarkDisplay
+display = benchmarkDisplay()
+display.createFigures('tabPeak')
+t2 = time.perf_counter()
+print(t1 - t0, t2 - t0)
+"""
+
+def benchmarkStartup(repeat = 3):
+    result = { 'import' : None, 'firstFrame' : None }
+    for _ in range(repeat):
+        out = subprocess.run([ sys.executable, "-c", _startupScript ], capture_output = True, check = True, text = True).stdout.split()
+        tImport, tFirstFrame = float(out[0]), float(out[1])
+        result['import'] = tImport if result['import'] is None else min(result['import'], tImport)
+        result['firstFrame'] = tFirstFrame if result['firstFrame'] is None else min(result['firstFrame'], tFirstFrame)
+    return result
+
+# Golden value regression checks. The vectorized statistics and the running
+# average are compared against the reference implementation above, the
+# simulation messages additionally against fixed values.
+
+GOLDEN = {
+    'simFirstPeak' : { 'sig.i' : 57.375, 'sig.q' : 19.65, 'err.i' : 8.575, 'err.q' : 8.0 },
+    'simAverage' : { 'sig.i' : 55.975, 'sig.q' : 18.536764705882355, 'err.i' : 17.796776889944528, 'err.q' : 18.114715843730725 }
+}
+
+def _payloadColumns(payload):
+    data = peakMatrix(payload)
+    n = (data.shape[1] - 1) // 2
+    return data[:, 0], data[:, 1:1+n], data[:, 1+n:1+2*n]
+
+def _pooledPayload(payloads):
+    # All iterations of all scans as one single scan - the reference result
+    # for the running average
+    columns = [ _payloadColumns(p) for p in payloads ]
+    I = columns[0][0]
+    i = np.concatenate([ c[1] for c in columns ], axis = 1)
+    q = np.concatenate([ c[2] for c in columns ], axis = 1)
+    return np.column_stack((I, i, q)).tolist()
+
+def _compareStatistics(name, result, expected, rtol = 1e-9, atol = 1e-12):
+    deviation = 0.0
+    passed = True
+    for key in ('sig', 'err'):
+        for channel in ('i', 'q'):
+            if (expected[key][channel] is None) or (result[key] is None) or (result[key][channel] is None):
+                if not ((expected[key][channel] is None) and ((result[key] is None) or (result[key][channel] is None))):
+                    passed = False
+                continue
+            a = np.asarray(result[key][channel], dtype = np.float64)
+            b = np.asarray(expected[key][channel], dtype = np.float64)
+            if a.shape != b.shape:
+                passed = False
+                continue
+            deviation = max(deviation, float(np.max(np.abs(a - b))) if len(a) > 0 else 0.0)
+            if not np.allclose(a, b, rtol = rtol, atol = atol):
+                passed = False
+    return { 'name' : name, 'passed' : passed, 'maxDeviation' : deviation }
+
+def _compareSums(name, result, expected, rtol = 1e-9):
+    sums = {}
+    for key in expected:
+        part, channel = key.split(".")
+        sums[key] = float(np.sum(result[part][channel]))
+    passed = all(math.isclose(sums[key], expected[key], rel_tol = rtol) for key in expected)
+    return { 'name' : name, 'passed' : passed, 'values' : sums }
+
+def goldenChecks(syntheticPayloads):
+    checks = []
+
+    for i, msg in enumerate(simMessages):
+        checks.append(_compareStatistics(f"peakStatistics sim[{i}]", peakStatistics(msg['payload']), referencePeakStatistics(msg['payload'])))
+    for name, payload in syntheticPayloads.items():
+        checks.append(_compareStatistics(f"peakStatistics {name}", peakStatistics(payload), referencePeakStatistics(payload)))
+    checks.append(_compareSums("golden sim[0]", peakStatistics(simMessages[0]['payload']), GOLDEN['simFirstPeak']))
+
+    # Running average over all simulation messages, as signal and as zero peaks
+    display = benchmarkDisplay()
+    for msg in simMessages:
+        display.feedMessage(BASETOPIC + "scan/peak/peakdata", msg)
+        display.feedMessage(BASETOPIC + "scan/peak/zeropeakdata", msg)
+    _, average = display.selectedExperiment().snapshots['average'].latest()
+    pooled = referencePeakStatistics(_pooledPayload([ msg['payload'] for msg in simMessages ]))
+    checks.append(_compareStatistics("running average", { 'sig' : average['sig'], 'err' : average['err'] }, pooled))
+    checks.append(_compareStatistics("running average zero", { 'sig' : average['sigZero'], 'err' : average['errZero'] }, pooled))
+    checks.append(_compareSums("golden running average", { 'sig' : average['sig'], 'err' : average['err'] }, GOLDEN['simAverage']))
+
+    # Sliding window over the last two messages and exponential weighting
+    # with a span of one peak (only the last message)
+    experiment = display.selectedExperiment()
+    for mode, peaks, reference in (
+        ('window', 2, _pooledPayload([ msg['payload'] for msg in simMessages[-2:] ])),
+        ('exponential', 1, simMessages[-1]['payload'])
+    ):
+        experiment.setAveragingMode(mode, peaks)
+        for msg in simMessages:
+            display.feedMessage(BASETOPIC + "scan/peak/peakdata", msg)
+        _, average = experiment.snapshots['average'].latest()
+        checks.append(_compareStatistics(f"{mode} average", { 'sig' : average['sig'], 'err' : average['err'] }, referencePeakStatistics(reference)))
+
+    # A coarse and a fine sweep (every other point of the fine grid) merged
+    # onto one grid: points of the coarse grid pool both sweeps
+    fine = syntheticPeakPayload(40, 8, seed = 1)
+    coarse = [ row for k, row in enumerate(syntheticPeakPayload(40, 8, seed = 2)) if (k % 2) == 0 ]
+    display = benchmarkDisplay()
+    display.feedMessage(BASETOPIC + "scan/peak/peakdata", { 'payload' : coarse })
+    display.feedMessage(BASETOPIC + "scan/peak/peakdata", { 'payload' : fine })
+    _, average = display.selectedExperiment().snapshots['average'].latest()
+    shared = _pooledPayload([ coarse, fine[0::2] ])
+    reference = referencePeakStatistics(fine)
+    for ch in ('i', 'q'):
+        for part, pooled in (('sig', referencePeakStatistics(shared)), ('err', referencePeakStatistics(shared))):
+            reference[part][ch] = [ pooled[part][ch][k // 2] if (k % 2) == 0 else value for k, value in enumerate(reference[part][ch]) ]
+    checks.append(_compareStatistics("merged grids", { 'sig' : average['sig'], 'err' : average['err'] }, reference))
+
+    # Differences of the last peak and zero peak
+    display = benchmarkDisplay()
+    display.feedMessage(BASETOPIC + "scan/peak/peakdata", simMessages[0])
+    display.feedMessage(BASETOPIC + "scan/peak/zeropeakdata", simMessages[1])
+    _, peak = display.selectedExperiment().snapshots['peak'].latest()
+    refSig = referencePeakStatistics(simMessages[0]['payload'])
+    refZero = referencePeakStatistics(simMessages[1]['payload'])
+    checks.append(_compareStatistics("peak difference", { 'sig' : peak['sigDiff'], 'err' : peak['errDiff'] }, {
+        'sig' : { ch : [ a - b for a, b in zip(refSig['sig'][ch], refZero['sig'][ch]) ] for ch in ('i', 'q') },
+        'err' : { ch : [ math.hypot(a, b) for a, b in zip(refSig['err'][ch], refZero['err'][ch]) ] for ch in ('i', 'q') }
+    }))
+
+    # Packed float64 matrices have to give exactly the statistics of JSON
+    display = benchmarkDisplay()
+    for msg in simMessages:
+        display.feedMessage(BASETOPIC + "scan/peak/peakdata/bin", encodeMatrix(msg['payload']))
+    _, average = display.selectedExperiment().snapshots['average'].latest()
+    checks.append(_compareStatistics("packed matrices", { 'sig' : average['sig'], 'err' : average['err'] }, referencePeakStatistics(_pooledPayload([ msg['payload'] for msg in simMessages ]))))
+
+    # The resonance fit has to recover the parameters of the synthetic peak
+    # (within five standard errors)
+    stats = peakStatistics(peakMatrix(syntheticResonancePayload(200, 20)))
+    fit = fitResonance(stats['I'], stats['sig']['i'], stats['sig']['q'], stats['err']['i'], stats['err']['q'])
+    deviations = { name : abs(fit['params'][name] - RESONANCE[name]) / fit['errors'][name] for name in PARAMETERS }
+    checks.append({ 'name' : "resonance fit", 'passed' : fit['converged'] and all(d < 5 for d in deviations.values()), 'deviations' : deviations })
+
+    return checks
+
+def _parseGrid(value):
+    try:
+        points, iterations = value.lower().split("x")
+        return int(points), int(iterations)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Grid sizes have to be given as POINTSxITERATIONS (i.e. 500x50)")
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the QUAK/ESR display hot paths")
+    parser.add_argument('--grid', type = _parseGrid, nargs = '+', default = [ (100, 10), (500, 50), (2000, 100) ], help = "Synthetic payload sizes as POINTSxITERATIONS")
+    parser.add_argument('--messages', type = int, default = 4, help = "Number of synthetic messages per grid size")
+    parser.add_argument('--filters', type = int, nargs = '+', default = [ 10, 100, 500 ], help = "Number of registered filters for dispatch benchmarks")
+    parser.add_argument('--repeat', type = int, default = 5)
+    parser.add_argument('--json', dest = 'jsonFile', default = None, help = "Write results as JSON to the given file ('-' for stdout)")
+    parser.add_argument('--no-redraw', dest = 'redraw', action = 'store_false', help = "Skip the matplotlib redraw benchmarks")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+    out = sys.stderr if args.jsonFile == '-' else sys.stdout
+
+    cases = { 'simMessages' : [ { 'payload' : msg['payload'] } for msg in simMessages ] }
+    for points, iterations in args.grid:
+        cases[f"{points}x{iterations}"] = [ { 'payload' : syntheticPeakPayload(points, iterations, seed = i) } for i in range(args.messages) ]
+
+    results = {
+        'timestamp' : time.time(),
+        'python' : platform.python_version(),
+        'numpy' : np.__version__,
+        'matplotlib' : matplotlib.__version__,
+        'platform' : platform.platform(),
+        'repeat' : args.repeat,
+        'golden' : goldenChecks({ name : msgs[0]['payload'] for name, msgs in cases.items() if name != 'simMessages' }),
+        'startup' : benchmarkStartup(),
+        'cases' : {},
+        'dispatch' : []
+    }
+
+    failed = [ check['name'] for check in results['golden'] if not check['passed'] ]
+    print("golden value checks: {} of {} passed".format(len(results['golden']) - len(failed), len(results['golden'])), file = out)
+    for name in failed:
+        print("  FAILED: {}".format(name), file = out)
+
+    print("startup: import {:.3f} s, first frame {:.3f} s".format(results['startup']['import'], results['startup']['firstFrame']), file = out)
+
+    for name, messages in cases.items():
+        case = {
+            'peakStatistics' : benchmarkPeakStatistics([ msg['payload'] for msg in messages ], repeat = args.repeat),
+            'handlers' : benchmarkHandlers(messages, repeat = args.repeat),
+            'runningAverage' : benchmarkRunningAverage(messages, repeat = args.repeat),
+            'decoding' : benchmarkDecoding(messages, repeat = args.repeat)
+        }
+        if args.redraw:
+            case['redraw'] = benchmarkRedraw(messages, repeat = args.repeat)
+        if name != 'simMessages':
+            points, iterations = (int(n) for n in name.split("x"))
+            case['fit'] = benchmarkFit(points, iterations, repeat = args.repeat)
+        results['cases'][name] = case
+
+        print("{}: statistics reference {:.3f} ms, vectorized {:.3f} ms, speedup {:.1f}x".format(
+            name,
+            case['peakStatistics']['reference'] * 1e3,
+            case['peakStatistics']['vectorized'] * 1e3,
+            case['peakStatistics']['speedup']
+        ), file = out)
+        print("{}: per message peakdata {:.3f} ms, zeropeakdata {:.3f} ms, callHandlers {:.3f} ms, running average {:.3f} ms".format(
+            name,
+            case['handlers']['peakdata'] * 1e3,
+            case['handlers']['zeropeakdata'] * 1e3,
+            case['handlers']['callHandlers'] * 1e3,
+            case['runningAverage']['signal'] * 1e3
+        ), file = out)
+        print("{}: running average window of 10 peaks {:.3f} ms, of 1000 peaks {:.3f} ms, exponential {:.3f} ms".format(
+            name,
+            case['runningAverage']['window10'] * 1e3,
+            case['runningAverage']['window1000'] * 1e3,
+            case['runningAverage']['exponential10'] * 1e3
+        ), file = out)
+        print("{}: decoding JSON {:.3f} ms ({:.0f} kB), packed float64 {:.3f} ms ({:.0f} kB), float32 {:.3f} ms ({:.0f} kB)".format(
+            name,
+            case['decoding']['json'] * 1e3, case['decoding']['bytes']['json'] / 1024.0,
+            case['decoding']['float64'] * 1e3, case['decoding']['bytes']['float64'] / 1024.0,
+            case['decoding']['float32'] * 1e3, case['decoding']['bytes']['float32'] / 1024.0
+        ), file = out)
+        if 'fit' in case:
+            print("{}: resonance fit {:.3f} ms ({} iterations), warm started {:.3f} ms ({} iterations)".format(
+                name,
+                case['fit']['cold'] * 1e3,
+                case['fit']['coldIterations'],
+                case['fit']['warm'] * 1e3,
+                case['fit']['warmIterations']
+            ), file = out)
+        if args.redraw:
+            print("{}: redraw {}".format(
+                name,
+                ", ".join("{} {:.1f} ms".format(method, t * 1e3) for method, t in case['redraw'].items() if method != 'plotsize')
+            ), file = out)
+
+    for nFilters in args.filters:
+        res = benchmarkDispatch(nFilters, repeat = args.repeat)
+        results['dispatch'].append(res)
+        print("dispatch {} filters: reference {:.0f} msg/s, trie {:.0f} msg/s, trie with route cache {:.0f} msg/s".format(
+            nFilters,
+            res['reference'],
+            res['trie'],
+            res['trieCached']
+        ), file = out)
+
+    if args.jsonFile == '-':
+        json.dump(results, sys.stdout, indent = 4)
+        print()
+    elif args.jsonFile is not None:
+        with open(args.jsonFile, 'w') as f:
+            json.dump(results, f, indent = 4)
+
+    if len(failed) > 0:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
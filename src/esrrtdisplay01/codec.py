@@ -0,0 +1,82 @@
+import json
+import struct
+
+import numpy as np
+
+# Pluggable JSON decoding of MQTT payloads. orjson is used if it's installed
+# (pip install quakesrrtdisplay-tspspi[fast]), the standard library decoder
+# is used otherwise. Both accept the raw payload bytes as delivered by paho.
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def stdlibJSONDecoder(raw):
+    if isinstance(raw, (bytes, bytearray, memoryview)):
+        raw = bytes(raw).decode('utf-8', 'ignore')
+    return json.loads(raw)
+
+def orjsonJSONDecoder(raw):
+    try:
+        return orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        # orjson refuses invalid UTF-8 - the stdlib decoder skips such bytes
+        return stdlibJSONDecoder(raw)
+
+def defaultJSONDecoder():
+    if orjson is not None:
+        return orjsonJSONDecoder
+    return stdlibJSONDecoder
+
+# Binary packed matrices (peak data, point data) as compact alternative to
+# JSON. A 16 byte header is followed by the values in row major order:
+#
+#   magic     'QESR'
+#   version   u8 (1)
+#   itemsize  u8, 4 (float32) or 8 (float64)
+#   reserved  u16
+#   rows      u32
+#   columns   u32
+#
+# All fields and values are little endian. Publishers select the format by
+# publishing on the topic with the suffix /bin or (MQTT v5) by setting the
+# content type MATRIX_CONTENT_TYPE. Decoding doesn't copy the values - the
+# matrix is a read only view into the received payload.
+
+MATRIX_MAGIC = b'QESR'
+MATRIX_VERSION = 1
+MATRIX_CONTENT_TYPE = "application/x-quakesr-matrix"
+MATRIX_TOPIC_SUFFIX = "/bin"
+
+_matrixHeader = struct.Struct('<4sBBHII')
+_matrixTypes = { 4 : np.dtype('<f4'), 8 : np.dtype('<f8') }
+
+def encodeMatrix(matrix, dtype = np.float64):
+    matrix = np.asarray(matrix, dtype = np.dtype(dtype).newbyteorder('<'))
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    if (matrix.ndim != 2) or (matrix.dtype.itemsize not in _matrixTypes):
+        raise ValueError("Only float32 or float64 matrices can be packed")
+    header = _matrixHeader.pack(MATRIX_MAGIC, MATRIX_VERSION, matrix.dtype.itemsize, 0, matrix.shape[0], matrix.shape[1])
+    return header + np.ascontiguousarray(matrix).tobytes()
+
+def decodeMatrix(raw):
+    if len(raw) < _matrixHeader.size:
+        raise ValueError("Packed matrix is shorter than its header")
+    magic, version, itemsize, _, rows, columns = _matrixHeader.unpack_from(raw)
+    if (magic != MATRIX_MAGIC) or (version != MATRIX_VERSION) or (itemsize not in _matrixTypes):
+        raise ValueError("Unsupported packed matrix (version {}, item size {})".format(version, itemsize))
+    if len(raw) != _matrixHeader.size + rows * columns * itemsize:
+        raise ValueError("Packed matrix of {}x{} values has {} bytes".format(rows, columns, len(raw)))
+    return np.frombuffer(raw, dtype = _matrixTypes[itemsize], count = rows * columns, offset = _matrixHeader.size).reshape(rows, columns)
+
+def isPackedMatrix(msg):
+    # Negotiated by topic suffix or content type. Recorded messages lose
+    # their properties, so the magic is accepted as well
+    if msg.topic.endswith(MATRIX_TOPIC_SUFFIX):
+        return True
+    properties = getattr(msg, 'properties', None)
+    if (properties is not None) and (getattr(properties, 'ContentType', None) == MATRIX_CONTENT_TYPE):
+        return True
+    return isinstance(msg.payload, (bytes, bytearray, memoryview)) and (bytes(msg.payload[:len(MATRIX_MAGIC)]) == MATRIX_MAGIC)
@@ -0,0 +1,230 @@
+import bisect
+import logging
+import threading
+import time
+
+# Runtime instrumentation of the display. Counts messages per topic, keeps
+# latency histograms of payload decoding, every message handler, the time from
+# receiving a message to the frame that drew it and the draw time of every
+# figure, and measures the rate of GUI loop iterations.
+#
+# All recording methods are cheap (one lock, a few additions) so they can
+# stay enabled during normal operation. They're called from the MQTT network
+# thread as well as from the GUI thread.
+
+class LatencyHistogram:
+    # Log spaced buckets from 1 us to 100 s, 8 buckets per decade. Values
+    # outside are counted in the first / last bucket
+    _edges = [ 10.0 ** (e / 8.0) for e in range(-6 * 8, 2 * 8 + 1) ]
+
+    def __init__(self):
+        self._counts = [ 0 ] * (len(self._edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self._counts[bisect.bisect_left(self._edges, seconds)] += 1
+        self.count = self.count + 1
+        self.total = self.total + seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def mean(self):
+        return self.total / self.count if self.count > 0 else None
+
+    def percentile(self, p):
+        # Upper edge of the bucket containing the p-th percentile (limited to
+        # the largest value seen)
+        if self.count == 0:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self._counts):
+            seen = seen + n
+            if (seen >= rank) and (n > 0):
+                if i >= len(self._edges):
+                    return self.max
+                return min(self._edges[i], self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count' : self.count,
+            'mean' : self.mean(),
+            'p50' : self.percentile(50),
+            'p90' : self.percentile(90),
+            'p99' : self.percentile(99),
+            'max' : self.max if self.count > 0 else None
+        }
+
+class RateMeter:
+    # Events per second, measured over windows of 'interval' seconds
+    def __init__(self, interval = 1.0):
+        self._interval = interval
+        self._windowStart = None
+        self._windowCount = 0
+        self._rate = 0.0
+        self.total = 0
+
+    def _roll(self, now):
+        if self._windowStart is None:
+            self._windowStart = now
+            return
+        elapsed = now - self._windowStart
+        if elapsed >= self._interval:
+            self._rate = self._windowCount / elapsed
+            self._windowCount = 0
+            self._windowStart = now
+
+    def add(self, n = 1, now = None):
+        self._roll(time.monotonic() if now is None else now)
+        self._windowCount = self._windowCount + n
+        self.total = self.total + n
+
+    def rate(self, now = None):
+        self._roll(time.monotonic() if now is None else now)
+        return self._rate
+
+class Diagnostics:
+    def __init__(self, maxTopics = 256, startedAt = None):
+        self._lock = threading.Lock()
+        self._started = time.monotonic() if startedAt is None else startedAt
+        self._startup = {}
+        self._maxTopics = maxTopics
+
+        self._topics = {}
+        self._bytes = RateMeter()
+        self._decode = LatencyHistogram()
+        self._handlers = {}
+        self._latency = LatencyHistogram()
+        self._draws = {}
+        self._fullDraws = {}
+        self._loop = RateMeter()
+        self._undrawnSince = None
+        self.deferredFrames = 0
+        self.ingestion = None
+
+    def messageReceived(self, topic, size, receivedAt):
+        with self._lock:
+            if (topic not in self._topics) and (len(self._topics) >= self._maxTopics):
+                topic = "(other)"
+            if topic not in self._topics:
+                self._topics[topic] = RateMeter()
+            self._topics[topic].add(now = receivedAt)
+            self._bytes.add(size, now = receivedAt)
+
+    def messageHandled(self, receivedAt):
+        # The oldest handled message that has not been drawn yet
+        if receivedAt is None:
+            return
+        with self._lock:
+            if (self._undrawnSince is None) or (receivedAt < self._undrawnSince):
+                self._undrawnSince = receivedAt
+
+    def decoded(self, seconds):
+        with self._lock:
+            self._decode.add(seconds)
+
+    def handlerTime(self, name, seconds):
+        with self._lock:
+            if name not in self._handlers:
+                self._handlers[name] = LatencyHistogram()
+            self._handlers[name].add(seconds)
+
+    def drawTime(self, name, seconds, fullDraw):
+        with self._lock:
+            if name not in self._draws:
+                self._draws[name] = LatencyHistogram()
+                self._fullDraws[name] = 0
+            self._draws[name].add(seconds)
+            if fullDraw:
+                self._fullDraws[name] = self._fullDraws[name] + 1
+
+    def frameStarted(self):
+        # Returns the receive time of the oldest message the frame is going
+        # to pick up (or None)
+        with self._lock:
+            since = self._undrawnSince
+            self._undrawnSince = None
+            return since
+
+    def frameFinished(self, since):
+        if since is None:
+            return
+        with self._lock:
+            self._latency.add(time.monotonic() - since)
+
+    def startupMark(self, name):
+        # Time from startup until the given milestone has been reached first
+        with self._lock:
+            if name not in self._startup:
+                self._startup[name] = time.monotonic() - self._started
+                logging.info("Startup: {} after {:.3f} s".format(name, self._startup[name]))
+
+    def loopIteration(self):
+        with self._lock:
+            self._loop.add()
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                'uptime' : now - self._started,
+                'startup' : dict(self._startup),
+                'loopRate' : self._loop.rate(now),
+                'loopIterations' : self._loop.total,
+                'deferredFrames' : self.deferredFrames,
+                'ingestion' : self.ingestion,
+                'bytesRate' : self._bytes.rate(now),
+                'messages' : { topic : { 'count' : meter.total, 'rate' : meter.rate(now) } for topic, meter in self._topics.items() },
+                'decode' : self._decode.summary(),
+                'handlers' : { name : hist.summary() for name, hist in self._handlers.items() },
+                'receiptToRedraw' : self._latency.summary(),
+                'draw' : { name : dict(hist.summary(), fullDraws = self._fullDraws[name]) for name, hist in self._draws.items() }
+            }
+
+def _ms(value):
+    return "{:9.2f}".format(value * 1e3) if value is not None else "        -"
+
+def formatReport(stats):
+    lines = [
+        "Uptime {:.0f} s, GUI loop {:.1f} it/s ({} iterations), deferred frames {}, received {:.1f} kB/s".format(
+            stats['uptime'], stats['loopRate'], stats['loopIterations'], stats['deferredFrames'], stats['bytesRate'] / 1024.0
+        ),
+        "Startup: " + (", ".join("{} after {:.3f} s".format(name, seconds) for name, seconds in stats['startup'].items()) if len(stats['startup']) > 0 else "-"),
+    ]
+    ingestion = stats.get('ingestion')
+    if ingestion is not None:
+        lines.append("Ingestion queue {} of {} (max {}), received {}, handled {}, pending {}, merged {}, dropped {}, {}reading paused {} times for {:.1f} s".format(
+            ingestion['queueLength'], ingestion['queueSize'], ingestion['queueHighWater'], ingestion['received'], ingestion['handled'],
+            ingestion['pending'], sum(ingestion['merged'].values()), sum(ingestion['dropped'].values()),
+            "PAUSED, " if ingestion['paused'] else "", ingestion['pauses'], ingestion['pausedSeconds']
+        ))
+    lines.append("")
+    if ingestion is None:
+        lines.append("{:<60} {:>10} {:>10}".format("Topic", "Messages", "Msg/s"))
+        for topic in sorted(stats['messages']):
+            lines.append("{:<60} {:>10} {:>10.2f}".format(topic, stats['messages'][topic]['count'], stats['messages'][topic]['rate']))
+    else:
+        # Messages merged into batches or dropped in favour of newer ones
+        # while waiting for the handlers
+        lines.append("{:<60} {:>10} {:>10} {:>10} {:>10}".format("Topic", "Messages", "Msg/s", "Merged", "Dropped"))
+        for topic in sorted(stats['messages']):
+            lines.append("{:<60} {:>10} {:>10.2f} {:>10} {:>10}".format(
+                topic, stats['messages'][topic]['count'], stats['messages'][topic]['rate'],
+                ingestion['merged'].get(topic, 0), ingestion['dropped'].get(topic, 0)
+            ))
+
+    lines.append("")
+    lines.append("{:<45} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9}".format("Timing [ms]", "Count", "Mean", "p50", "p90", "p99", "Max"))
+    rows = [ ("Payload decoding", stats['decode']), ("Receipt to redraw", stats['receiptToRedraw']) ]
+    if ingestion is not None:
+        rows.append(("Ingestion queue wait", ingestion['queueWait']))
+    rows.extend(("Handler " + name, summary) for name, summary in sorted(stats['handlers'].items()))
+    rows.extend(("Draw {} ({} full)".format(name, summary['fullDraws']), summary) for name, summary in sorted(stats['draw'].items()))
+    for name, summary in rows:
+        lines.append("{:<45} {:>8} {} {} {} {} {}".format(
+            name[:45], summary['count'], _ms(summary['mean']), _ms(summary['p50']), _ms(summary['p90']), _ms(summary['p99']), _ms(summary['max'])
+        ))
+    return "\n".join(lines)
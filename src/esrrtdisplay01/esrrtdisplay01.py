@@ -3,17 +3,33 @@ import paho.mqtt.client as mqtt
 from pathlib import Path
 import os
 
+import argparse
 import logging
+import threading
 import json
-import math
+import time
+import cProfile
+import pstats
 
-import random
+from collections import OrderedDict
+
+import numpy as np
 
-from datetime import datetime
+import random
 
 import FreeSimpleGUI as sg
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, FigureCanvasAgg
-from matplotlib.figure import Figure
+
+from esrrtdisplay01.codec import defaultJSONDecoder, decodeMatrix, isPackedMatrix
+from esrrtdisplay01.diagnostics import Diagnostics, formatReport
+from esrrtdisplay01.recorder import MessageLogWriter, MessageLogReader
+from esrrtdisplay01.plotting import LivePlot
+from esrrtdisplay01.scheduler import RedrawScheduler
+from esrrtdisplay01.snapshot import SnapshotConsumer
+from esrrtdisplay01.experiment import Experiment
+from esrrtdisplay01.archive import ArchiveWriter
+from esrrtdisplay01.ingest import AsyncIngestion
+from esrrtdisplay01.fitting import PARAMETERS, ResonanceFitter, resonanceModel
+from esrrtdisplay01.peakstats import AVERAGE_MODES
 
 
 class simulatedMessage:
@@ -21,55 +37,135 @@ class simulatedMessage:
         self.topic = topic
         self.payload = payload
 
-class MQTTPatternMatcher:
+class _TopicTrieNode:
+    __slots__ = ('children', 'handlers')
+
     def __init__(self):
-        self._handlers = []
+        self.children = {}
+        self.handlers = []
+
+class MQTTPatternMatcher:
+    # Filters are compiled into a trie with one level per topic level; the
+    # '+' and '#' wildcards are stored as ordinary children. Lookups walk the
+    # trie once per message instead of matching every registered filter and
+    # the result for each concrete topic is kept in a bounded LRU cache that
+    # is dropped whenever handlers are added or removed.
+
+    def __init__(self, routeCacheSize = 1024):
+        self._handlers = {}
         self._idcounter = 0
+        self._trie = _TopicTrieNode()
+        self._routeCache = OrderedDict()
+        self._routeCacheSize = routeCacheSize
+        self.onFiltersChanged = None
+
+    def _splitTopic(self, topic):
+        parts = topic.split("/")
+        # If last part of topic or filter is empty - drop ...
+        if (len(parts) > 1) and (parts[-1] == ""):
+            del parts[-1]
+        return parts
 
     def registerHandler(self, pattern, handler):
         self._idcounter = self._idcounter + 1
-        self._handlers.append({ 'id' : self._idcounter, 'pattern' : pattern, 'handler' : handler })
+
+        node = self._trie
+        for part in self._splitTopic(pattern):
+            child = node.children.get(part)
+            if child is None:
+                child = _TopicTrieNode()
+                node.children[part] = child
+            node = child
+
+        entry = { 'id' : self._idcounter, 'pattern' : pattern, 'handler' : handler, 'node' : node }
+        node.handlers.append(entry)
+        self._handlers[self._idcounter] = entry
+        self._routeCache = OrderedDict()
+        self._filtersChanged()
         return self._idcounter
 
     def removeHandler(self, handlerId):
-        newHandlerList = []
-        for entry in self._handlers:
-            if entry['id'] == handlerId:
-                continue
-            newHandlerList.append(entry)
-        self._handlers = newHandlerList
-
-    def _checkTopicMatch(self, filter, topic):
-        filterparts = filter.split("/")
-        topicparts = topic.split("/")
-
-        # If last part of topic or filter is empty - drop ...
-        if topicparts[-1] == "":
-            del topicparts[-1]
-        if filterparts[-1] == "":
-            del filterparts[-1]
-
-        # If filter is longer than topics we cannot have a match
-        if len(filterparts) > len(topicparts):
-            return False
-
-        # Check all levels till we have a mistmatch or a multi level wildcard match,
-        # continue scanning while we have a correct filter and no multi level match
-        for i in range(len(filterparts)):
-            if filterparts[i] == '+':
-                continue
-            if filterparts[i] == '#':
+        entry = self._handlers.pop(handlerId, None)
+        if entry is None:
+            return
+        entry['node'].handlers = [ e for e in entry['node'].handlers if e['id'] != handlerId ]
+        self._routeCache = OrderedDict()
+        self._filtersChanged()
+
+    def _filtersChanged(self):
+        if self.onFiltersChanged is not None:
+            self.onFiltersChanged()
+
+    def _filterCovers(self, general, specific):
+        generalparts = self._splitTopic(general)
+        specificparts = self._splitTopic(specific)
+        for i in range(len(generalparts)):
+            if generalparts[i] == '#':
                 return True
-            if filterparts[i] != topicparts[i]:
+            if i >= len(specificparts):
+                return False
+            if specificparts[i] == '#':
                 return False
+            if (generalparts[i] != '+') and (generalparts[i] != specificparts[i]):
+                return False
+        return len(generalparts) == len(specificparts)
+
+    def filters(self):
+        # Minimal set of filters that covers all registered handlers - filters
+        # that are already covered by a more general one are dropped so the
+        # broker doesn't deliver messages twice
+        patterns = sorted(set(entry['pattern'] for entry in self._handlers.values()))
+        result = set()
+        for pattern in patterns:
+            covered = False
+            for other in patterns:
+                if (other != pattern) and self._filterCovers(other, pattern):
+                    # Of two filters covering each other keep the first one
+                    if (not self._filterCovers(pattern, other)) or (other < pattern):
+                        covered = True
+                        break
+            if not covered:
+                result.add(pattern)
+        return result
+
+    def _collectHandlers(self, node, parts, level, result):
+        # A multi level wildcard also matches the parent level
+        wildcard = node.children.get('#')
+        if wildcard is not None:
+            result.extend(wildcard.handlers)
+
+        if level == len(parts):
+            result.extend(node.handlers)
+            return
 
-        # Topic applies
-        return True
+        child = node.children.get(parts[level])
+        if child is not None:
+            self._collectHandlers(child, parts, level + 1, result)
+        child = node.children.get('+')
+        if child is not None:
+            self._collectHandlers(child, parts, level + 1, result)
+
+    def matchHandlers(self, topic):
+        cache = self._routeCache
+        handlers = cache.get(topic)
+        if handlers is not None:
+            cache.move_to_end(topic)
+            return handlers
+
+        entries = []
+        self._collectHandlers(self._trie, self._splitTopic(topic), 0, entries)
+        entries.sort(key = lambda e: e['id'])
+        handlers = tuple(e['handler'] for e in entries)
+
+        if self._routeCacheSize > 0:
+            cache[topic] = handlers
+            if len(cache) > self._routeCacheSize:
+                cache.popitem(last = False)
+        return handlers
 
     def callHandlers(self, topic, message):
-        for regHandler in self._handlers:
-            if self._checkTopicMatch(regHandler['pattern'], topic):
-                regHandler['handler'](message)
+        for handler in self.matchHandlers(topic):
+            handler(message)
 
 
 
@@ -95,24 +191,39 @@ class ModalDialogError:
                 return None
 
 
+def loadConnectionConfig(path = None):
+    # Defaults for the connection dialog (or the connection itself when
+    # started without dialog)
+    defaults = {
+        'broker' : '',
+        'port' : '',
+        'user' : '',
+        'password' : '',
+        'basetopic' : ''
+    }
+
+    if path is None:
+        path = os.path.join(Path.home(), ".config/quakesrdisplay/connection.conf")
+    try:
+        with open(path) as cfgCon:
+            defaults.update(json.load(cfgCon))
+    except FileNotFoundError:
+        pass
+    return defaults
+
+def parseBasetopics(basetopic):
+    # Several experiments are given as list or as comma separated base topics
+    if isinstance(basetopic, str):
+        basetopic = basetopic.split(",")
+    return [ topic.strip() for topic in basetopic if len(topic.strip()) > 0 ]
+
 class WindowConnect:
     def __init__(self):
         pass
 
-    def showConnect(self):
-        defaults = {
-            'broker' : '',
-            'port' : '',
-            'user' : '',
-            'password' : '',
-            'basetopic' : ''
-        }
-
-        try:
-            with open(os.path.join(Path.home(), ".config/quakesrdisplay/connection.conf")) as cfgCon:
-                defaults = json.load(cfgCon)
-        except FileNotFoundError:
-            pass
+    def showConnect(self, defaults = None):
+        if defaults is None:
+            defaults = loadConnectionConfig()
 
         layout = [
             [
@@ -121,14 +232,14 @@ class WindowConnect:
                     [ sg.Text("MQTT port:") ],
                     [ sg.Text("MQTT user:") ],
                     [ sg.Text("MQTT password:") ],
-                    [ sg.Text("Base topic:") ]
+                    [ sg.Text("Base topic(s):") ]
                 ]),
                 sg.Column([
                     [ sg.InputText(defaults['broker'], key="txtBroker") ],
                     [ sg.InputText(defaults['port'], key="txtBrokerPort") ],
                     [ sg.InputText(defaults['user'], key="txtBrokerUser") ],
                     [ sg.InputText(defaults['password'], key="txtBrokerPassword") ],
-                    [ sg.InputText(defaults['basetopic'], key="txtBasetopic") ]
+                    [ sg.InputText(", ".join(parseBasetopics(defaults['basetopic'])), key="txtBasetopic") ]
                 ]),
             ],
             [
@@ -152,7 +263,7 @@ class WindowConnect:
                     ModalDialogError().show("Invalid broker port", "The supplied broker port is invalid")
                 brokeruser = values['txtBrokerUser']
                 brokerpass = values['txtBrokerPassword']
-                basetopic = values['txtBasetopic']
+                basetopic = parseBasetopics(values['txtBasetopic'])
 
                 window.close()
 
@@ -164,784 +275,583 @@ class WindowConnect:
                     'basetopic' : basetopic
                 }
 
-class QUAKESRRealtimeDisplay:
-    def __init__(
-        self,
-        connectionData,
-
-        plotsize = (320, 240)
-    ):
-        self._condata = connectionData
-        if self._condata['basetopic'][-1] != '/':
-            self._condata['basetopic'] = self._condata['basetopic'] + "/"
-
-        self._plotsize = plotsize
-        self._statusstring = "Not connected"
-        self._lastscan = { 'start' : "", 'stop' : "", 'duration' : "", 'type' : "" }
-        self._mqttHandlers = MQTTPatternMatcher()
-
-        self._mqttHandlers.registerHandler(f"{self._condata['basetopic']}scan/peak/peakdata", self._msghandler_received_peakdata)
-        self._mqttHandlers.registerHandler(f"{self._condata['basetopic']}scan/peak/zeropeakdata", self._msghandler_received_zeropeakdata)
-        self._mqttHandlers.registerHandler(f"{self._condata['basetopic']}scan/+/start", self._msghandler_received_startscan)
-        self._mqttHandlers.registerHandler(f"{self._condata['basetopic']}scan/+/done", self._msghandler_received_donescan)
+# Figure name, tab, Tk canvas key, x label, y label, title, options. Figures
+# are created when their tab is shown for the first time
+FIGURES = (
+    ('sig', 'tabPeak', 'canvSig', 'B0', 'uV', 'Last peak signal', {}),
+    ('err', 'tabPeak', 'canvErr', 'B0', 'uV', 'Last peak error', {}),
 
-        self._mqttHandlers.registerHandler(f"{self._condata['basetopic']}scan/until/+/start", self._msghandler_received_startscan)
-        self._mqttHandlers.registerHandler(f"{self._condata['basetopic']}scan/until/+/done", self._msghandler_received_donescan)
+    ('sigZero', 'tabPeak', 'canvSigZero', 'B0', 'uV', 'Last peak zero signal', {}),
+    ('errZero', 'tabPeak', 'canvErrZero', 'B0', 'uV', 'Zero signal error', {}),
 
-        self._mqttHandlers.registerHandler(f"{self._condata['basetopic']}scanuntil/start", self._msghandler_resetandenableaverage)
-        self._mqttHandlers.registerHandler(f"{self._condata['basetopic']}scanuntil/done", self._msghandler_stoprunningaverage)
+    ('sigDiff', 'tabPeak', 'canvSigDiff', 'B0', 'uV', 'Current signal difference', {}),
+    ('errDiff', 'tabPeak', 'canvErrDiff', 'B0', 'uV', 'Current error difference', {}),
 
-        self._mqttHandlers.registerHandler(f"{self._condata['basetopic']}egun/beamcurrent/estimate", self._msghandler_beamcurrentestimate)
-        self._mqttHandlers.registerHandler(f"{self._condata['basetopic']}egun/beamcurrent/measurement", self._msghandler_beamcurrentmeasurement)
+    ('sigAvg', 'tabAverage', 'canvSigAVG', 'B0', 'uV', 'Peak signal (averaged)', {}),
+    ('errAvg', 'tabAverage', 'canvErrAVG', 'B0', 'uV', 'Error (averaged)', {}),
 
-        self._mqttHandlers.registerHandler(f"{self._condata['basetopic']}scan/iteration", self._msghandler_received_scaniteration)
+    ('sigZeroAvg', 'tabAverage', 'canvSigZeroAVG', 'B0', 'uV', 'Zero signal (averaged)', {}),
+    ('errZeroAvg', 'tabAverage', 'canvErrZeroAVG', 'B0', 'uV', 'Zero error (averaged)', {}),
 
-        self._mqttHandlers.registerHandler(f"{self._condata['basetopic']}scan/pointdata", self._msghandler_received_pointdata)
+    ('sigDiffAvg', 'tabAverage', 'canvSigDiffAVG', 'B0', 'uV', 'Difference signal (averaged)', {}),
+    ('errDiffAvg', 'tabAverage', 'canvErrDiffAVG', 'B0', 'uV', 'Difference error (averaged)', {}),
 
-        self._showDiffInSigma = False
+    ('scanDurations', 'tabScanDuration', 'canvMeasDuration', 'Scan', 'Duration [s]', 'Scan durations', {}),
 
-        self._lastPeakData = {
-            'I' : None,
-            'sig' : None,
-            'err' : None,
-            'sigZero' : None,
-            'errZero' : None,
-            'sigDiff' : None,
-            'errDiff' : None,
-            'n' : None,
-            'changed' : False
-        }
+    ('ebeamCurrentMeas', 'tabBeamCurrent', 'canvEbeamCurrentMeas', 'Scan', 'Current (uA)', 'Measured beam current', {}),
+    ('ebeamCurrentEst', 'tabBeamCurrent', 'canvEbeamCurrentEst', 'Scan', 'Current (uA)', 'Estimated beam current', {}),
 
-        self._scanDurations = []
-        self._scanDurationsUpdated = True
+    ('pointCurScan', 'tabPointData', 'canvPointCurScan', 'B0/f_RF', 'Current (uA)', 'Realtime points aquired', { 'viewMargin' : 0.25 }),
 
-        self._lastPointData = {
-            'I' : [],
-            'i' : [],
-            'q' : [],
-            'changed' : True
-        }
-        self._currentPeakRealtime = {
-            'signal' : {
-                'I' : [],
-                'i' : [],
-                'q' : []
-            },
-            'zero' : {
-                'I' : [],
-                'i' : [],
-                'q' : []
-            },
-            'diff' : {
-                'I' : [],
-                'i' : [],
-                'q' : []
-            }
-        }
-        self._pointdataClear = True
+    ('fitCenter', 'tabFit', 'canvFitCenter', 'Peak', 'B0', 'Fitted resonance center', {}),
+    ('fitWidth', 'tabFit', 'canvFitWidth', 'Peak', 'B0', 'Fitted resonance width', {})
+)
 
-        self._ebeamCurrentEst = []
-        self._ebeamCurrentMeas = []
-        self._ebeamUpdated = True
+# Tab showing the figures of each snapshot. Changes of snapshots on hidden
+# tabs are not drawn - the snapshot stays marked as changed and is drawn
+# once (with the latest data) when its tab gets selected
+SNAPSHOT_TABS = {
+    'peak' : 'tabPeak',
+    'pointData' : 'tabPointData',
+    'average' : 'tabAverage',
+    'scanDurations' : 'tabScanDuration',
+    'beamCurrent' : 'tabBeamCurrent',
+    'fitDrift' : 'tabFit'
+}
 
-        self._runningAverageInit()
+AVERAGE_MODE_LABELS = {
+    'cumulative' : 'Cumulative',
+    'window' : 'Sliding window',
+    'exponential' : 'Exponentially weighted'
+}
 
-    def _msghandler_received_startscan(self, message):
-        try:
-            self._lastscan['start'] = message.payload['starttime']
-        except:
-            self._lastscan['start'] = ""
-            pass
-        self._lastscan['stop'] = ""
-        self._lastscan['duration'] = ""
-
-    def _msghandler_received_donescan(self, message):
-        try:
-            self._lastscan['start'] = message.payload['starttime'].replace("_", " ")
-            self._lastscan['stop'] = message.payload['endtime'].replace("_", " ")
-
-            stime = datetime.strptime(message.payload['starttime'], "%Y-%m-%d_%H:%M:%S")
-            etime = datetime.strptime(message.payload['endtime'], "%Y-%m-%d_%H:%M:%S")
-
-            self._lastscan['duration'] = str((etime-stime).total_seconds()) + "s (" + str(etime - stime) + ")"
-            self._scanDurations.append((etime-stime).total_seconds())
-            self._scanDurationsUpdated = True
-        except:
-            pass
+class QUAKESRRealtimeDisplay:
+    def __init__(
+        self,
+        connectionData,
 
-    def _msghandler_beamcurrentestimate(self, message):
-        try:
-            self._ebeamCurrentEst.append(float(message.payload['current']))
-            self._ebeamUpdated = True
-        except:
-            pass
+        plotsize = (320, 240),
+        blit = True,
+        maxFrameRate = 20.0,
+        frameBudget = None,
+        subscribeAll = False,
+        jsonDecoder = None,
+        historyLength = 10000,
+        peakHistoryLength = 500,
+        recordTo = None,
+        statsInterval = None,
+        profileTo = None,
+        startedAt = None,
+        archiveTo = None,
+        resonanceFit = False,
+        averageMode = 'cumulative',
+        averagePeaks = 20,
+        gridTolerance = None,
+        asyncIngestion = False,
+        queueSize = 256,
+        mqtt5 = False
+    ):
+        # The base topic may be a single topic or a list of base topics of
+        # several experiments
+        self._condata = connectionData
+        if isinstance(self._condata['basetopic'], str):
+            self._condata['basetopic'] = [ self._condata['basetopic'] ]
+        self._condata['basetopic'] = [ topic if topic[-1] == '/' else topic + "/" for topic in self._condata['basetopic'] ]
 
-    def _msghandler_beamcurrentmeasurement(self, message):
-        try:
-            self._ebeamCurrentMeas.append(float(message.payload['current']))
-            self._ebeamUpdated = True
-        except:
-            pass
-
-    def _msghandler_received_scaniteration(self, message):
-        self._pointdataClear = True
-        if not message.payload['diffscan']:
-            self._window.write_event_value('update_progress', (message.payload['i'] / message.payload['n']) * 100.0)
-        else:
-            if message.payload['zero']:
-                self._window.write_event_value('update_progresszero', (message.payload['i'] / message.payload['n']) * 100.0)
-            else:
-                self._window.write_event_value('update_progress', (message.payload['i'] / message.payload['n']) * 100.0)
-
-    def _msghandler_received_pointdata(self, message):
-        if self._pointdataClear:
-            self._lastPointData = {
-                'I' : [],
-                'i' : [],
-                'q' : [],
-                'changed' : True
-            }
-            self._pointdataClear = False
-
-        self._lastPointData['I'].append(message.payload['I'])
-        self._lastPointData['i'].append(message.payload['i'])
-        self._lastPointData['q'].append(message.payload['q'])
-        self._lastPointData['changed'] = True
-
-    def _msghandler_received_peakdata(self, message):
-        currents = []
-        qAvg = []
-        iAvg = []
-        qErr = None
-        iErr = None
-        n = 0
-
-        for ptCurrent in message.payload['payload']:
-            currents.append(ptCurrent[0])
-
-            # Average q's and average i's
-            n = int((len(ptCurrent)-1) / 2)
-            qSum = 0
-            iSum = 0
-            for ptIteration in range(n):
-                iSum = iSum + ptCurrent[1 + ptIteration] / float(n)
-                qSum = qSum + ptCurrent[1 + n + ptIteration] / float(n)
-            qAvg.append(qSum)
-            iAvg.append(iSum)
-
-            # Error bars ...
-            qE = 0
-            iE = 0
-            if n > 1:
-                if qErr is None:
-                    qErr = []
-                    iErr = []
-
-                for ptIteration in range(n):
-                    iE = iE + (ptCurrent[1 + ptIteration] - iSum)*(ptCurrent[1 + ptIteration] - iSum) / float(n)
-                    qE = qE + (ptCurrent[1 + ptIteration + n] - qSum)*(ptCurrent[1 + ptIteration + n] - qSum) / float(n)
-                iE = math.sqrt(iE)
-                qE = math.sqrt(qE)
-                iErr.append(iE)
-                qErr.append(qE)
-
-        # Update local cache ...
-        self._lastPeakData['I'] = currents
-        self._lastPeakData['n'] = n
-        self._lastPeakData['sig'] = { 'i' : iAvg, 'q' : qAvg }
-        self._lastPeakData['err'] = { 'i' : iErr, 'q' : qErr }
-        self._lastPeakData['changed'] = True
-
-        # Update running average if required
-        self._runningAverageUpdate(message, False)
-
-
-    def _runningAverageInit(self):
-        self._averagedPeakData = {
-            'I' : None,
-            'sig' : None,
-            'err' : None,
-            'sigZero' : None,
-            'errZero' : None,
-            'sigDiff' : None,
-            'errDiff' : None,
-            'n' : None,
-            'changed' : True,
-
-            'enabled' : True
-        }
+        self._plotsize = plotsize
+        self._blit = blit
+        self._maxFrameRate = maxFrameRate
+        self._frameBudget = frameBudget
+        self._window = None
+        self._visibleTab = None
+        self._historyPosition = None
+        self._historyShown = None
+        self._historyMissing = False
+        self._figures = {}
+        self._dataChangedPending = False
+
+        # Runtime statistics (shown in the diagnostics tab and optionally
+        # published every statsInterval seconds) and optional profiling
+        self._diagnostics = Diagnostics(startedAt = startedAt)
+        self._statsInterval = statsInterval
+        self._profileTo = profileTo
+        self._profiles = []
+
+        # Optional recording of all routed messages
+        self._recorder = MessageLogWriter(recordTo) if recordTo is not None else None
+        self._statusstring = "Not connected"
+        self._jsonDecoder = jsonDecoder if jsonDecoder is not None else defaultJSONDecoder()
+        self._mqttHandlers = MQTTPatternMatcher()
+        self._mqttHandlers.onFiltersChanged = self._syncSubscriptions
+
+        # Subscriptions are derived from the registered handler filters. The
+        # wildcard subscription of the whole base topic has to be requested
+        # explicitly. MQTT v5 is only used on request (content types)
+        self.mqtt = None
+        self._subscribeAll = subscribeAll
+        self._mqtt5 = mqtt5
+        self._subscriptionLock = threading.Lock()
+        self._subscriptions = set()
+        self._mqttConnected = False
+
+        # Optionally messages are received by an asyncio event loop and
+        # decoded and handled by a pipeline with a bounded queue (instead of
+        # being handled on paho's network thread). Messages waiting for the
+        # handlers are coalesced by the policies of the experiments
+        self._asyncIngestion = asyncIngestion
+        self._queueSize = queueSize
+        self._ingestion = None
 
-        self._runningAverageData = {
-            'I' : None,
-            'sigAverages' : {
-                'i' : None,
-                'q' : None
-            },
-            'sigM2' : {
-                'i' : None,
-                'q' : None
-            },
-            'zeroAverages' : {
-                'i' : None,
-                'q' : None
-            },
-            'zeroM2' : {
-                'i' : None,
-                'q' : None
-            },
-            'ntotal' : 0,
-            'ntotalZero' : 0
-        }
+        self._showDiffInSigma = False
 
-    def _runningAverageUpdate(self, message, isZero = False):
-        if not self._averagedPeakData['enabled']:
+        # One experiment state per base topic, all fed by the same dispatcher.
+        # Handlers are called while holding _stateLock. The figures show the
+        # selected experiment. Experiments are optionally archived into one
+        # subdirectory each. All experiments share one resonance fitter (its
+        # results are published while holding _stateLock as well, possibly
+        # from within a handler - so the lock is reentrant)
+        self._stateLock = threading.RLock()
+        self._fitter = ResonanceFitter() if resonanceFit else None
+        self._experiments = [
+            Experiment(
+                basetopic,
+                self._mqttHandlers,
+                self._stateLock,
+                historyLength = historyLength,
+                peakHistoryLength = peakHistoryLength,
+                archive = ArchiveWriter(os.path.join(archiveTo, basetopic.strip("/").replace("/", "_"))) if archiveTo is not None else None,
+                fitter = self._fitter,
+                averageMode = averageMode,
+                averagePeaks = averagePeaks,
+                gridTolerance = gridTolerance
+            )
+            for basetopic in self._condata['basetopic']
+        ]
+        for experiment in self._experiments:
+            experiment.onChanged = self._notifyDataChanged
+        self._experiment = self._experiments[0]
+        self._drawn = SnapshotConsumer()
+
+    def _postEvent(self, key, value):
+        if self._window is not None:
+            self._window.write_event_value(key, value)
+
+    def _notifyDataChanged(self):
+        # Wakes the GUI loop - only one notification is queued at a time,
+        # the GUI thread re-arms this after it picked up the event
+        if (self._window is None) or self._dataChangedPending:
             return
+        self._dataChangedPending = True
+        self._postEvent("sigDataChanged", None)
 
-        if not isZero:
-            nNew = int((len(message.payload['payload'][0])-1) / 2)
-            updateCurrentValues = False
-            for ptIteration in range(nNew):
-                for ptCurrent in range(len(message.payload['payload'])):
-                    curCurrent = message.payload['payload'][ptCurrent][0]
-                    curISamp = message.payload['payload'][ptCurrent][1 + ptIteration]
-                    curQSamp = message.payload['payload'][ptCurrent][1 + nNew + ptIteration]
-
-                    if self._runningAverageData['ntotal'] == 0:
-                        if self._runningAverageData['I'] is None:
-                            self._runningAverageData['I'] = [ ]
-                            updateCurrentValues = True
-                        if updateCurrentValues:
-                            self._runningAverageData['I'].append(curCurrent)
-                        if self._runningAverageData['sigAverages']['i'] is None:
-                            self._runningAverageData['sigAverages']['i'] = []
-                            self._runningAverageData['sigAverages']['q'] = []
-                            self._runningAverageData['sigM2']['i'] = []
-                            self._runningAverageData['sigM2']['q'] = []
-                        #self._runningAverageData['I'].append(curCurrent)
-                        self._runningAverageData['sigAverages']['i'].append(curISamp)
-                        self._runningAverageData['sigAverages']['q'].append(curQSamp)
-                        self._runningAverageData['sigM2']['i'].append(0.0)
-                        self._runningAverageData['sigM2']['q'].append(0.0)
-                    else:
-                        # Update running average & moments
-                        oldAvgI = self._runningAverageData['sigAverages']['i'][ptCurrent]
-                        oldAvgQ = self._runningAverageData['sigAverages']['q'][ptCurrent]
-                        newAvgI = oldAvgI * (self._runningAverageData['ntotal'] / (self._runningAverageData['ntotal'] + 1)) + 1.0 / (self._runningAverageData['ntotal'] + 1) * curISamp
-                        newAvgQ = oldAvgQ * (self._runningAverageData['ntotal'] / (self._runningAverageData['ntotal'] + 1)) + 1.0 / (self._runningAverageData['ntotal'] + 1) * curQSamp
-                        self._runningAverageData['sigAverages']['i'][ptCurrent] = newAvgI
-                        self._runningAverageData['sigAverages']['q'][ptCurrent] = newAvgQ
-                        self._runningAverageData['sigM2']['i'][ptCurrent] = self._runningAverageData['sigM2']['i'][ptCurrent] + (curISamp - oldAvgI)*(curISamp - newAvgI)
-                        self._runningAverageData['sigM2']['q'][ptCurrent] = self._runningAverageData['sigM2']['q'][ptCurrent] + (curQSamp - oldAvgQ)*(curQSamp - newAvgQ)
-                self._runningAverageData['ntotal'] = self._runningAverageData['ntotal'] + 1
-
-                self._averagedPeakData['I'] = self._runningAverageData['I']
-                self._averagedPeakData['sig'] = self._runningAverageData['sigAverages']
-
-                newError = { 'i' : [], 'q' : [] }
-                for i in range(len(self._runningAverageData['sigM2']['i'])):
-                    newError['i'].append(math.sqrt(self._runningAverageData['sigM2']['i'][i] / self._runningAverageData['ntotal']))
-                    newError['q'].append(math.sqrt(self._runningAverageData['sigM2']['q'][i] / self._runningAverageData['ntotal']))
-                self._averagedPeakData['err'] = newError
-                self._averagedPeakData['changed'] = True
-        else:
-            nNew = int((len(message.payload['payload'][0])-1) / 2)
-            updateCurrentValues = False
-            for ptIteration in range(nNew):
-                for ptCurrent in range(len(message.payload['payload'])):
-                    curCurrent = message.payload['payload'][ptCurrent][0]
-                    curISamp = message.payload['payload'][ptCurrent][1 + ptIteration]
-                    curQSamp = message.payload['payload'][ptCurrent][1 + nNew + ptIteration]
-
-                    if self._runningAverageData['ntotalZero'] == 0:
-                        if self._runningAverageData['I'] is None:
-                            self._runningAverageData['I'] = []
-                            updateCurrentValues = True
-                        if updateCurrentValues:
-                            self._runningAverageData['I'].append(curCurrent)
-                        if self._runningAverageData['zeroAverages']['i'] is None:
-                            self._runningAverageData['zeroAverages']['i'] = []
-                            self._runningAverageData['zeroAverages']['q'] = []
-                            self._runningAverageData['zeroM2']['i'] = []
-                            self._runningAverageData['zeroM2']['q'] = []
-                        self._runningAverageData['zeroAverages']['i'].append(curISamp)
-                        self._runningAverageData['zeroAverages']['q'].append(curQSamp)
-                        self._runningAverageData['zeroM2']['i'].append(0.0)
-                        self._runningAverageData['zeroM2']['q'].append(0.0)
-                    else:
-                        # Update running average & moments
-                        oldAvgI = self._runningAverageData['zeroAverages']['i'][ptCurrent]
-                        oldAvgQ = self._runningAverageData['zeroAverages']['q'][ptCurrent]
-                        newAvgI = self._runningAverageData['zeroAverages']['i'][ptCurrent] * (self._runningAverageData['ntotalZero'] / (self._runningAverageData['ntotalZero'] + 1)) + 1.0 / (self._runningAverageData['ntotalZero'] + 1) * curISamp
-                        newAvgQ = self._runningAverageData['zeroAverages']['q'][ptCurrent] * (self._runningAverageData['ntotalZero'] / (self._runningAverageData['ntotalZero'] + 1)) + 1.0 / (self._runningAverageData['ntotalZero'] + 1) * curQSamp
-                        self._runningAverageData['zeroAverages']['i'][ptCurrent] = newAvgI
-                        self._runningAverageData['zeroAverages']['q'][ptCurrent] = newAvgQ
-                        self._runningAverageData['zeroM2']['i'][ptCurrent] = self._runningAverageData['zeroM2']['i'][ptCurrent] + (curISamp - oldAvgI)*(curISamp - newAvgI)
-                        self._runningAverageData['zeroM2']['q'][ptCurrent] = self._runningAverageData['zeroM2']['q'][ptCurrent] + (curQSamp - oldAvgQ)*(curQSamp - newAvgQ)
-                self._runningAverageData['ntotalZero'] = self._runningAverageData['ntotalZero'] + 1
-
-                self._averagedPeakData['I'] = self._runningAverageData['I']
-                self._averagedPeakData['sigZero'] = self._runningAverageData['zeroAverages']
-
-                newError = { 'i' : [], 'q' : [] }
-                for i in range(len(self._runningAverageData['zeroM2']['i'])):
-                    newError['i'].append(math.sqrt(self._runningAverageData['zeroM2']['i'][i] / self._runningAverageData['ntotalZero']))
-                    newError['q'].append(math.sqrt(self._runningAverageData['zeroM2']['q'][i] / self._runningAverageData['ntotalZero']))
-                self._averagedPeakData['errZero'] = newError
-                self._averagedPeakData['changed'] = True
-
-        # ToDo: Differences
-        iDiff = None
-        qDiff = None
-        iDiffErr = None
-        qDiffErr = None
-        if self._averagedPeakData['sig'] and self._averagedPeakData['sig']['i'] and self._averagedPeakData['sigZero'] and self._averagedPeakData['sigZero']['i']:
-            if (len(self._averagedPeakData['sig']['i']) == len(self._averagedPeakData['sigZero']['i'])) and (len(self._lastPeakData['sig']['q']) == len(self._averagedPeakData['sigZero']['q'])):
-                iDiff = []
-                qDiff = []
-                iDiffErr = None
-                qDiffErr = None
-
-                for i in range(len(self._averagedPeakData['sig']['i'])):
-                    iDiff.append(self._averagedPeakData['sig']['i'][i] - self._averagedPeakData['sigZero']['i'][i])
-                    qDiff.append(self._averagedPeakData['sig']['q'][i] - self._averagedPeakData['sigZero']['q'][i])
-
-                    if (not (self._averagedPeakData['err'] is None)) and (not (self._averagedPeakData['err']['i'] is None)) and (not (self._averagedPeakData['errZero'] is None)) and (not (self._averagedPeakData['errZero']['i'] is None)):
-                        if iDiffErr is None:
-                            iDiffErr = []
-                            qDiffErr = []
-                        iDiffErr.append(math.sqrt(self._averagedPeakData['errZero']['i'][i]*self._averagedPeakData['errZero']['i'][i] + self._averagedPeakData['err']['i'][i]*self._averagedPeakData['err']['i'][i]))
-                        qDiffErr.append(math.sqrt(self._averagedPeakData['errZero']['q'][i]*self._averagedPeakData['errZero']['q'][i] + self._averagedPeakData['err']['q'][i]*self._averagedPeakData['err']['q'][i]))
-
-        self._averagedPeakData['sigDiff'] = { 'i' : iDiff, 'q' : qDiff }
-        self._averagedPeakData['errDiff'] = { 'i' : iDiffErr, 'q' : qDiffErr }
-        self._averagedPeakData['changed'] = True
-
-
-    def _msghandler_resetandenableaverage(self, message):
-        self._runningAverageInit()
-        self._averagedPeakData['enabled'] = True
-        # self._window['chkRunAverage'].Update(True)
-        self._window.write_event_value("sigEnableAverage", "*")
-    def _msghandler_stoprunningaverage(self, message):
-        self._averagedPeakData['enabled'] = False
-        #self._window['chkRunAverage'].Update(False)
-        self._window.write_event_value("sigDisableAverage", "*")
-
-    def _msghandler_received_zeropeakdata(self, message):
-        currents = []
-        qAvg = []
-        iAvg = []
-        qErr = None
-        iErr = None
-        n = 0
-
-        for ptCurrent in message.payload['payload']:
-            currents.append(ptCurrent[0])
-
-            # Average q's and average i's
-            n = int((len(ptCurrent)-1) / 2)
-            qSum = 0
-            iSum = 0
-            for ptIteration in range(n):
-                iSum = iSum + ptCurrent[1 + ptIteration] / float(n)
-                qSum = qSum + ptCurrent[1 + n + ptIteration] / float(n)
-            qAvg.append(qSum)
-            iAvg.append(iSum)
-
-            # Error bars ...
-            qE = 0
-            iE = 0
-            if n > 1:
-                if qErr is None:
-                    qErr = []
-                    iErr = []
-
-                for ptIteration in range(n):
-                    iE = iE + (ptCurrent[1 + ptIteration] - iSum)*(ptCurrent[1 + ptIteration] - iSum) / float(n)
-                    qE = qE + (ptCurrent[1 + ptIteration + n] - qSum)*(ptCurrent[1 + ptIteration + n] - qSum) / float(n)
-                iE = math.sqrt(iE)
-                qE = math.sqrt(qE)
-                iErr.append(iE)
-                qErr.append(qE)
-
-        # Calculate difference if possible
-        if self._lastPeakData['sig']:
-            if (len(self._lastPeakData['sig']['i']) == len(iAvg)) and (len(self._lastPeakData['sig']['q']) == len(qAvg)):
-                iDiff = []
-                qDiff = []
-                iDiffErr = None
-                qDiffErr = None
-
-                for i in range(len(iAvg)):
-                    iDiff.append(self._lastPeakData['sig']['i'][i] - iAvg[i])
-                    qDiff.append(self._lastPeakData['sig']['q'][i] - qAvg[i])
-
-                    if (n > 1) and (not (self._lastPeakData['err'] is None)):
-                        if iDiffErr is None:
-                            iDiffErr = []
-                            qDiffErr = []
-                        iDiffErr.append(math.sqrt(iErr[i]*iErr[i] + self._lastPeakData['err']['i'][i]*self._lastPeakData['err']['i'][i]))
-                        qDiffErr.append(math.sqrt(qErr[i]*qErr[i] + self._lastPeakData['err']['q'][i]*self._lastPeakData['err']['q'][i]))
-        else:
-            iDiff = None
-            qDiff = None
-            iDiffErr = None
-            qDiffErr = None
+    def experiments(self):
+        return self._experiments
 
-        # Update local cache ...
-        self._lastPeakData['I'] = currents
-        self._lastPeakData['n'] = n
-        self._lastPeakData['sigZero'] = { 'i' : iAvg, 'q' : qAvg }
-        self._lastPeakData['errZero'] = { 'i' : iErr, 'q' : qErr }
-        self._lastPeakData['sigDiff'] = { 'i' : iDiff, 'q' : qDiff }
-        self._lastPeakData['errDiff'] = { 'i' : iDiffErr, 'q' : qDiffErr }
-        self._lastPeakData['changed'] = True
+    def selectedExperiment(self):
+        return self._experiment
 
-        # Update running average if required
+    def selectExperiment(self, index):
+        # All figures show the new experiment on their next redraw
+        self._experiment = self._experiments[index]
+        self._historyPosition = None
+        self._historyShown = None
+        self._historyMissing = False
+        self._drawn.invalidate()
 
-        self._runningAverageUpdate(message, True)
+    # Browsing the history of the last peak. While a historic peak is shown
+    # the last peak figures don't follow new data
 
-    def _mqtt_on_connect(self, client, userdata, flags, rc):
+    def browsePeakHistory(self, step):
+        first, end = self._experiment.history.range()
+        if end <= first:
+            return
+        position = end - 1 if self._historyPosition is None else self._historyPosition
+        self._historyPosition = min(max(position + step, first), end - 1)
+
+    def showLivePeak(self):
+        if self._historyPosition is not None:
+            self._historyPosition = None
+            self._historyShown = None
+            self._historyMissing = False
+            self._drawn.invalidate('peak')
+
+    def _historyStatus(self):
+        first, end = self._experiment.history.range()
+        if self._historyPosition is None:
+            return "Live ({} peaks)".format(end - first)
+        if self._historyMissing:
+            return "Peak {} of {} not available".format(self._historyPosition - first + 1, end - first)
+        return "Peak {} of {}".format(self._historyPosition - first + 1, end - first)
+
+    def _wantedSubscriptions(self):
+        if self._subscribeAll:
+            return { basetopic + "#" for basetopic in self._condata['basetopic'] }
+        return self._mqttHandlers.filters()
+
+    def _syncSubscriptions(self):
+        with self._subscriptionLock:
+            if (self.mqtt is None) or (not self._mqttConnected):
+                return
+
+            wanted = self._wantedSubscriptions()
+            added = sorted(wanted - self._subscriptions)
+            removed = sorted(self._subscriptions - wanted)
+
+            if len(added) > 0:
+                self.mqtt.subscribe([ (topic, 0) for topic in added ])
+            if len(removed) > 0:
+                self.mqtt.unsubscribe(removed)
+            self._subscriptions = wanted
+
+    def _mqtt_on_connect(self, client, userdata, flags, rc, properties = None):
         if rc == 0:
             self._statusstring = "Connected to {}:{} as {}".format(self._condata['broker'], self._condata['port'], self._condata['user'])
 
-            #Subscribe all messages in our basetopic
-            client.subscribe(self._condata['basetopic']+"#")
+            # Subscribe all topics we have handlers for (again after reconnects)
+            with self._subscriptionLock:
+                self._mqttConnected = True
+                self._subscriptions = set()
+            self._syncSubscriptions()
         else:
             self._statusstring = "Failed connecting to {}:{} as {}, retrying".format(self._condata['broker'], self._condata['port'], self._condata['user'])
-        pass
-    def _mqtt_on_message(self, client, userdata, msg):
-        logging.debug("[MQTT IN] {}: {}".format(msg.topic, msg.payload))
-        try:
-            msg.payload = json.loads(str(msg.payload.decode('utf-8', 'ignore')))
-        except:
-            # Ignore if we don't have a JSON payload
-            pass
-        self._mqttHandlers.callHandlers(msg.topic, msg)
-
-    def __init_figure(self, canvasName, xlabel, ylabel, title, grid=True):
-        figTemp = Figure()
-        fig = Figure(figsize = (self._plotsize[0] / figTemp.get_dpi(), self._plotsize[1] / figTemp.get_dpi()))
-
-        ax = fig.add_subplot(111)
-        ax.set_xlabel(xlabel)
-        ax.set_ylabel(ylabel)
-        ax.set_title(title)
-
-        if grid:
-            ax.grid()
-        fig_agg = FigureCanvasTkAgg(fig, self._window[canvasName].TKCanvas)
-        fig_agg.draw()
-        fig_agg.get_tk_widget().pack(side='top', fill='both', expand=1)
-
-        return {
-            'figure' : fig,
-            'axis' : ax,
-            'fig_agg' : fig_agg,
-            'xlabel' : xlabel,
-            'ylabel' : ylabel,
-            'title' : title
-        }
-
-    def redrawAveragedData(self):
-        data = self._averagedPeakData
-        if not data['changed']:
-            return
-
-        self._averagedPeakData['changed'] = False
+        self._notifyDataChanged()
 
-        self._figures['sigAvg']['axis'].cla()
-        self._figures['sigAvg']['axis'].grid()
+    def _mqtt_on_disconnect(self, client, userdata, rc, properties = None):
+        with self._subscriptionLock:
+            self._mqttConnected = False
+        self._statusstring = "Disconnected from {}:{}, reconnecting".format(self._condata['broker'], self._condata['port'])
+        self._notifyDataChanged()
 
-        if not(data['sig'] is None) and not(data['sig']['i'] is None):
-            if not(data['err'] is None) and not(data['err']['i'] is None):
-                # Plot with error bars ...
-                self._figures['sigAvg']['axis'].errorbar(data['I'], data['sig']['i'], yerr = data['err']['i'], label = "I")
-                self._figures['sigAvg']['axis'].errorbar(data['I'], data['sig']['q'], yerr = data['err']['q'], label = "Q")
-                self._figures['sigAvg']['axis'].legend()
+    def _mqtt_on_message(self, client, userdata, msg):
+        self._dispatchMessage(msg, decode = True, record = True)
+
+    def feedMessage(self, topic, payload):
+        # Injects a message that has not been received via MQTT (recorded
+        # streams, simulation). Raw payloads are decoded like MQTT payloads,
+        # already decoded ones are passed to the handlers as they are
+        self._dispatchMessage(simulatedMessage(topic, payload), decode = isinstance(payload, (bytes, bytearray, str)))
+
+    def _dispatchMessage(self, msg, decode = True, record = False):
+        prepared = self._prepareMessage(msg, decode = decode, record = record)
+        if prepared is not None:
+            self._handleMessage(prepared)
+
+    def _prepareMessage(self, msg, decode = True, record = False, receivedAt = None):
+        # Routing, recording and decoding of a message. Returns the message
+        # with its handlers or None if nobody handles it
+        if receivedAt is None:
+            receivedAt = time.monotonic()
+        self._diagnostics.messageReceived(msg.topic, len(msg.payload) if isinstance(msg.payload, (bytes, bytearray, str)) else 0, receivedAt)
+
+        # Route first - payloads on topics nobody handles are never decoded
+        handlers = self._mqttHandlers.matchHandlers(msg.topic)
+        if len(handlers) == 0:
+            return None
+
+        if record and (self._recorder is not None):
+            self._recorder.write(msg.topic, msg.payload)
+
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("[MQTT IN] {}: {}".format(msg.topic, msg.payload))
+        if decode:
+            tStart = time.perf_counter()
+            if isPackedMatrix(msg):
+                try:
+                    msg.payload = decodeMatrix(msg.payload)
+                except ValueError as e:
+                    logging.warning("Ignoring invalid packed matrix on {}: {}".format(msg.topic, e))
+                    return None
             else:
-                self._figures['sigAvg']['axis'].plot(data['I'], data['sig']['i'], label = "I")
-                self._figures['sigAvg']['axis'].plot(data['I'], data['sig']['q'], label = "Q")
-                self._figures['sigAvg']['axis'].legend()
-
-        self._figures['sigAvg']['axis'].set_xlabel(self._figures['sigAvg']['xlabel'])
-        self._figures['sigAvg']['axis'].set_ylabel(self._figures['sigAvg']['ylabel'])
-        self._figures['sigAvg']['axis'].set_title(self._figures['sigAvg']['title'])
-        self._figures['sigAvg']['fig_agg'].draw()
-
-        # Error plot (signal)
-
-        self._figures['errAvg']['axis'].cla()
-        self._figures['errAvg']['axis'].grid()
-
-        if not(data['err'] is None) and not(data['err']['i'] is None):
-            self._figures['errAvg']['axis'].plot(data['I'], data['err']['i'], label="I")
-            self._figures['errAvg']['axis'].plot(data['I'], data['err']['q'], label="Q")
-            self._figures['errAvg']['axis'].legend()
-
-        self._figures['errAvg']['axis'].set_xlabel(self._figures['errAvg']['xlabel'])
-        self._figures['errAvg']['axis'].set_ylabel(self._figures['errAvg']['ylabel'])
-        self._figures['errAvg']['axis'].set_title(self._figures['errAvg']['title'])
-        self._figures['errAvg']['fig_agg'].draw()
+                try:
+                    msg.payload = self._jsonDecoder(msg.payload)
+                except:
+                    # Ignore if we don't have a JSON payload
+                    pass
+            self._diagnostics.decoded(time.perf_counter() - tStart)
+        return (msg, handlers, receivedAt)
+
+    def _prepareReceived(self, msg, receivedAt):
+        return self._prepareMessage(msg, decode = True, record = True, receivedAt = receivedAt)
+
+    def _mergeBatch(self, items):
+        # Prepared messages of one topic coalesced by the ingestion mailbox
+        # are handled as one message with the list of payloads
+        messages = [ msg for msg, _, _ in items ]
+        return (simulatedMessage(messages[0].topic, [ msg.payload for msg in messages ]), items[0][1], min(receivedAt for _, _, receivedAt in items))
+
+    def _handleMessage(self, prepared):
+        msg, handlers, receivedAt = prepared
+        with self._stateLock:
+            for handler in handlers:
+                tStart = time.perf_counter()
+                handler(msg)
+                self._diagnostics.handlerTime(handler.__name__, time.perf_counter() - tStart)
+        self._diagnostics.messageHandled(receivedAt)
+        self._notifyDataChanged()
+
+    def __init_figure(self, canvasName, xlabel, ylabel, title, grid=True, viewMargin=0.05):
+        # matplotlib is only imported once the first figure is shown. Without
+        # window (headless rendering) figures are drawn by a plain Agg canvas
+        import matplotlib
+        from matplotlib.figure import Figure
+
+        dpi = matplotlib.rcParams['figure.dpi']
+        fig = Figure(figsize = (self._plotsize[0] / dpi, self._plotsize[1] / dpi), dpi = dpi)
 
-        self._figures['sigZeroAvg']['axis'].cla()
-        self._figures['sigZeroAvg']['axis'].grid()
+        ax = fig.add_subplot(111)
+        if self._window is not None:
+            from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+            fig_agg = FigureCanvasTkAgg(fig, self._window[canvasName].TKCanvas)
+        else:
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            fig_agg = FigureCanvasAgg(fig)
+        plot = LivePlot(fig, ax, fig_agg, xlabel, ylabel, title, grid = grid, blit = self._blit and (self._window is not None), viewMargin = viewMargin)
+        fig_agg.draw()
+        if self._window is not None:
+            fig_agg.get_tk_widget().pack(side='top', fill='both', expand=1)
 
-        if not (data['sigZero'] is None):
-            if not (data['errZero'] is None) and not (data['errZero']['i'] is None):
-                self._figures['sigZeroAvg']['axis'].errorbar(data['I'], data['sigZero']['i'], yerr = data['errZero']['i'], label = "I")
-                self._figures['sigZeroAvg']['axis'].errorbar(data['I'], data['sigZero']['q'], yerr = data['errZero']['q'], label = "Q")
-                self._figures['sigZeroAvg']['axis'].legend()
-            else:
-                self._figures['sigZeroAvg']['axis'].plot(data['I'], data['sigZero']['i'], label = "I")
-                self._figures['sigZeroAvg']['axis'].plot(data['I'], data['sigZero']['q'], label = "Q")
-                self._figures['sigZeroAvg']['axis'].legend()
+        return plot
 
-        self._figures['sigZeroAvg']['axis'].set_xlabel(self._figures['sigZeroAvg']['xlabel'])
-        self._figures['sigZeroAvg']['axis'].set_ylabel(self._figures['sigZeroAvg']['ylabel'])
-        self._figures['sigZeroAvg']['axis'].set_title(self._figures['sigZeroAvg']['title'])
-        self._figures['sigZeroAvg']['fig_agg'].draw()
+    def createFigures(self, tab = None):
+        # Creates the figures of the given tab (or all) that don't exist yet
+        for figName, figTab, canvasName, xlabel, ylabel, title, options in FIGURES:
+            if ((tab is not None) and (figTab != tab)) or (figName in self._figures):
+                continue
+            self._figures[figName] = self.__init_figure(canvasName, xlabel, ylabel, title, **options)
+            self._figures[figName].onDrawn = lambda seconds, fullDraw, figName = figName: self._diagnostics.drawTime(figName, seconds, fullDraw)
+        return self._figures
 
-        # Error plot
-        self._figures['errZeroAvg']['axis'].cla()
-        self._figures['errZeroAvg']['axis'].grid()
+    def _needsRedraw(self, name):
+        # Without window (headless) all figures count as visible
+        if (self._visibleTab is not None) and (SNAPSHOT_TABS[name] != self._visibleTab):
+            return False
+        if (name == 'peak') and (self._historyPosition is not None):
+            return self._historyPosition != self._historyShown
+        return self._drawn.changed(name, self._experiment.snapshots[name])
+
+    def redrawAll(self):
+        self.redrawPeakData()
+        self.redrawAveragedData()
+        self.redrawScanDurations()
+        self.redrawBeamCurrent()
+        self.redrawPointData()
+        self.redrawFitDrift()
+
+    def _signalCurves(self, sig, err):
+        if (sig is None) or (sig['i'] is None):
+            return []
+        if (err is not None) and (err['i'] is not None):
+            return [ ("I", sig['i'], err['i']), ("Q", sig['q'], err['q']) ]
+        return [ ("I", sig['i'], None), ("Q", sig['q'], None) ]
+
+    def _fitCurves(self, I, fit):
+        # Fitted resonance evaluated on the grid of the peak
+        if (fit is None) or (I is None):
+            return []
+        i, q = resonanceModel(I, [ fit['params'][name] for name in PARAMETERS ])
+        return [ ("Fit I", i, None), ("Fit Q", q, None) ]
+
+    def _fitStatus(self):
+        # Parameters of the last peak and average fit of the selected experiment
+        lines = []
+        for label, name in (("Last peak", 'peak'), ("Average", 'average')):
+            _, data = self._experiment.snapshots[name].latest()
+            fit = data.get('fit') if data is not None else None
+            if fit is None:
+                lines.append("{}: {}".format(label, "fit failed" if data.get('fitFailed') else "no fit"))
+                continue
+            lines.append("{}: center {:.6g} +- {:.2g}, width {:.4g} +- {:.2g}, amplitude {:.4g}, phase {:.3f} rad, chi2/dof {:.3g}".format(
+                label,
+                fit['params']['center'], fit['errors']['center'],
+                fit['params']['width'], fit['errors']['width'],
+                fit['params']['amplitude'], fit['params']['phase'],
+                fit['chi2']
+            ))
+        return "\n".join(lines)
+
+    def _errorCurves(self, err):
+        if (err is None) or (err['i'] is None):
+            return []
+        return [ ("I", err['i'], None), ("Q", err['q'], None) ]
+
+    def _differenceCurves(self, sigDiff, errDiff):
+        if not self._showDiffInSigma:
+            return self._signalCurves(sigDiff, errDiff)
+        if (sigDiff is None) or (sigDiff['i'] is None) or (errDiff is None) or (errDiff['i'] is None):
+            return []
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            return [
+                ("I", np.divide(sigDiff['i'], errDiff['i']), None),
+                ("Q", np.divide(sigDiff['q'], errDiff['q']), None)
+            ]
 
-        if not (data['errZero'] is None) and not (data['errZero']['i'] is None):
-            self._figures['errZeroAvg']['axis'].plot(data['I'], data['errZero']['i'], label="I")
-            self._figures['errZeroAvg']['axis'].plot(data['I'], data['errZero']['q'], label="Q")
-            self._figures['errZeroAvg']['axis'].legend()
+    def redrawAveragedData(self):
+        data = self._drawn.consume('average', self._experiment.snapshots['average'])
+        if data is None:
+            return
 
-        self._figures['errZeroAvg']['axis'].set_xlabel(self._figures['errZeroAvg']['xlabel'])
-        self._figures['errZeroAvg']['axis'].set_ylabel(self._figures['errZeroAvg']['ylabel'])
-        self._figures['errZeroAvg']['axis'].set_title(self._figures['errZeroAvg']['title'])
-        self._figures['errZeroAvg']['fig_agg'].draw()
+        self._figures['sigAvg'].update(data['I'], self._signalCurves(data['sig'], data['err']) + self._fitCurves(data['I'], data.get('fit')))
+        self._figures['errAvg'].update(data['I'], self._errorCurves(data['err']))
 
-        self._figures['sigDiffAvg']['axis'].cla()
-        self._figures['sigDiffAvg']['axis'].grid()
+        self._figures['sigZeroAvg'].update(data['I'], self._signalCurves(data['sigZero'], data['errZero']))
+        self._figures['errZeroAvg'].update(data['I'], self._errorCurves(data['errZero']))
 
-        # if self._lastPeakData['n'] > 1:
-        if not (data['sigDiff'] is None) and not (data['sigDiff']['i'] is None):
-            if not self._showDiffInSigma:
-                if (not (self._averagedPeakData['errDiff'] is None)) and (not (self._averagedPeakData['errDiff']['i'] is None)):
-                    self._figures['sigDiffAvg']['axis'].errorbar(data['I'], data['sigDiff']['i'], yerr = data['errDiff']['i'], label = "I")
-                    self._figures['sigDiffAvg']['axis'].errorbar(data['I'], data['sigDiff']['q'], yerr = data['errDiff']['q'], label = "Q")
-                    self._figures['sigDiffAvg']['axis'].legend()
-                else:
-                    self._figures['sigDiffAvg']['axis'].plot(data['I'], data['sigDiff']['i'], label = "I")
-                    self._figures['sigDiffAvg']['axis'].plot(data['I'], data['sigDiff']['q'], label = "Q")
-                    self._figures['sigDiffAvg']['axis'].legend()
-            else:
-                if (not (self._averagedPeakData['errDiff'] is None)) and (not (self._averagedPeakData['errDiff']['i'] is None)):
-                    di = [a_i / b_i for a_i, b_i in zip(data['sigDiff']['i'], data['errDiff']['i'])]
-                    dq = [a_i / b_i for a_i, b_i in zip(data['sigDiff']['q'], data['errDiff']['q'])]
-                    self._figures['sigDiffAvg']['axis'].plot(data['I'], di, label = "I")
-                    self._figures['sigDiffAvg']['axis'].plot(data['I'], dq, label = "Q")
-                    self._figures['sigDiffAvg']['axis'].legend()
-
-        self._figures['sigDiffAvg']['axis'].set_xlabel(self._figures['sigDiffAvg']['xlabel'])
-        self._figures['sigDiffAvg']['axis'].set_ylabel(self._figures['sigDiffAvg']['ylabel'])
-        self._figures['sigDiffAvg']['axis'].set_title(self._figures['sigDiffAvg']['title'])
-        self._figures['sigDiffAvg']['fig_agg'].draw()
-
-        # Error plot
-        self._figures['errDiffAvg']['axis'].cla()
-        self._figures['errDiffAvg']['axis'].grid()
-
-        if (not (self._averagedPeakData['errDiff'] is None)) and (not (self._averagedPeakData['errDiff']['i'] is None)):
-            self._figures['errDiffAvg']['axis'].plot(data['I'], data['errDiff']['i'], label="I")
-            self._figures['errDiffAvg']['axis'].plot(data['I'], data['errDiff']['q'], label="Q")
-            self._figures['errDiffAvg']['axis'].legend()
-
-        self._figures['errDiffAvg']['axis'].set_xlabel(self._figures['errDiffAvg']['xlabel'])
-        self._figures['errDiffAvg']['axis'].set_ylabel(self._figures['errDiffAvg']['ylabel'])
-        self._figures['errDiffAvg']['axis'].set_title(self._figures['errDiffAvg']['title'])
-        self._figures['errDiffAvg']['fig_agg'].draw()
+        self._figures['sigDiffAvg'].update(data['I'], self._differenceCurves(data['sigDiff'], data['errDiff']))
+        self._figures['errDiffAvg'].update(data['I'], self._errorCurves(data['errDiff']))
 
     def redrawPointData(self):
-        data = self._lastPointData
-        if not data['changed']:
+        data = self._drawn.consume('pointData', self._experiment.snapshots['pointData'])
+        if data is None:
             return
 
-        self._lastPointData['changed'] = False
-
-        self._figures['pointCurScan']['axis'].cla()
-        self._figures['pointCurScan']['axis'].grid()
         if len(data['I']) > 0:
-            self._figures['pointCurScan']['axis'].plot(data['I'], data['i'], label = 'I')
-            self._figures['pointCurScan']['axis'].plot(data['I'], data['q'], label = 'Q')
-            self._figures['pointCurScan']['axis'].legend()
-
-        self._figures['pointCurScan']['axis'].set_xlabel(self._figures['pointCurScan']['xlabel'])
-        self._figures['pointCurScan']['axis'].set_ylabel(self._figures['pointCurScan']['ylabel'])
-        self._figures['pointCurScan']['axis'].set_title(self._figures['pointCurScan']['title'])
-        self._figures['pointCurScan']['fig_agg'].draw()
+            self._figures['pointCurScan'].update(
+                data['I'], [ ("I", data['i'], None), ("Q", data['q'], None) ],
+                appendKey = (self._experiment.name, data['iteration'])
+            )
+        else:
+            self._figures['pointCurScan'].clear()
 
     def redrawPeakData(self):
-        data = self._lastPeakData
-        if not data['changed']:
+        if self._historyPosition is not None:
+            data = self._experiment.history.get(self._historyPosition)
+            if data is None:
+                # Evicted without archive or not yet written to disk, the
+                # figures must not keep showing another peak
+                self._historyMissing = True
+                if self._experiment.history.archiveError is not None:
+                    self._statusstring = "Peak archive not available: {}".format(self._experiment.history.archiveError)
+                for figName in ('sig', 'err', 'sigZero', 'errZero', 'sigDiff', 'errDiff'):
+                    self._figures[figName].clear()
+            else:
+                self._historyMissing = False
+            self._historyShown = self._historyPosition
+        else:
+            data = self._drawn.consume('peak', self._experiment.snapshots['peak'])
+        if data is None:
             return
 
-        self._lastPeakData['changed'] = False
-
         if data['n'] is None:
             return
 
         if not (data['sig'] is None):
-            self._figures['sig']['axis'].cla()
-            self._figures['sig']['axis'].grid()
-
-            if self._lastPeakData['n'] > 1:
-                self._figures['sig']['axis'].errorbar(data['I'], data['sig']['i'], yerr = data['err']['i'], label = "I")
-                self._figures['sig']['axis'].errorbar(data['I'], data['sig']['q'], yerr = data['err']['q'], label = "Q")
-                self._figures['sig']['axis'].legend()
-            else:
-                self._figures['sig']['axis'].plot(data['I'], data['sig']['i'], label = "I")
-                self._figures['sig']['axis'].plot(data['I'], data['sig']['q'], label = "Q")
-                self._figures['sig']['axis'].legend()
-
-            self._figures['sig']['axis'].set_xlabel(self._figures['sig']['xlabel'])
-            self._figures['sig']['axis'].set_ylabel(self._figures['sig']['ylabel'])
-            self._figures['sig']['axis'].set_title(self._figures['sig']['title'])
-            self._figures['sig']['fig_agg'].draw()
-
-            # Error plot
-            self._figures['err']['axis'].cla()
-            self._figures['err']['axis'].grid()
-
-            if data['n'] > 1:
-                self._figures['err']['axis'].plot(data['I'], data['err']['i'], label="I")
-                self._figures['err']['axis'].plot(data['I'], data['err']['q'], label="Q")
-                self._figures['err']['axis'].legend()
-
-            self._figures['err']['axis'].set_xlabel(self._figures['err']['xlabel'])
-            self._figures['err']['axis'].set_ylabel(self._figures['err']['ylabel'])
-            self._figures['err']['axis'].set_title(self._figures['err']['title'])
-            self._figures['err']['fig_agg'].draw()
+            self._figures['sig'].update(data['I'], self._signalCurves(data['sig'], data['err']) + self._fitCurves(data['I'], data.get('fit')))
+            self._figures['err'].update(data['I'], self._errorCurves(data['err']))
 
         if not (data['sigZero'] is None):
-            self._figures['sigZero']['axis'].cla()
-            self._figures['sigZero']['axis'].grid()
-
-            if self._lastPeakData['n'] > 1:
-                self._figures['sigZero']['axis'].errorbar(data['I'], data['sigZero']['i'], yerr = data['errZero']['i'], label = "I")
-                self._figures['sigZero']['axis'].errorbar(data['I'], data['sigZero']['q'], yerr = data['errZero']['q'], label = "Q")
-                self._figures['sigZero']['axis'].legend()
-            else:
-                self._figures['sigZero']['axis'].plot(data['I'], data['sigZero']['i'], label = "I")
-                self._figures['sigZero']['axis'].plot(data['I'], data['sigZero']['q'], label = "Q")
-                self._figures['sigZero']['axis'].legend()
-
-            self._figures['sigZero']['axis'].set_xlabel(self._figures['sigZero']['xlabel'])
-            self._figures['sigZero']['axis'].set_ylabel(self._figures['sigZero']['ylabel'])
-            self._figures['sigZero']['axis'].set_title(self._figures['sigZero']['title'])
-            self._figures['sigZero']['fig_agg'].draw()
-
-            # Error plot
-            self._figures['errZero']['axis'].cla()
-            self._figures['errZero']['axis'].grid()
-
-            if data['n'] > 1:
-                self._figures['errZero']['axis'].plot(data['I'], data['errZero']['i'], label="I")
-                self._figures['errZero']['axis'].plot(data['I'], data['errZero']['q'], label="Q")
-                self._figures['errZero']['axis'].legend()
-
-            self._figures['errZero']['axis'].set_xlabel(self._figures['errZero']['xlabel'])
-            self._figures['errZero']['axis'].set_ylabel(self._figures['errZero']['ylabel'])
-            self._figures['errZero']['axis'].set_title(self._figures['errZero']['title'])
-            self._figures['errZero']['fig_agg'].draw()
+            self._figures['sigZero'].update(data['I'], self._signalCurves(data['sigZero'], data['errZero']))
+            self._figures['errZero'].update(data['I'], self._errorCurves(data['errZero']))
 
         if not (data['sigDiff'] is None) and not (data['sigDiff']['i'] is None):
-            self._figures['sigDiff']['axis'].cla()
-            self._figures['sigDiff']['axis'].grid()
-
-            # if self._lastPeakData['n'] > 1:
-            if not self._showDiffInSigma:
-                if (not (self._lastPeakData['errDiff'] is None)) and (not (self._lastPeakData['errDiff']['i'] is None)):
-                    self._figures['sigDiff']['axis'].errorbar(data['I'], data['sigDiff']['i'], yerr = data['errDiff']['i'], label = "I")
-                    self._figures['sigDiff']['axis'].errorbar(data['I'], data['sigDiff']['q'], yerr = data['errDiff']['q'], label = "Q")
-                    self._figures['sigDiff']['axis'].legend()
-                else:
-                    self._figures['sigDiff']['axis'].plot(data['I'], data['sigDiff']['i'], label = "I")
-                    self._figures['sigDiff']['axis'].plot(data['I'], data['sigDiff']['q'], label = "Q")
-                    self._figures['sigDiff']['axis'].legend()
-            else:
-                if (not (self._lastPeakData['errDiff'] is None)) and (not (self._lastPeakData['errDiff']['i'] is None)):
-                    di = [a_i / b_i for a_i, b_i in zip(data['sigDiff']['i'], data['errDiff']['i'])]
-                    dq = [a_i / b_i for a_i, b_i in zip(data['sigDiff']['q'], data['errDiff']['q'])]
-                    self._figures['sigDiff']['axis'].plot(data['I'], di, label = "I")
-                    self._figures['sigDiff']['axis'].plot(data['I'], dq, label = "Q")
-                    self._figures['sigDiff']['axis'].legend()
-
-            self._figures['sigDiff']['axis'].set_xlabel(self._figures['sigDiff']['xlabel'])
-            self._figures['sigDiff']['axis'].set_ylabel(self._figures['sigDiff']['ylabel'])
-            self._figures['sigDiff']['axis'].set_title(self._figures['sigDiff']['title'])
-            self._figures['sigDiff']['fig_agg'].draw()
-
-            # Error plot
-            self._figures['errDiff']['axis'].cla()
-            self._figures['errDiff']['axis'].grid()
-
-            if (not (self._lastPeakData['errDiff'] is None)) and (not (self._lastPeakData['errDiff']['i'] is None)):
-                self._figures['errDiff']['axis'].plot(data['I'], data['errDiff']['i'], label="I")
-                self._figures['errDiff']['axis'].plot(data['I'], data['errDiff']['q'], label="Q")
-                self._figures['errDiff']['axis'].legend()
-
-            self._figures['errDiff']['axis'].set_xlabel(self._figures['errDiff']['xlabel'])
-            self._figures['errDiff']['axis'].set_ylabel(self._figures['errDiff']['ylabel'])
-            self._figures['errDiff']['axis'].set_title(self._figures['errDiff']['title'])
-            self._figures['errDiff']['fig_agg'].draw()
+            self._figures['sigDiff'].update(data['I'], self._differenceCurves(data['sigDiff'], data['errDiff']))
+            self._figures['errDiff'].update(data['I'], self._errorCurves(data['errDiff']))
 
     def redrawScanDurations(self):
-        if not self._scanDurationsUpdated:
+        data = self._drawn.consume('scanDurations', self._experiment.snapshots['scanDurations'])
+        if data is None:
             return
-        self._scanDurationsUpdated = True
 
-        self._figures['scanDurations']['axis'].cla()
-        self._figures['scanDurations']['axis'].grid()
-        if len(self._scanDurations) > 0:
-            self._figures['scanDurations']['axis'].plot(self._scanDurations)
-        self._figures['scanDurations']['axis'].set_xlabel(self._figures['scanDurations']['xlabel'])
-        self._figures['scanDurations']['axis'].set_ylabel(self._figures['scanDurations']['ylabel'])
-        self._figures['scanDurations']['axis'].set_title(self._figures['scanDurations']['title'])
-        self._figures['scanDurations']['fig_agg'].draw()
+        if len(data['values']) > 0:
+            self._figures['scanDurations'].update(data['index'], [ (None, data['values'], None) ])
+        else:
+            self._figures['scanDurations'].clear()
 
     def redrawBeamCurrent(self):
-        if not self._ebeamUpdated:
+        data = self._drawn.consume('beamCurrent', self._experiment.snapshots['beamCurrent'])
+        if data is None:
             return
-        self._ebeamUpdated = False
-
-        self._figures['ebeamCurrentEst']['axis'].cla()
-        self._figures['ebeamCurrentEst']['axis'].grid()
-        if len(self._ebeamCurrentEst) > 0:
-            self._figures['ebeamCurrentEst']['axis'].plot(self._ebeamCurrentEst)
-        self._figures['ebeamCurrentEst']['axis'].set_xlabel(self._figures['ebeamCurrentEst']['xlabel'])
-        self._figures['ebeamCurrentEst']['axis'].set_ylabel(self._figures['ebeamCurrentEst']['ylabel'])
-        self._figures['ebeamCurrentEst']['axis'].set_title(self._figures['ebeamCurrentEst']['title'])
-        self._figures['ebeamCurrentEst']['fig_agg'].draw()
-
-        self._figures['ebeamCurrentMeas']['axis'].cla()
-        self._figures['ebeamCurrentMeas']['axis'].grid()
-        if len(self._ebeamCurrentMeas) > 0:
-            self._figures['ebeamCurrentMeas']['axis'].plot(self._ebeamCurrentMeas)
-        self._figures['ebeamCurrentMeas']['axis'].set_xlabel(self._figures['ebeamCurrentMeas']['xlabel'])
-        self._figures['ebeamCurrentMeas']['axis'].set_ylabel(self._figures['ebeamCurrentMeas']['ylabel'])
-        self._figures['ebeamCurrentMeas']['axis'].set_title(self._figures['ebeamCurrentMeas']['title'])
-        self._figures['ebeamCurrentMeas']['fig_agg'].draw()
-
-    def run(self):
-        # MQTT setup ...
-        self.mqtt = mqtt.Client(reconnect_on_failure=True)
-        self.mqtt.on_connect = self._mqtt_on_connect
-        self.mqtt.on_message = self._mqtt_on_message
-
-        self.mqtt.username_pw_set(self._condata['user'], self._condata['pass'])
-        self.mqtt.connect(self._condata['broker'], self._condata['port'])
-        self.mqtt.loop_start()
+
+        for figName, history in (('ebeamCurrentEst', data['est']), ('ebeamCurrentMeas', data['meas'])):
+            if len(history['values']) > 0:
+                self._figures[figName].update(history['index'], [ (None, history['values'], None) ])
+            else:
+                self._figures[figName].clear()
+
+    def redrawFitDrift(self):
+        data = self._drawn.consume('fitDrift', self._experiment.snapshots['fitDrift'])
+        if data is None:
+            return
+
+        for figName, name in (('fitCenter', 'center'), ('fitWidth', 'width')):
+            if len(data[name]) > 0:
+                self._figures[figName].update(data['index'], [ (None, data[name], data[name + 'Error']) ])
+            else:
+                self._figures[figName].clear()
+
+    def _profiled(self, target):
+        # cProfile only sees the thread it has been enabled in, so every
+        # thread of the display runs its own profiler. They're merged into
+        # one pstats file after the display has been closed
+        if self._profileTo is None:
+            return target
+
+        def profiledTarget(*args, **kwargs):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError as e:
+                # Newer Python versions allow only one active profiler
+                logging.warning("Not profiling thread {}: {}".format(threading.current_thread().name, e))
+                return target(*args, **kwargs)
+            self._profiles.append(profile)
+            try:
+                return target(*args, **kwargs)
+            finally:
+                profile.disable()
+        return profiledTarget
+
+    def publishStatistics(self, stats = None):
+        if stats is None:
+            stats = self._diagnostics.snapshot()
+        if (self.mqtt is not None) and self._mqttConnected:
+            self.mqtt.publish(self._condata['basetopic'][0] + "display/stats", json.dumps(stats))
+
+    def _replayLog(self, reader, speed, start, stopEvent):
+        nMessages = reader.replay(lambda timestamp, topic, payload: self.feedMessage(topic, payload), speed = speed, start = start, stopEvent = stopEvent)
+        reader.close()
+        self._statusstring = "Replay finished after {} messages".format(nMessages)
+        self._notifyDataChanged()
+
+    def run(self, replay = None, replaySpeed = 1.0, replayStart = None):
+        self._profiled(self._runDisplay)(replay, replaySpeed, replayStart)
+        if (self._profileTo is not None) and (len(self._profiles) > 0):
+            pstats.Stats(*self._profiles).dump_stats(self._profileTo)
+
+    def _runDisplay(self, replay, replaySpeed, replayStart):
+        # Either replay a recorded log (replay = path) or connect to the broker
+        replayThread = None
+        mqttThread = None
+        replayStop = threading.Event()
+        if replay is not None:
+            replayReader = MessageLogReader(replay)
+            self._statusstring = "Replaying {}".format(replay)
+        else:
+            # MQTT setup ...
+            self.mqtt = mqtt.Client(reconnect_on_failure=True, protocol = mqtt.MQTTv5 if self._mqtt5 else mqtt.MQTTv311)
+            self.mqtt.on_connect = self._mqtt_on_connect
+            self.mqtt.on_disconnect = self._mqtt_on_disconnect
+            self.mqtt.on_message = self._mqtt_on_message
+
+            self.mqtt.username_pw_set(self._condata['user'], self._condata['pass'])
+            if self._asyncIngestion:
+                policies = {}
+                for experiment in self._experiments:
+                    policies.update(experiment.coalescing)
+                self._ingestion = AsyncIngestion(self.mqtt, self._prepareReceived, self._handleMessage, queueSize = self._queueSize, policies = policies, mergeBatch = self._mergeBatch)
+                self._ingestion.start(self._condata['broker'], self._condata['port'], wrapThread = self._profiled if self._profileTo is not None else None)
+            elif self._profileTo is None:
+                self.mqtt.connect(self._condata['broker'], self._condata['port'])
+                self.mqtt.loop_start()
+            else:
+                # Same as loop_start but with the network thread profiled
+                self.mqtt.connect(self._condata['broker'], self._condata['port'])
+                mqttThread = threading.Thread(target = self._profiled(self.mqtt.loop_forever), kwargs = { 'retry_first_connection' : True }, daemon = True)
+                mqttThread.start()
 
         layout = [
             [
                 sg.TabGroup([[
-                        sg.Tab('Last peak',[
+                        sg.Tab('Last peak', key='tabPeak', layout=[
                             [
                                 sg.Column([
                                     [ sg.Text("Signal") ],
@@ -961,9 +871,17 @@ class QUAKESRRealtimeDisplay:
                                     [ sg.Text("Error (Difference)") ],
                                     [ sg.Canvas(size=self._plotsize, key='canvErrDiff') ]
                                 ], scrollable=False)
+                            ],
+                            [
+                                sg.Button("<<", key='btnHistoryBack10'),
+                                sg.Button("<", key='btnHistoryBack'),
+                                sg.Text("Live", size=(30,1), justification='center', key='txtHistory'),
+                                sg.Button(">", key='btnHistoryForward'),
+                                sg.Button(">>", key='btnHistoryForward10'),
+                                sg.Button("Live", key='btnHistoryLive')
                             ]
                         ]),
-                        sg.Tab('Point data',[
+                        sg.Tab('Point data', key='tabPointData', layout=[
                             [
                                 sg.Column([
                                     [ sg.Text("Current peak points") ],
@@ -971,7 +889,7 @@ class QUAKESRRealtimeDisplay:
                                 ], scrollable=False)
                             ]
                         ]),
-                        sg.Tab('Average',[
+                        sg.Tab('Average', key='tabAverage', layout=[
                             [
                                 sg.Column([
                                     [ sg.Text("Signal") ],
@@ -991,9 +909,16 @@ class QUAKESRRealtimeDisplay:
                                     [ sg.Text("Error (Difference)") ],
                                     [ sg.Canvas(size=self._plotsize, key='canvErrDiffAVG') ]
                                 ], scrollable=False)
+                            ],
+                            [
+                                sg.Text("Averaging:"),
+                                sg.Combo([ AVERAGE_MODE_LABELS[mode] for mode in AVERAGE_MODES ], default_value = AVERAGE_MODE_LABELS['cumulative'], key='cmbAverageMode', readonly=True),
+                                sg.Text("Peaks:"),
+                                sg.InputText("", size=(6,1), key='txtAveragePeaks'),
+                                sg.Button("Apply", key='btnAverageApply')
                             ]
                         ]),
-                        sg.Tab('Scan duration', [
+                        sg.Tab('Scan duration', key='tabScanDuration', layout=[
                             [
                                 sg.Column([
                                     [ sg.Text("Scan duration") ],
@@ -1002,7 +927,7 @@ class QUAKESRRealtimeDisplay:
                                 ])
                             ]
                         ]),
-                        sg.Tab('Electron beam', [
+                        sg.Tab('Electron beam', key='tabBeamCurrent', layout=[
                             [
                                 sg.Column([
                                     [ sg.Text("Current (measured)") ],
@@ -1012,8 +937,25 @@ class QUAKESRRealtimeDisplay:
                                     [ sg.Button("Reset", key='btnResetBeamCurrent')]
                                 ]),
                             ]
+                        ]),
+                        sg.Tab('Resonance fit', key='tabFit', layout=[
+                            [
+                                sg.Column([
+                                    [ sg.Text("Center") ],
+                                    [ sg.Canvas(size=self._plotsize, key='canvFitCenter') ]
+                                ], scrollable=False),
+                                sg.Column([
+                                    [ sg.Text("Width") ],
+                                    [ sg.Canvas(size=self._plotsize, key='canvFitWidth') ]
+                                ], scrollable=False)
+                            ],
+                            [ sg.Text("", size=(130, 2), key='txtFit') ],
+                            [ sg.Button("Reset", key='btnResetFitDrift') ]
+                        ]),
+                        sg.Tab('Diagnostics', key='tabDiagnostics', layout=[
+                            [ sg.Multiline("", size=(130, 40), key='txtDiagnostics', disabled=True, font=('Courier', 9)) ]
                         ])
-                ]])
+                ]], key='tabGroup', enable_events=True)
             ],
             [
                 sg.Column([
@@ -1039,7 +981,8 @@ class QUAKESRRealtimeDisplay:
                     [ sg.Text("", key="txtLastScanDuration") ]
                 ]),
                 sg.Column([
-                    [ sg.Checkbox("Running average", default = False, key="chkRunAverage") ],
+                    [ sg.Combo([ experiment.name for experiment in self._experiments ], default_value = self._experiment.name, key="cmbExperiment", readonly = True, enable_events = True) ],
+                    [ sg.Checkbox("Running average", default = False, key="chkRunAverage", enable_events = True) ],
                     [ sg.Button("Reset running average", key="btnAvgReset") ],
                     [ sg.Button("Exit", key="btnExit") ]
                 ])
@@ -1052,82 +995,211 @@ class QUAKESRRealtimeDisplay:
         ]
 
         self._window = sg.Window("QUAK/ESR Realtime display", layout, size=(1024,750), finalize=True)
+        self._visibleTab = 'tabPeak'
+        for experiment in self._experiments:
+            experiment.setRunningAverageEnabled(False)
         # self._window.Maximize()
 
-        # Create figures / keep track of canvas, etc. ...
-        self._figures = {
-            'sig' : self.__init_figure('canvSig', 'B0', 'uV', 'Last peak signal'),
-            'err' : self.__init_figure('canvErr', 'B0', 'uV', 'Last peak error'),
-
-            'sigZero' : self.__init_figure('canvSigZero', 'B0', 'uV', 'Last peak zero signal'),
-            'errZero' : self.__init_figure('canvErrZero', 'B0', 'uV', 'Zero signal error'),
-
-            'sigDiff' : self.__init_figure('canvSigDiff', 'B0', 'uV', 'Current signal difference'),
-            'errDiff' : self.__init_figure('canvErrDiff', 'B0', 'uV', 'Current error difference'),
-
-
-
-            'sigAvg' : self.__init_figure('canvSigAVG', 'B0', 'uV', 'Peak signal (averaged)'),
-            'errAvg' : self.__init_figure('canvErrAVG', 'B0', 'uV', 'Error (averaged)'),
-
-            'sigZeroAvg' : self.__init_figure('canvSigZeroAVG', 'B0', 'uV', 'Zero signal (averaged)'),
-            'errZeroAvg' : self.__init_figure('canvErrZeroAVG', 'B0', 'uV', 'Zero error (averaged)'),
-
-            'sigDiffAvg' : self.__init_figure('canvSigDiffAVG', 'B0', 'uV', 'Difference signal (averaged)'),
-            'errDiffAvg' : self.__init_figure('canvErrDiffAVG', 'B0', 'uV', 'Difference error (averaged)'),
-
-            'scanDurations' : self.__init_figure('canvMeasDuration', 'Scan', 'Duration [s]', 'Scan durations'),
-
-            'ebeamCurrentMeas' : self.__init_figure('canvEbeamCurrentMeas', 'Scan', 'Current (uA)', 'Measured beam current'),
-            'ebeamCurrentEst' : self.__init_figure('canvEbeamCurrentEst', 'Scan', 'Current (uA)', 'Estimated beam current'),
-
-            'pointCurScan' : self.__init_figure('canvPointCurScan', 'B0/f_RF', 'Current (uA)', 'Realtime points aquired' )
-        }
+        # Only the figures of the visible tab are created now, the others
+        # when their tab is selected
+        self.createFigures(self._visibleTab)
+        self._window.refresh()
+        self._diagnostics.startupMark('firstFrame')
+
+        # Redraws are coalesced into frames by the scheduler
+        self._scheduler = RedrawScheduler(maxFrameRate = self._maxFrameRate, frameBudget = self._frameBudget)
+        for name, redraw in (
+            ('peak', self.redrawPeakData),
+            ('average', self.redrawAveragedData),
+            ('scanDurations', self.redrawScanDurations),
+            ('beamCurrent', self.redrawBeamCurrent),
+            ('pointData', self.redrawPointData),
+            ('fitDrift', self.redrawFitDrift)
+        ):
+            self._scheduler.addTask(name, lambda name = name: self._needsRedraw(name), redraw)
+
+        if replay is not None:
+            replayThread = threading.Thread(target = self._profiled(self._replayLog), args = (replayReader, replaySpeed, replayStart, replayStop), daemon = True)
+            replayThread.start()
+
+        statusTexts = {}
+        diagnosticsInterval = 1.0
+        nextDiagnostics = time.monotonic()
+        nextStats = time.monotonic() + self._statsInterval if self._statsInterval else None
 
         # Show window and react to events ...
         while True:
-            event, values = self._window.read(timeout = 1)
+            # Block until either a GUI event, a data changed notification,
+            # the next frame for already pending changes or the next
+            # diagnostics update is due
+            timeout = self._scheduler.timeout()
+            diagnosticsTimeout = max(0, int((nextDiagnostics - time.monotonic()) * 1000))
+            event, values = self._window.read(timeout = diagnosticsTimeout if timeout is None else min(timeout, diagnosticsTimeout))
+            self._diagnostics.loopIteration()
             if event in ('btnExit', None):
                 break
-            self._averagedPeakData['enabled'] = values['chkRunAverage']
+            if event == "sigDataChanged":
+                self._dataChangedPending = False
+            if event == "tabGroup":
+                self._visibleTab = values['tabGroup']
+                self.createFigures(self._visibleTab)
+
+            if event == "cmbExperiment":
+                self.selectExperiment([ experiment.name for experiment in self._experiments ].index(values['cmbExperiment']))
+            if event == "chkRunAverage":
+                self._experiment.setRunningAverageEnabled(values['chkRunAverage'])
             if event == "btnAvgReset":
-                self._runningAverageInit()
-            if event == "sigEnableAverage":
-                self._window['chkRunAverage'].Update(True)
-            if event == "sigDisableAverage":
-                self._window['chkRunAverage'].Update(False)
+                self._experiment.resetRunningAverage()
+            if event == "btnAverageApply":
+                mode = [ mode for mode in AVERAGE_MODES if AVERAGE_MODE_LABELS[mode] == values['cmbAverageMode'] ][0]
+                try:
+                    self._experiment.setAveragingMode(mode, int(values['txtAveragePeaks']))
+                except ValueError:
+                    ModalDialogError().show("Invalid number of peaks", "The number of peaks to average has to be a positive integer")
+            for key, step in (('btnHistoryBack10', -10), ('btnHistoryBack', -1), ('btnHistoryForward', 1), ('btnHistoryForward10', 10)):
+                if event == key:
+                    self.browsePeakHistory(step)
+            if event == "btnHistoryLive":
+                self.showLivePeak()
             if event == "btnResetMeasurementDuration":
-                self._scanDurations = []
-                self._scanDurationsUpdated = True
+                self._experiment.resetScanDurations()
             if event == "btnResetBeamCurrent":
-                self._ebeamCurrentEst = []
-                self._ebeamCurrentMeas = []
-                self._ebeamUpdated = True
-            if event == "update_progress":
-                if values['update_progress'] == 0:
-                    self._window['progressZeroPeak'].Update(0.0)
-                self._window['progressPeak'].Update(values['update_progress'])
-            if event == "update_progresszero":
-                self._window['progressZeroPeak'].Update(values['update_progresszero'])
+                self._experiment.resetBeamCurrent()
+            if event == "btnResetFitDrift":
+                self._experiment.resetFitDrift()
 
             # Redraw peak data if required ...
-            self.redrawPeakData()
-            self.redrawAveragedData()
-            self.redrawScanDurations()
-            self.redrawBeamCurrent()
-            self.redrawPointData()
-
-            # Update status string
-            self._window['txtStatus'].Update(self._statusstring)
-            self._window['txtLastScanStart'].Update(self._lastscan['start'])
-            self._window['txtLastScanFinish'].Update(self._lastscan['stop'])
-            self._window['txtLastScanDuration'].Update(self._lastscan['duration'])
-            self._window['txtScantype'].Update(self._lastscan['type'])
+            if self._scheduler.frameDue():
+                frameSince = self._diagnostics.frameStarted()
+                if self._scheduler.runFrame():
+                    self._diagnostics.frameFinished(frameSince)
+                    self._diagnostics.startupMark('firstDataFrame')
+                else:
+                    # Remaining changes are picked up by the next frame
+                    self._diagnostics.messageHandled(frameSince)
+                self._diagnostics.deferredFrames = self._scheduler.deferredFrames()
+
+            now = time.monotonic()
+            if now >= nextDiagnostics:
+                if self._ingestion is not None:
+                    self._diagnostics.ingestion = self._ingestion.statistics()
+                stats = self._diagnostics.snapshot()
+                self._window['txtDiagnostics'].Update(formatReport(stats))
+                nextDiagnostics = now + diagnosticsInterval
+                if (nextStats is not None) and (now >= nextStats):
+                    self.publishStatistics(stats)
+                    nextStats = now + self._statsInterval
+
+            # Update status strings, progress and the running average state of
+            # the selected experiment (only pushed to Tk when changed)
+            _, lastscan = self._experiment.snapshots['lastScan'].latest()
+            _, progress = self._experiment.snapshots['progress'].latest()
+            for key, value in (
+                ('txtStatus', self._statusstring),
+                ('txtLastScanStart', lastscan['start']),
+                ('txtLastScanFinish', lastscan['stop']),
+                ('txtLastScanDuration', lastscan['duration']),
+                ('txtScantype', lastscan['type']),
+                ('progressPeak', progress['peak']),
+                ('progressZeroPeak', progress['zero']),
+                ('chkRunAverage', self._experiment.runningAverageEnabled()),
+                ('cmbAverageMode', AVERAGE_MODE_LABELS[self._experiment.averagingMode()[0]]),
+                ('txtAveragePeaks', str(self._experiment.averagingMode()[1])),
+                ('txtHistory', self._historyStatus()),
+                ('txtFit', self._fitStatus())
+            ):
+                if statusTexts.get(key) != value:
+                    self._window[key].Update(value)
+                    statusTexts[key] = value
+
+        # Shutdown
+        if replayThread is not None:
+            replayStop.set()
+            replayThread.join()
+        if self._ingestion is not None:
+            self._ingestion.stop()
+        elif mqttThread is not None:
+            self.mqtt.disconnect()
+            mqttThread.join()
+        elif self.mqtt is not None:
+            self.mqtt.loop_stop()
+            self.mqtt.disconnect()
+        if self._recorder is not None:
+            self._recorder.close()
+        if self._fitter is not None:
+            self._fitter.close()
+        for experiment in self._experiments:
+            experiment.close()
+        self._window.close()
 
 def main():
-    conResult = WindowConnect().showConnect()
+    startedAt = time.monotonic()
+
+    parser = argparse.ArgumentParser(description = "QUAK/ESR realtime display")
+    parser.add_argument('--connect', action = 'store_true', help = "Connect without showing the connection dialog (settings from the configuration file and command line)")
+    parser.add_argument('--config', default = None, help = "Connection configuration file (default ~/.config/quakesrdisplay/connection.conf)")
+    parser.add_argument('--broker', default = None, help = "MQTT broker (implies --connect)")
+    parser.add_argument('--port', type = int, default = None, help = "MQTT broker port")
+    parser.add_argument('--user', default = None, help = "MQTT user")
+    parser.add_argument('--password', default = None, help = "MQTT password")
+    parser.add_argument('--record', default = None, help = "Record all handled MQTT messages into the given log file")
+    parser.add_argument('--archive', default = None, help = "Archive peaks, scans and beam currents into the given directory")
+    parser.add_argument('--replay', default = None, help = "Replay a recorded log file instead of connecting to a broker")
+    parser.add_argument('--speed', type = float, default = 1.0, help = "Replay speed (1 = real time, 0 = as fast as possible)")
+    parser.add_argument('--seek', type = float, default = None, help = "Start the replay at the given UNIX timestamp")
+    parser.add_argument('--basetopic', nargs = '+', default = None, help = "Base topic(s) of the experiments (default from the configuration file, quakesr/experiment for replays)")
+    parser.add_argument('--stats-interval', dest = 'statsInterval', type = float, default = None, help = "Publish display statistics to <basetopic>/display/stats (of the first experiment) every N seconds")
+    parser.add_argument('--profile', default = None, help = "Record a cProfile capture of the session into the given pstats file")
+    parser.add_argument('--peak-history', dest = 'peakHistory', type = int, default = 500, help = "Number of peaks kept in memory for browsing the last peak history")
+    parser.add_argument('--average', choices = AVERAGE_MODES, default = 'cumulative', help = "Running average mode (cumulative since the last reset, sliding window or exponentially weighted)")
+    parser.add_argument('--average-peaks', dest = 'averagePeaks', type = int, default = 20, help = "Window size (or span of the exponential weighting) of the running average in peaks")
+    parser.add_argument('--grid-tolerance', dest = 'gridTolerance', type = float, default = None, help = "B0 values closer than this are averaged as the same grid point (default 1%% of the grid step)")
+    parser.add_argument('--asyncio', dest = 'asyncIngestion', action = 'store_true', help = "Receive messages on an asyncio event loop and handle them in a pipeline with bounded queue")
+    parser.add_argument('--queue-size', dest = 'queueSize', type = int, default = 256, help = "Messages queued by the asyncio ingestion before reading from the broker pauses")
+    parser.add_argument('--mqtt5', action = 'store_true', help = "Connect with MQTT v5 (required to select packed payloads by content type)")
+    parser.add_argument('--no-fit', dest = 'noFit', action = 'store_true', help = "Don't fit the resonance of every peak and the running average")
+    args = parser.parse_args()
+    if args.averagePeaks < 1:
+        parser.error("The running average has to span at least one peak")
+    if args.peakHistory < 1:
+        parser.error("The peak history has to hold at least one peak")
+
+    if args.replay is not None:
+        conResult = {
+            'broker' : '',
+            'port' : 0,
+            'user' : '',
+            'pass' : '',
+            'basetopic' : args.basetopic if args.basetopic is not None else [ 'quakesr/experiment' ]
+        }
+        QUAKESRRealtimeDisplay(conResult, recordTo = args.record, statsInterval = args.statsInterval, profileTo = args.profile, startedAt = startedAt, peakHistoryLength = args.peakHistory, archiveTo = args.archive, resonanceFit = not args.noFit, averageMode = args.average, averagePeaks = args.averagePeaks, gridTolerance = args.gridTolerance).run(replay = args.replay, replaySpeed = args.speed, replayStart = args.seek)
+        return
+
+    defaults = loadConnectionConfig(args.config)
+    for key, value in (('broker', args.broker), ('port', args.port), ('user', args.user), ('password', args.password), ('basetopic', args.basetopic)):
+        if value is not None:
+            defaults[key] = value
+
+    if args.connect or (args.broker is not None) or defaults.get('autoconnect', False):
+        try:
+            conResult = {
+                'broker' : defaults['broker'],
+                'port' : int(defaults['port']),
+                'user' : defaults['user'],
+                'pass' : defaults['password'],
+                'basetopic' : parseBasetopics(defaults['basetopic'])
+            }
+        except ValueError:
+            parser.error("Invalid broker port {}".format(defaults['port']))
+        if (conResult['broker'] == '') or (len(conResult['basetopic']) == 0):
+            parser.error("Connecting without dialog requires a broker and a base topic")
+    else:
+        conResult = WindowConnect().showConnect(defaults)
+        # Startup time is measured from the moment the dialog has been closed
+        startedAt = time.monotonic()
+
     if conResult:
-        disp = QUAKESRRealtimeDisplay(conResult).run()
+        disp = QUAKESRRealtimeDisplay(conResult, recordTo = args.record, statsInterval = args.statsInterval, profileTo = args.profile, startedAt = startedAt, peakHistoryLength = args.peakHistory, archiveTo = args.archive, resonanceFit = not args.noFit, averageMode = args.average, averagePeaks = args.averagePeaks, gridTolerance = args.gridTolerance, asyncIngestion = args.asyncIngestion, queueSize = args.queueSize, mqtt5 = args.mqtt5).run()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,522 @@
+import logging
+import time
+
+import numpy as np
+
+from datetime import datetime
+
+from esrrtdisplay01.ringbuffer import RingBuffer
+from esrrtdisplay01.growbuffer import GrowableBuffer
+from esrrtdisplay01.snapshot import SnapshotSlot
+from esrrtdisplay01.peakstats import peakMatrix, peakStatistics, peakDifference, createAverage, GridIndex
+from esrrtdisplay01.history import PeakHistory
+from esrrtdisplay01.archive import PEAK_SIGNAL, PEAK_ZERO, BEAMCURRENT_ESTIMATE, BEAMCURRENT_MEASUREMENT
+from esrrtdisplay01.fitting import PARAMETERS
+from esrrtdisplay01.mailbox import LATEST, BATCH
+from esrrtdisplay01.codec import MATRIX_TOPIC_SUFFIX
+
+# State of one experiment (one base topic). The handlers of every experiment
+# are registered at the dispatcher shared by all experiments of a display,
+# they're called on the thread running the dispatcher while holding the
+# state lock of the display.
+#
+# State shared with the GUI thread is only exchanged via immutable
+# snapshots. The lists and accumulators below are private to the thread
+# running the handlers (writers hold the state lock)
+#
+# If an archive writer is supplied all peaks, running averages (after every
+# averaged peak), scans and beam current samples are archived as well. The
+# state of the last peak after every peak is kept in a browsable history of
+# peakHistoryLength peaks in memory (continued from the archive if there is
+# one).
+#
+# The running average is either cumulative (since the last reset), over a
+# sliding window of the last peaks or exponentially weighted. Signal and
+# zero peaks are averaged on one common grid of all B0 values seen (points
+# within gridTolerance are treated as the same point), so scans with refined
+# or shifted grids can be combined.
+#
+# With a resonance fitter the last signal peak and the running average are
+# fitted in the background. Results are attached to the peak and average
+# snapshots ('fit') when they arrive, the center and width of the peak fits
+# are kept as drift history. If a fit fails or doesn't converge, 'fit' is
+# cleared and 'fitFailed' set instead of keeping the previous result.
+# Every new signal peak starts without fit, results are only attached to
+# the peak (or average generation) they have been submitted for.
+# onChanged is called after a result has been published (from a thread of
+# the fitter).
+#
+# coalescing lists the policies for messages that queue up before being
+# handled (see mailbox.py): only the newest scan progress is of interest,
+# point data may be handled in batches (the payload is then a list of
+# point data payloads).
+#
+# Peak and point data are accepted as JSON as well as packed matrices (see
+# codec.py, also on the topics with suffix /bin). Packed point data holds
+# one row (B0, i, q) per point.
+
+class Experiment:
+    def __init__(self, basetopic, handlers, stateLock, historyLength = 10000, peakHistoryLength = 500, archive = None, fitter = None, averageMode = 'cumulative', averagePeaks = 20, gridTolerance = None):
+        if basetopic[-1] != '/':
+            basetopic = basetopic + "/"
+        self.basetopic = basetopic
+        self.name = basetopic[:-1]
+
+        self._stateLock = stateLock
+        self._historyLength = historyLength
+        self._archive = archive
+        self._fitter = fitter
+        self.onChanged = None
+
+        self.snapshots = {
+            'peak' : SnapshotSlot({
+                'I' : None,
+                'sig' : None,
+                'err' : None,
+                'sigZero' : None,
+                'errZero' : None,
+                'sigDiff' : None,
+                'errDiff' : None,
+                'n' : None,
+                'fit' : None,
+                'fitFailed' : False
+            }),
+            'average' : SnapshotSlot(),
+            'pointData' : SnapshotSlot(),
+            'scanDurations' : SnapshotSlot(),
+            'beamCurrent' : SnapshotSlot(),
+            'lastScan' : SnapshotSlot(),
+            'progress' : SnapshotSlot(),
+            'fitDrift' : SnapshotSlot()
+        }
+
+        self.history = PeakHistory(
+            maxEntries = peakHistoryLength,
+            archiveDirectory = archive.directory if archive is not None else None,
+            archivedPeaks = len(archive) if archive is not None else None
+        )
+
+        self._lastscan = { 'start' : "", 'stop' : "", 'duration' : "", 'type' : "" }
+        self.snapshots['lastScan'].publish(self._lastscan)
+
+        self._progress = { 'peak' : 0.0, 'zero' : 0.0 }
+        self.snapshots['progress'].publish(self._progress)
+
+        self._scanDurations = RingBuffer(self._historyLength)
+        self._publishScanDurations()
+
+        # Point data of the current iteration (columns I, i, q). Two buffers
+        # are used alternately so the GUI can still draw the previous
+        # iteration while the new one is filled. The points of one iteration
+        # only grow, so the GUI draws just the new ones until the iteration
+        # number changes
+        self._pointBuffers = [ GrowableBuffer(3), GrowableBuffer(3) ]
+        self._lastPointData = self._pointBuffers[0]
+        self._pointIteration = 0
+        self._pointdataClear = True
+        self._publishPointData()
+
+        self._ebeamCurrentEst = RingBuffer(self._historyLength)
+        self._ebeamCurrentMeas = RingBuffer(self._historyLength)
+        self._publishBeamCurrent()
+
+        self._fitCenter = RingBuffer(self._historyLength)
+        self._fitCenterError = RingBuffer(self._historyLength)
+        self._fitWidth = RingBuffer(self._historyLength)
+        self._fitWidthError = RingBuffer(self._historyLength)
+        self._publishFitDrift()
+
+        self._peakGeneration = 0
+        self._averageGeneration = 0
+        self._averageMode = averageMode
+        self._averagePeaks = averagePeaks
+        self._gridTolerance = gridTolerance
+        self._runningAverageEnabled = True
+        self._runningAverageInit()
+
+        handlers.registerHandler(f"{basetopic}scan/peak/peakdata", self._msghandler_received_peakdata)
+        handlers.registerHandler(f"{basetopic}scan/peak/zeropeakdata", self._msghandler_received_zeropeakdata)
+        handlers.registerHandler(f"{basetopic}scan/peak/peakdata{MATRIX_TOPIC_SUFFIX}", self._msghandler_received_peakdata)
+        handlers.registerHandler(f"{basetopic}scan/peak/zeropeakdata{MATRIX_TOPIC_SUFFIX}", self._msghandler_received_zeropeakdata)
+        handlers.registerHandler(f"{basetopic}scan/+/start", self._msghandler_received_startscan)
+        handlers.registerHandler(f"{basetopic}scan/+/done", self._msghandler_received_donescan)
+
+        handlers.registerHandler(f"{basetopic}scan/until/+/start", self._msghandler_received_startscan)
+        handlers.registerHandler(f"{basetopic}scan/until/+/done", self._msghandler_received_donescan)
+
+        handlers.registerHandler(f"{basetopic}scanuntil/start", self._msghandler_resetandenableaverage)
+        handlers.registerHandler(f"{basetopic}scanuntil/done", self._msghandler_stoprunningaverage)
+
+        handlers.registerHandler(f"{basetopic}egun/beamcurrent/estimate", self._msghandler_beamcurrentestimate)
+        handlers.registerHandler(f"{basetopic}egun/beamcurrent/measurement", self._msghandler_beamcurrentmeasurement)
+
+        handlers.registerHandler(f"{basetopic}scan/iteration", self._msghandler_received_scaniteration)
+
+        handlers.registerHandler(f"{basetopic}scan/pointdata", self._msghandler_received_pointdata)
+        handlers.registerHandler(f"{basetopic}scan/pointdata{MATRIX_TOPIC_SUFFIX}", self._msghandler_received_pointdata)
+
+        self.coalescing = {
+            f"{basetopic}scan/iteration" : (LATEST, basetopic),
+            f"{basetopic}scan/pointdata" : (BATCH, basetopic),
+            f"{basetopic}scan/pointdata{MATRIX_TOPIC_SUFFIX}" : (BATCH, basetopic)
+        }
+
+    # Histories are published as copies of their ring buffer windows (a full
+    # ring buffer overwrites its oldest samples), point data as view into
+    # its buffer (rows of a view aren't written again until the buffer is
+    # reused for the iteration after next)
+
+    def _historySnapshot(self, history):
+        window = history.window()
+        return {
+            'index' : history.indices(),
+            'values' : window[:, 1],
+            'timestamps' : window[:, 0]
+        }
+
+    def _publishScanDurations(self):
+        self.snapshots['scanDurations'].publish(self._historySnapshot(self._scanDurations))
+
+    def _publishBeamCurrent(self):
+        self.snapshots['beamCurrent'].publish({
+            'est' : self._historySnapshot(self._ebeamCurrentEst),
+            'meas' : self._historySnapshot(self._ebeamCurrentMeas)
+        })
+
+    def _publishFitDrift(self):
+        center = self._fitCenter.window()
+        self.snapshots['fitDrift'].publish({
+            'index' : self._fitCenter.indices(),
+            'timestamps' : center[:, 0],
+            'center' : center[:, 1],
+            'centerError' : self._fitCenterError.window()[:, 1],
+            'width' : self._fitWidth.window()[:, 1],
+            'widthError' : self._fitWidthError.window()[:, 1]
+        })
+
+    def _publishPointData(self):
+        points = self._lastPointData.view()
+        self.snapshots['pointData'].publish({
+            'I' : points[:, 0],
+            'i' : points[:, 1],
+            'q' : points[:, 2],
+            'iteration' : self._pointIteration
+        })
+
+    def resetScanDurations(self):
+        with self._stateLock:
+            self._scanDurations = RingBuffer(self._historyLength)
+            self._publishScanDurations()
+
+    def resetBeamCurrent(self):
+        with self._stateLock:
+            self._ebeamCurrentEst = RingBuffer(self._historyLength)
+            self._ebeamCurrentMeas = RingBuffer(self._historyLength)
+            self._publishBeamCurrent()
+
+    def resetFitDrift(self):
+        with self._stateLock:
+            self._fitCenter = RingBuffer(self._historyLength)
+            self._fitCenterError = RingBuffer(self._historyLength)
+            self._fitWidth = RingBuffer(self._historyLength)
+            self._fitWidthError = RingBuffer(self._historyLength)
+            self._publishFitDrift()
+
+    def resetRunningAverage(self):
+        with self._stateLock:
+            self._runningAverageInit()
+
+    def averagingMode(self):
+        return (self._averageMode, self._averagePeaks)
+
+    def setAveragingMode(self, mode, peaks = 20):
+        # Restarts the running average in the new mode (invalid modes raise
+        # a ValueError before the current average is dropped)
+        createAverage(mode, peaks)
+        with self._stateLock:
+            self._averageMode = mode
+            self._averagePeaks = peaks
+            self._runningAverageInit()
+
+    def close(self):
+        if self._archive is not None:
+            self._archive.close()
+
+    def _submitFit(self, kind, data, timestamp):
+        # Fits the signal of data ('peak' or 'average') in the background
+        if (self._fitter is None) or (data['I'] is None) or (data['sig'] is None):
+            return
+        err = data['err'] if data['err'] is not None else { 'i' : None, 'q' : None }
+
+        # Grid points of the average without samples yet are left out
+        valid = np.isfinite(data['sig']['i']) & np.isfinite(data['sig']['q'])
+        if np.count_nonzero(valid) <= len(PARAMETERS):
+            return
+        generation = self._peakGeneration if kind == 'peak' else self._averageGeneration
+        self._fitter.submit(
+            (self.name, kind),
+            data['I'][valid], data['sig']['i'][valid], data['sig']['q'][valid],
+            err['i'][valid] if err['i'] is not None else None,
+            err['q'][valid] if err['q'] is not None else None,
+            lambda result: self._fitFinished(kind, generation, timestamp, result)
+        )
+
+    def _fitFinished(self, kind, generation, timestamp, result):
+        failed = (result is None) or (not result['converged'])
+        if failed:
+            logging.debug("Resonance fit of {} ({}) failed or did not converge".format(self.name, kind))
+            result = None
+
+        with self._stateLock:
+            if kind == 'peak':
+                # Results for an older peak are dropped
+                if generation != self._peakGeneration:
+                    return
+                self.snapshots['peak'].update(fit = result, fitFailed = failed)
+
+                # Only fits of single peaks are used for the drift history
+                if not failed:
+                    self._fitCenter.append(result['params']['center'], timestamp)
+                    self._fitCenterError.append(result['errors']['center'], timestamp)
+                    self._fitWidth.append(result['params']['width'], timestamp)
+                    self._fitWidthError.append(result['errors']['width'], timestamp)
+                    self._publishFitDrift()
+            else:
+                # Results for an average that has been reset in the meantime
+                # are dropped
+                if generation != self._averageGeneration:
+                    return
+                self._averagedPeakData['fit'] = result
+                self._averagedPeakData['fitFailed'] = failed
+                self.snapshots['average'].publish(self._averagedPeakData)
+
+        if self.onChanged is not None:
+            self.onChanged()
+
+    def runningAverageEnabled(self):
+        return self._runningAverageEnabled
+
+    def setRunningAverageEnabled(self, enabled):
+        self._runningAverageEnabled = enabled
+
+    def _msghandler_received_startscan(self, message):
+        try:
+            self._lastscan['start'] = message.payload['starttime']
+        except:
+            self._lastscan['start'] = ""
+            pass
+        self._lastscan['stop'] = ""
+        self._lastscan['duration'] = ""
+        self.snapshots['lastScan'].publish(self._lastscan)
+
+    def _msghandler_received_donescan(self, message):
+        try:
+            self._lastscan['start'] = message.payload['starttime'].replace("_", " ")
+            self._lastscan['stop'] = message.payload['endtime'].replace("_", " ")
+
+            stime = datetime.strptime(message.payload['starttime'], "%Y-%m-%d_%H:%M:%S")
+            etime = datetime.strptime(message.payload['endtime'], "%Y-%m-%d_%H:%M:%S")
+
+            self._lastscan['duration'] = str((etime-stime).total_seconds()) + "s (" + str(etime - stime) + ")"
+            self._scanDurations.append((etime-stime).total_seconds(), etime.timestamp())
+            self._publishScanDurations()
+            if self._archive is not None:
+                self._archive.scan(stime.timestamp(), etime.timestamp())
+        except:
+            pass
+        self.snapshots['lastScan'].publish(self._lastscan)
+
+    def _msghandler_beamcurrentestimate(self, message):
+        try:
+            self._ebeamCurrentEst.append(float(message.payload['current']))
+            self._publishBeamCurrent()
+            if self._archive is not None:
+                self._archive.beamCurrent(BEAMCURRENT_ESTIMATE, float(message.payload['current']))
+        except:
+            pass
+
+    def _msghandler_beamcurrentmeasurement(self, message):
+        try:
+            self._ebeamCurrentMeas.append(float(message.payload['current']))
+            self._publishBeamCurrent()
+            if self._archive is not None:
+                self._archive.beamCurrent(BEAMCURRENT_MEASUREMENT, float(message.payload['current']))
+        except:
+            pass
+
+    def _msghandler_received_scaniteration(self, message):
+        self._pointdataClear = True
+        progress = (message.payload['i'] / message.payload['n']) * 100.0
+        if message.payload['diffscan'] and message.payload['zero']:
+            self._progress['zero'] = progress
+        else:
+            # A new signal peak restarts the zero peak as well
+            if progress == 0:
+                self._progress['zero'] = 0.0
+            self._progress['peak'] = progress
+        self.snapshots['progress'].publish(self._progress)
+
+    def _msghandler_received_pointdata(self, message):
+        if self._pointdataClear:
+            if self._lastPointData is self._pointBuffers[0]:
+                self._lastPointData = self._pointBuffers[1]
+            else:
+                self._lastPointData = self._pointBuffers[0]
+            self._lastPointData.clear()
+            self._pointIteration = self._pointIteration + 1
+            self._pointdataClear = False
+
+        if isinstance(message.payload, np.ndarray):
+            self._lastPointData.extend(message.payload)
+        elif isinstance(message.payload, list):
+            points = []
+            for payload in message.payload:
+                if isinstance(payload, np.ndarray):
+                    if (payload.ndim == 2) and (payload.shape[1] == 3):
+                        points.extend(payload.tolist())
+                    continue
+                try:
+                    points.append((payload['I'], payload['i'], payload['q']))
+                except:
+                    # Skip malformed points of a batch
+                    pass
+            if len(points) > 0:
+                self._lastPointData.extend(points)
+        else:
+            self._lastPointData.append((message.payload['I'], message.payload['i'], message.payload['q']))
+        self._publishPointData()
+
+    def _peakData(self, message):
+        # Packed matrices arrive as array, JSON as { 'payload' : [ rows ] }.
+        # Invalid payloads (i.e. ragged rows) are dropped with a warning
+        # instead of stopping the thread running the handlers
+        try:
+            if isinstance(message.payload, np.ndarray):
+                return peakMatrix(message.payload)
+            return peakMatrix(message.payload['payload'])
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning("Ignoring invalid peak data on {}: {}".format(message.topic, e))
+            return None
+
+    def _msghandler_received_peakdata(self, message):
+        data = self._peakData(message)
+        if data is None:
+            return
+        stats = peakStatistics(data)
+
+        # Update local cache ...
+        self._peakGeneration = self._peakGeneration + 1
+        self.snapshots['peak'].update(
+            I = stats['I'],
+            n = stats['n'],
+            sig = stats['sig'],
+            err = stats['err'],
+            fit = None,
+            fitFailed = False
+        )
+        if self._archive is not None:
+            self._archive.peak(PEAK_SIGNAL, data, stats)
+        self.history.append(self.snapshots['peak'].latest()[1])
+        self._submitFit('peak', stats, time.time())
+
+        # Update running average if required
+        self._runningAverageUpdate(data, False)
+
+
+    def _runningAverageInit(self):
+        self._averagedPeakData = {
+            'I' : None,
+            'sig' : None,
+            'err' : None,
+            'sigZero' : None,
+            'errZero' : None,
+            'sigDiff' : None,
+            'errDiff' : None,
+            'n' : None,
+            'fit' : None,
+            'fitFailed' : False
+        }
+        self.snapshots['average'].publish(self._averagedPeakData)
+
+        self._averageGeneration = self._averageGeneration + 1
+        if self._fitter is not None:
+            self._fitter.reset((self.name, 'average'))
+
+        grid = GridIndex(self._gridTolerance)
+        self._runningAverageData = {
+            'sig' : createAverage(self._averageMode, self._averagePeaks, grid),
+            'zero' : createAverage(self._averageMode, self._averagePeaks, grid)
+        }
+
+    def _runningAverageUpdate(self, data, isZero = False):
+        if not self._runningAverageEnabled:
+            return
+
+        accumulator = self._runningAverageData['zero' if isZero else 'sig']
+        gridSize = len(accumulator.grid)
+        if not accumulator.merge(data):
+            return
+
+        # New grid points extend the other average as well
+        updated = (('sig', 'sig', 'err'), ('zero', 'sigZero', 'errZero'))
+        if len(accumulator.grid) == gridSize:
+            updated = updated[1:] if isZero else updated[:1]
+        for name, sigKey, errKey in updated:
+            self._averagedPeakData[sigKey] = self._runningAverageData[name].signal()
+            self._averagedPeakData[errKey] = self._runningAverageData[name].error()
+        self._averagedPeakData['I'] = accumulator.grid.values
+
+        sigDiff, errDiff = peakDifference(
+            self._averagedPeakData['sig'], self._averagedPeakData['err'],
+            self._averagedPeakData['sigZero'], self._averagedPeakData['errZero']
+        )
+        self._averagedPeakData['sigDiff'] = sigDiff
+        self._averagedPeakData['errDiff'] = errDiff
+        self.snapshots['average'].publish(self._averagedPeakData)
+
+        if self._archive is not None:
+            self._archive.average(
+                PEAK_ZERO if isZero else PEAK_SIGNAL,
+                self._averagedPeakData['I'],
+                self._averagedPeakData['sigZero' if isZero else 'sig'],
+                self._averagedPeakData['errZero' if isZero else 'err'],
+                accumulator.count,
+                self._averageGeneration
+            )
+
+        if not isZero:
+            self._submitFit('average', self._averagedPeakData, time.time())
+
+
+    def _msghandler_resetandenableaverage(self, message):
+        self._runningAverageInit()
+        self._runningAverageEnabled = True
+    def _msghandler_stoprunningaverage(self, message):
+        self._runningAverageEnabled = False
+
+    def _msghandler_received_zeropeakdata(self, message):
+        data = self._peakData(message)
+        if data is None:
+            return
+        stats = peakStatistics(data)
+
+        # Calculate difference if possible
+        _, lastPeak = self.snapshots['peak'].latest()
+        sigDiff, errDiff = peakDifference(lastPeak['sig'], lastPeak['err'], stats['sig'], stats['err'])
+
+        # Update local cache ...
+        self.snapshots['peak'].update(
+            I = stats['I'],
+            n = stats['n'],
+            sigZero = stats['sig'],
+            errZero = stats['err'],
+            sigDiff = sigDiff,
+            errDiff = errDiff
+        )
+        if self._archive is not None:
+            self._archive.peak(PEAK_ZERO, data, stats)
+        self.history.append(self.snapshots['peak'].latest()[1])
+
+        # Update running average if required
+
+        self._runningAverageUpdate(data, True)
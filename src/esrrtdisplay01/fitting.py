@@ -0,0 +1,219 @@
+import multiprocessing
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Fit of the ESR resonance to the I/Q signal of a peak. I and Q are treated
+# as real and imaginary part of a complex Lorentzian
+#
+#   I + iQ = A exp(i phi) / (1 - i (B - center) / width) + (offsetI + i offsetQ)
+#
+# i.e. absorption and dispersion mixed by the detection phase. Both channels
+# are fitted together by Levenberg-Marquardt (weighted by the errors of the
+# mean if available).
+#
+# Fits run on a process pool so neither the network thread nor the GUI
+# thread blocks. Only one fit per key (i.e. experiment and last peak or
+# average) is in flight, data arriving in the meantime replaces the
+# pending data. Every fit starts from the previous result of its key.
+
+PARAMETERS = ('center', 'width', 'amplitude', 'phase', 'offsetI', 'offsetQ')
+
+def resonanceModel(B, params):
+    center, width, amplitude, phase, offsetI, offsetQ = params
+    x = (np.asarray(B, dtype = np.float64) - center) / width
+    z = amplitude * np.exp(1j * phase) / (1.0 - 1j * x) + (offsetI + 1j * offsetQ)
+    return z.real, z.imag
+
+def _residualsAndJacobian(B, data, weights, params):
+    center, width, amplitude, phase, offsetI, offsetQ = params
+    x = (B - center) / width
+    rotation = np.exp(1j * phase)
+    lorentz = 1.0 / (1.0 - 1j * x)
+    z = amplitude * rotation * lorentz + (offsetI + 1j * offsetQ)
+
+    dzdx = amplitude * rotation * 1j * lorentz * lorentz
+    derivatives = (
+        dzdx * (-1.0 / width),
+        dzdx * (-x / width),
+        rotation * lorentz,
+        1j * (z - (offsetI + 1j * offsetQ)),
+        np.ones_like(z),
+        1j * np.ones_like(z)
+    )
+
+    residuals = np.concatenate(((z - data).real, (z - data).imag)) * weights
+    jacobian = np.column_stack([ np.concatenate((d.real, d.imag)) * weights for d in derivatives ])
+    return residuals, jacobian
+
+def initialGuess(B, i, q):
+    B = np.asarray(B, dtype = np.float64)
+    z = np.asarray(i, dtype = np.float64) + 1j * np.asarray(q, dtype = np.float64)
+    offset = np.median(z.real) + 1j * np.median(z.imag)
+    peak = int(np.argmax(np.abs(z - offset)))
+    span = (B.max() - B.min()) if len(B) > 1 else 1.0
+    return np.array([
+        B[peak],
+        span / 10.0 if span > 0 else 1.0,
+        np.abs(z[peak] - offset),
+        np.angle(z[peak] - offset),
+        offset.real,
+        offset.imag
+    ])
+
+def fitResonance(B, i, q, errI = None, errQ = None, initial = None, maxIterations = 100, tolerance = 1e-8):
+    B = np.asarray(B, dtype = np.float64)
+    data = np.asarray(i, dtype = np.float64) + 1j * np.asarray(q, dtype = np.float64)
+    nPoints = len(B)
+    if nPoints < len(PARAMETERS) + 1:
+        raise ValueError("At least {} points are required to fit the resonance".format(len(PARAMETERS) + 1))
+
+    weights = np.ones(2 * nPoints)
+    if (errI is not None) and (errQ is not None):
+        sigma = np.concatenate((np.asarray(errI, dtype = np.float64), np.asarray(errQ, dtype = np.float64)))
+        if np.all(sigma > 0):
+            weights = 1.0 / sigma
+
+    params = np.array(initial, dtype = np.float64) if initial is not None else initialGuess(B, i, q)
+    residuals, jacobian = _residualsAndJacobian(B, data, weights, params)
+    chi2 = np.dot(residuals, residuals)
+    damping = 1e-3
+    converged = False
+
+    iteration = 0
+    for iteration in range(1, maxIterations + 1):
+        jtj = jacobian.T @ jacobian
+        gradient = jacobian.T @ residuals
+        try:
+            step = np.linalg.solve(jtj + damping * np.diag(np.diag(jtj) + 1e-12), -gradient)
+        except np.linalg.LinAlgError:
+            damping = damping * 10.0
+            continue
+
+        candidate = params + step
+        candidate[1] = np.abs(candidate[1]) if candidate[1] != 0 else params[1]
+        candidateResiduals, candidateJacobian = _residualsAndJacobian(B, data, weights, candidate)
+        candidateChi2 = np.dot(candidateResiduals, candidateResiduals)
+
+        if candidateChi2 < chi2:
+            improvement = (chi2 - candidateChi2) / max(chi2, 1e-300)
+            params, residuals, jacobian, chi2 = candidate, candidateResiduals, candidateJacobian, candidateChi2
+            damping = max(damping / 10.0, 1e-12)
+            if improvement < tolerance:
+                converged = True
+                break
+        else:
+            damping = damping * 10.0
+            if damping > 1e12:
+                # No further improvement possible
+                converged = True
+                break
+
+    params[3] = np.angle(np.exp(1j * params[3]))
+    dof = max(1, 2 * nPoints - len(PARAMETERS))
+    reducedChi2 = chi2 / dof
+    try:
+        covariance = np.linalg.inv(jacobian.T @ jacobian) * reducedChi2
+        errors = np.sqrt(np.abs(np.diag(covariance)))
+    except np.linalg.LinAlgError:
+        errors = np.full(len(PARAMETERS), np.nan)
+
+    return {
+        'params' : dict(zip(PARAMETERS, params.tolist())),
+        'errors' : dict(zip(PARAMETERS, errors.tolist())),
+        'chi2' : float(reducedChi2),
+        'iterations' : iteration,
+        'converged' : converged
+    }
+
+def _fitWorker(B, i, q, errI, errQ, initial):
+    # Warm start from the previous result if its center is still inside the
+    # scanned range, otherwise (or if that doesn't converge) from scratch
+    if (initial is not None) and (np.min(B) <= initial[0] <= np.max(B)):
+        result = fitResonance(B, i, q, errI, errQ, initial = initial)
+        if result['converged']:
+            result['warmStart'] = True
+            return result
+    result = fitResonance(B, i, q, errI, errQ)
+    result['warmStart'] = False
+    return result
+
+class ResonanceFitter:
+    def __init__(self, workers = 1):
+        self._workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+        self._running = set()
+        self._futures = set()
+        self._pending = {}
+        self._previous = {}
+        self._closed = False
+
+    def submit(self, key, B, i, q, errI, errQ, callback):
+        # callback(result) is called from a thread of the pool once the fit
+        # has finished (result is None if the fit failed). Fits cancelled by
+        # close() don't call back
+        job = (np.array(B, dtype = np.float64), np.array(i, dtype = np.float64), np.array(q, dtype = np.float64),
+            None if errI is None else np.array(errI, dtype = np.float64), None if errQ is None else np.array(errQ, dtype = np.float64), callback)
+        with self._lock:
+            if self._closed:
+                return
+            if key in self._running:
+                self._pending[key] = job
+                return
+            self._running.add(key)
+        self._start(key, job)
+
+    def _start(self, key, job):
+        B, i, q, errI, errQ, callback = job
+        with self._lock:
+            if self._closed:
+                return
+            if self._pool is None:
+                # Workers are spawned (not forked from a process running Tk
+                # and several threads) and only import numpy and this module
+                self._pool = ProcessPoolExecutor(max_workers = self._workers, mp_context = multiprocessing.get_context('spawn'))
+            initial = self._previous.get(key)
+            future = self._pool.submit(_fitWorker, B, i, q, errI, errQ, initial)
+            self._futures.add(future)
+        future.add_done_callback(lambda future: self._finished(key, callback, future))
+
+    def _finished(self, key, callback, future):
+        try:
+            result = future.result()
+        except Exception:
+            result = None
+
+        with self._lock:
+            self._futures.discard(future)
+            if result is not None:
+                self._previous[key] = np.array([ result['params'][name] for name in PARAMETERS ])
+            else:
+                self._previous.pop(key, None)
+            job = self._pending.pop(key, None)
+            if (job is None) or self._closed:
+                self._running.discard(key)
+
+        if not future.cancelled():
+            callback(result)
+        if (job is not None) and not self._closed:
+            self._start(key, job)
+
+    def reset(self, key):
+        with self._lock:
+            self._previous.pop(key, None)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            pool = self._pool
+            self._pool = None
+            futures = list(self._futures)
+        # Fits that haven't started yet are cancelled, running ones finish
+        # in the background
+        for future in futures:
+            future.cancel()
+        if pool is not None:
+            pool.shutdown(wait = False)
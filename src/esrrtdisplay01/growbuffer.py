@@ -0,0 +1,45 @@
+import numpy as np
+
+# Preallocated row storage that grows geometrically. clear() only resets the
+# fill level so the allocated memory is reused for the next scan iteration.
+# view() returns the filled rows without copying; rows that are part of a
+# view are never written again until clear() is called.
+
+class GrowableBuffer:
+    def __init__(self, columns, initialCapacity = 1024, dtype = np.float64):
+        self._data = np.empty((max(1, initialCapacity), columns), dtype = dtype)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def capacity(self):
+        return self._data.shape[0]
+
+    def _reserve(self, required):
+        if required <= self._data.shape[0]:
+            return
+        newCapacity = self._data.shape[0]
+        while newCapacity < required:
+            newCapacity = newCapacity * 2
+        newData = np.empty((newCapacity, self._data.shape[1]), dtype = self._data.dtype)
+        newData[:self._count] = self._data[:self._count]
+        self._data = newData
+
+    def append(self, row):
+        self._reserve(self._count + 1)
+        self._data[self._count] = row
+        self._count = self._count + 1
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype = self._data.dtype)
+        self._reserve(self._count + rows.shape[0])
+        self._data[self._count:self._count + rows.shape[0]] = rows
+        self._count = self._count + rows.shape[0]
+
+    def clear(self):
+        self._count = 0
+
+    def view(self):
+        return self._data[:self._count]
@@ -0,0 +1,119 @@
+import argparse
+import json
+import logging
+import os
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from esrrtdisplay01.esrrtdisplay01 import QUAKESRRealtimeDisplay
+from esrrtdisplay01.recorder import LOG_MAGIC, MessageLogReader
+from esrrtdisplay01.simmessages import simMessages
+
+# Headless batch rendering of recorded sessions. Every recorded message is
+# fed through the same handlers the realtime display uses, afterwards all
+# figures are rendered with Agg and written to image files. Runs are
+# distributed over a process pool.
+#
+# Recorded streams are either message logs written by the display (see
+# recorder.py) or JSON lines files, one message per line:
+#
+#   { "topic" : "quakesr/experiment/scan/peak/peakdata", "timestamp" : 1700000000.0, "payload" : { ... } }
+#
+# The payload may either be the decoded JSON object or the raw payload string.
+
+SIMULATION = "sim"
+
+def readMessageStream(source, basetopic):
+    if source == SIMULATION:
+        # Alternate signal and zero peaks from the simulation fixtures
+        if basetopic[-1] != '/':
+            basetopic = basetopic + "/"
+        for i, msg in enumerate(simMessages):
+            topic = "scan/peak/peakdata" if (i % 2) == 0 else "scan/peak/zeropeakdata"
+            yield basetopic + topic, msg
+        return
+
+    with open(source, 'rb') as f:
+        isMessageLog = (f.read(len(LOG_MAGIC)) == LOG_MAGIC)
+    if isMessageLog:
+        with MessageLogReader(source) as reader:
+            for _, topic, payload in reader:
+                yield topic, payload
+        return
+
+    with open(source) as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            entry = json.loads(line)
+            yield entry['topic'], entry['payload']
+
+def runName(source):
+    if source == SIMULATION:
+        return SIMULATION
+    return os.path.splitext(os.path.basename(source))[0]
+
+def renderRun(source, outputDirectory, basetopic, formats = ('png',), plotsize = (640, 480), dpi = None):
+    display = QUAKESRRealtimeDisplay(
+        {
+            'broker' : '',
+            'port' : 0,
+            'user' : '',
+            'pass' : '',
+            'basetopic' : basetopic
+        },
+        plotsize = plotsize,
+        blit = False
+    )
+
+    nMessages = 0
+    for topic, payload in readMessageStream(source, basetopic):
+        display.feedMessage(topic, payload)
+        nMessages = nMessages + 1
+
+    figures = display.createFigures()
+    display.redrawAll()
+
+    runDirectory = os.path.join(outputDirectory, runName(source))
+    os.makedirs(runDirectory, exist_ok = True)
+
+    files = []
+    for figName, plot in figures.items():
+        for fmt in formats:
+            fileName = os.path.join(runDirectory, "{}.{}".format(figName, fmt))
+            plot.figure.savefig(fileName, format = fmt, dpi = dpi)
+            files.append(fileName)
+
+    return { 'source' : source, 'messages' : nMessages, 'files' : files }
+
+def main():
+    parser = argparse.ArgumentParser(description = "Render recorded QUAK/ESR sessions to image files without display")
+    parser.add_argument('sources', nargs = '+', help = f"Recorded message logs, JSON lines files or '{SIMULATION}' for the built in simulation messages")
+    parser.add_argument('--output', default = '.', help = "Output directory, one subdirectory is created per run")
+    parser.add_argument('--basetopic', default = 'quakesr/experiment', help = "Base topic the recorded messages have been published under")
+    parser.add_argument('--format', dest = 'formats', nargs = '+', default = [ 'png' ], choices = [ 'png', 'svg', 'pdf' ])
+    parser.add_argument('--size', type = int, nargs = 2, default = [ 640, 480 ], metavar = ('WIDTH', 'HEIGHT'), help = "Figure size in pixels")
+    parser.add_argument('--dpi', type = float, default = None)
+    parser.add_argument('--jobs', type = int, default = None, help = "Number of worker processes (default: number of CPUs)")
+    args = parser.parse_args()
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers = args.jobs) as pool:
+        futures = {
+            pool.submit(renderRun, source, args.output, args.basetopic, tuple(args.formats), tuple(args.size), args.dpi) : source
+            for source in args.sources
+        }
+        for future in as_completed(futures):
+            try:
+                res = future.result()
+                print("{}: {} messages, {} files".format(res['source'], res['messages'], len(res['files'])))
+            except Exception as e:
+                logging.error("Failed to render {}: {}".format(futures[future], e))
+                failed = failed + 1
+
+    if failed > 0:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
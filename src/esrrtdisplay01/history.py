@@ -0,0 +1,181 @@
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+import numpy as np
+
+from esrrtdisplay01.archive import ArchiveReader, PEAK_SIGNAL, PEAK_ZERO
+from esrrtdisplay01.peakstats import peakDifference
+
+# History of the "Last peak" state (signal, zero and difference) after every
+# received peak. Entries are numbered like the peaks in the archive so the
+# history continues seamlessly into previous sessions if an archive is
+# configured.
+#
+# Recent entries are kept in memory in a least recently used cache bounded
+# by the number of entries and their size. Every entry is packed into one
+# float32 array (rows I, signal, error, zero, zero error, difference,
+# difference error). Entries that have been evicted are rebuilt from the
+# archive on demand. Without archive they are lost, so the oldest entries
+# are evicted first and the browsable range starts after them.
+#
+# The archive is only opened on the first lookup that misses the cache
+# (archivedPeaks, the number of peaks archived before the first appended
+# one, is then known from the writer). If it can't be read the entry is
+# not available and the error is kept in archiveError.
+
+_FIELDS = (
+    ('sig', 'i'), ('sig', 'q'),
+    ('err', 'i'), ('err', 'q'),
+    ('sigZero', 'i'), ('sigZero', 'q'),
+    ('errZero', 'i'), ('errZero', 'q'),
+    ('sigDiff', 'i'), ('sigDiff', 'q'),
+    ('errDiff', 'i'), ('errDiff', 'q')
+)
+
+def _pack(peak, timestamp):
+    nPoints = len(peak['I'])
+    data = np.full((1 + len(_FIELDS), nPoints), np.nan, dtype = np.float32)
+    data[0] = peak['I']
+    present = []
+    for row, (name, channel) in enumerate(_FIELDS):
+        if (peak[name] is not None) and (peak[name][channel] is not None) and (len(peak[name][channel]) == nPoints):
+            data[1 + row] = peak[name][channel]
+            present.append(True)
+        else:
+            present.append(False)
+    data.flags.writeable = False
+    return { 'timestamp' : timestamp, 'n' : peak['n'], 'data' : data, 'present' : tuple(present) }
+
+def _unpack(entry):
+    data = entry['data']
+    peak = { 'I' : data[0], 'n' : entry['n'], 'timestamp' : entry['timestamp'] }
+    for row, (name, channel) in enumerate(_FIELDS):
+        if name not in peak:
+            peak[name] = {}
+        peak[name][channel] = data[1 + row] if entry['present'][row] else None
+    for name in ('sig', 'err', 'sigZero', 'errZero', 'sigDiff', 'errDiff'):
+        if peak[name]['i'] is None:
+            peak[name] = None
+    return peak
+
+class PeakHistory:
+    def __init__(self, maxEntries = 500, maxBytes = 64 * 1024 * 1024, archiveDirectory = None, archiveLookback = 64, archivedPeaks = None):
+        self._maxEntries = maxEntries
+        self._maxBytes = maxBytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+        self._archiveDirectory = archiveDirectory
+        self._archive = None
+        self._archiveLookback = archiveLookback
+        self.archiveError = None
+        self._first = 0
+        if archiveDirectory is not None:
+            self._first = archivedPeaks if archivedPeaks is not None else len(self._openArchive())
+        self._next = self._first
+
+    def _openArchive(self):
+        if self._archive is None:
+            self._archive = ArchiveReader(self._archiveDirectory)
+        return self._archive
+
+    def range(self):
+        # Indices of the entries that can be browsed (first, end)
+        return (0 if self._archiveDirectory is not None else self._first, self._next)
+
+    def __len__(self):
+        return self._next
+
+    def append(self, peak, timestamp = None):
+        # Called by the handlers after every peak (the same order peaks are
+        # archived in)
+        entry = _pack(peak, time.time() if timestamp is None else timestamp)
+        with self._lock:
+            index = self._next
+            self._next = self._next + 1
+            self._insert(index, entry)
+        return index
+
+    def _insert(self, index, entry):
+        if index in self._entries:
+            return
+        self._entries[index] = entry
+        self._bytes = self._bytes + entry['data'].nbytes
+        while (len(self._entries) > self._maxEntries) or ((self._bytes > self._maxBytes) and (len(self._entries) > 1)):
+            evictedIndex, evicted = self._entries.popitem(last = False)
+            self._bytes = self._bytes - evicted['data'].nbytes
+            if self._archiveDirectory is None:
+                self._first = max(self._first, evictedIndex + 1)
+
+    def get(self, index):
+        # Returns the peak state after the given peak or None if it's not
+        # available (evicted without archive or not yet written to disk)
+        with self._lock:
+            entry = self._entries.get(index)
+            if entry is not None:
+                if self._archiveDirectory is not None:
+                    self._entries.move_to_end(index)
+                return _unpack(entry)
+
+        # Archive access happens outside the lock so handlers appending new
+        # entries never wait for the disk
+        if self._archiveDirectory is None:
+            return None
+        try:
+            peak = self._fromArchive(index)
+        except OSError as e:
+            logging.warning("Failed to read peak {} from archive {}: {}".format(index, self._archiveDirectory, e))
+            self.archiveError = str(e)
+            return None
+        self.archiveError = None
+        if peak is None:
+            return None
+        entry = _pack(peak, peak['timestamp'])
+        with self._lock:
+            self._insert(index, entry)
+        return _unpack(entry)
+
+    def _fromArchive(self, index):
+        archive = self._openArchive()
+        if index >= len(archive):
+            archive.refresh()
+            if index >= len(archive):
+                return None
+
+        # The state after peak 'index' consists of the latest signal and
+        # zero peak up to then and the difference calculated when that zero
+        # peak arrived
+        signal = None
+        zero = None
+        zeroSignal = None
+        for i in range(index, max(-1, index - self._archiveLookback), -1):
+            record = archive.peak(i)
+            if record['kind'] == PEAK_SIGNAL:
+                if signal is None:
+                    signal = record
+                if (zero is not None) and (zeroSignal is None):
+                    zeroSignal = record
+            elif (record['kind'] == PEAK_ZERO) and (zero is None):
+                zero = record
+            if (signal is not None) and (zero is not None) and (zeroSignal is not None):
+                break
+
+        latest = archive.peak(index)
+        peak = {
+            'timestamp' : latest['timestamp'],
+            'I' : latest['I'],
+            'n' : latest['n'],
+            'sig' : signal['sig'] if signal is not None else None,
+            'err' : signal['err'] if signal is not None else None,
+            'sigZero' : zero['sig'] if zero is not None else None,
+            'errZero' : zero['err'] if zero is not None else None,
+            'sigDiff' : None,
+            'errDiff' : None
+        }
+        if (zero is not None) and (zeroSignal is not None):
+            peak['sigDiff'], peak['errDiff'] = peakDifference(zeroSignal['sig'], zeroSignal['err'], zero['sig'], zero['err'])
+        return peak
@@ -0,0 +1,277 @@
+import asyncio
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import paho.mqtt.client as mqtt
+
+from esrrtdisplay01.diagnostics import LatencyHistogram
+from esrrtdisplay01.mailbox import CoalescingMailbox
+
+# asyncio based ingestion of MQTT messages as alternative to paho's own
+# network thread (loop_start).
+#
+# The paho client is driven by an event loop running in its own thread: the
+# socket is registered with add_reader / add_writer and loop_read,
+# loop_write and loop_misc are called by the event loop. Received messages
+# pass through a pipeline of three stages that run concurrently:
+#
+#   receive (event loop)  ->  prepare (decode, route, record; one thread)
+#                         ->  handle (handlers and statistics; one thread)
+#
+# Each stage works on one message at a time, so messages are still handled
+# in the order they have been received. The receive queue is bounded: once
+# it holds queueSize messages the socket is no longer read until it has
+# drained to resumeSize. The broker then sees TCP backpressure instead of
+# the network loop stalling inside a handler (pings and acknowledgements are
+# still sent while paused). A message that is already being parsed when the
+# limit is reached is still queued.
+#
+# Prepared messages wait for the handlers in a coalescing mailbox (see
+# mailbox.py) that holds at most queueSize messages. Topics with a policy
+# are coalesced while the handlers are busy: of LATEST topics only the
+# newest message is handled, runs of BATCH topics are merged into a single
+# message by mergeBatch(items). Each batch is handled as one message, the
+# number of merged and dropped messages per topic is part of the statistics.
+
+class AsyncIngestion:
+    def __init__(self, client, prepare, handle, queueSize = 256, resumeSize = None, policies = None, mergeBatch = None):
+        # prepare(msg, receivedAt) returns the prepared message (or None if
+        # it should be ignored), handle(prepared) runs the handlers. policies
+        # maps topics to (policy, group) for the mailbox
+        self._client = client
+        self._prepare = prepare
+        self._handle = handle
+        self._queueSize = queueSize
+        self._resumeSize = resumeSize if resumeSize is not None else queueSize // 2
+        self._mergeBatch = mergeBatch
+        self._mailbox = CoalescingMailbox(policies if policies is not None else {}, self._mergeItems, maxPending = queueSize)
+
+        self._loop = None
+        self._thread = None
+        self._stopEvent = None
+        self._socket = None
+        self._paused = False
+
+        self._lock = threading.Lock()
+        self._received = 0
+        self._handled = 0
+        self._queueLength = 0
+        self._queueHighWater = 0
+        self._pauses = 0
+        self._pausedSeconds = 0.0
+        self._pausedSince = None
+        self._queueWait = LatencyHistogram()
+
+        self._prepareExecutor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "ingestPrepare")
+        self._handleExecutor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "ingestHandle")
+
+        client.on_message = self._on_message
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def start(self, broker, port, wrapThread = None):
+        # Connects (blocking, errors are raised to the caller like with
+        # loop_start) and runs the event loop in a new thread. wrapThread
+        # optionally wraps the thread target (profiling)
+        self._loop = asyncio.new_event_loop()
+        self._client.connect(broker, port)
+
+        target = self._run if wrapThread is None else wrapThread(self._run)
+        self._thread = threading.Thread(target = target, daemon = True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._loop.call_soon_threadsafe(self._requestStop)
+        self._thread.join()
+        self._thread = None
+        self._prepareExecutor.shutdown(wait = True)
+        self._handleExecutor.shutdown(wait = True)
+
+    def _requestStop(self):
+        self._stopEvent.set()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._stopEvent = asyncio.Event()
+        self._queue = asyncio.Queue()
+        self._mailboxReady = asyncio.Event()
+        self._mailboxSpace = asyncio.Event()
+        try:
+            self._loop.run_until_complete(self._main())
+        finally:
+            self._loop.close()
+
+    # Socket callbacks of paho. They're usually called on the event loop
+    # thread, but subscribing from another thread (or connecting before the
+    # loop runs) registers the socket from there
+
+    def _inLoop(self, callback, *args):
+        if self._thread is threading.current_thread():
+            callback(*args)
+        else:
+            self._loop.call_soon_threadsafe(callback, *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._inLoop(self._socketOpened, sock)
+
+    def _socketOpened(self, sock):
+        self._socket = sock
+        if not self._paused:
+            self._loop.add_reader(sock, self._readable)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._inLoop(self._socketClosed, sock)
+
+    def _socketClosed(self, sock):
+        self._loop.remove_reader(sock)
+        self._loop.remove_writer(sock)
+        if self._socket is sock:
+            self._socket = None
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._inLoop(self._loop.add_writer, sock, self._writable)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._inLoop(self._loop.remove_writer, sock)
+
+    def _readable(self):
+        self._client.loop_read()
+
+    def _writable(self):
+        self._client.loop_write()
+
+    # Backpressure
+
+    def _pause(self):
+        self._paused = True
+        if self._socket is not None:
+            self._loop.remove_reader(self._socket)
+        with self._lock:
+            self._pauses = self._pauses + 1
+            self._pausedSince = time.monotonic()
+
+    def _resume(self):
+        self._paused = False
+        if self._socket is not None:
+            self._loop.add_reader(self._socket, self._readable)
+        with self._lock:
+            self._pausedSeconds = self._pausedSeconds + (time.monotonic() - self._pausedSince)
+            self._pausedSince = None
+
+    def _on_message(self, client, userdata, msg):
+        # Called from loop_read on the event loop thread
+        self._queue.put_nowait((msg, time.monotonic()))
+        with self._lock:
+            self._received = self._received + 1
+            self._queueLength = self._queue.qsize()
+            self._queueHighWater = max(self._queueHighWater, self._queueLength)
+        if (not self._paused) and (self._queue.qsize() >= self._queueSize):
+            self._pause()
+
+    # Pipeline stages
+
+    def _mergeItems(self, items):
+        # Items in the mailbox carry their receive time, a batch keeps the
+        # oldest one
+        return (self._mergeBatch([ prepared for prepared, _ in items ]), items[0][1])
+
+    async def _prepareStage(self):
+        while True:
+            msg, receivedAt = await self._queue.get()
+            if self._paused and (self._queue.qsize() <= self._resumeSize):
+                self._resume()
+            with self._lock:
+                self._queueLength = self._queue.qsize()
+
+            try:
+                prepared = await self._loop.run_in_executor(self._prepareExecutor, self._prepare, msg, receivedAt)
+            except Exception as e:
+                logging.exception("Failed to prepare message: {}".format(e))
+                prepared = None
+            if prepared is None:
+                with self._lock:
+                    self._handled = self._handled + 1
+                continue
+
+            # If the handlers fall behind the mailbox fills up, then the
+            # receive queue and finally reading pauses
+            while self._mailbox.full():
+                self._mailboxSpace.clear()
+                await self._mailboxSpace.wait()
+            with self._lock:
+                self._mailbox.put(msg.topic, (prepared, receivedAt))
+            self._mailboxReady.set()
+
+    async def _handleStage(self):
+        while True:
+            await self._mailboxReady.wait()
+            self._mailboxReady.clear()
+            with self._lock:
+                items = self._mailbox.take()
+            self._mailboxSpace.set()
+
+            for prepared, receivedAt in items:
+                with self._lock:
+                    self._queueWait.add(time.monotonic() - receivedAt)
+                try:
+                    await self._loop.run_in_executor(self._handleExecutor, self._handle, prepared)
+                except Exception as e:
+                    logging.exception("Failed to handle message: {}".format(e))
+                with self._lock:
+                    self._handled = self._handled + 1
+
+    async def _misc(self):
+        # Keepalive and reconnects (loop_forever / loop_start would reconnect
+        # by themselves)
+        retryDelay = 1.0
+        while True:
+            if self._client.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+                await asyncio.sleep(retryDelay)
+                try:
+                    await self._loop.run_in_executor(None, self._client.reconnect)
+                    retryDelay = 1.0
+                except (OSError, ValueError) as e:
+                    logging.warning("Reconnecting failed: {}".format(e))
+                    retryDelay = min(2 * retryDelay, 30.0)
+                continue
+            await asyncio.sleep(1.0)
+
+    async def _main(self):
+        tasks = [ asyncio.ensure_future(task) for task in (self._prepareStage(), self._handleStage(), self._misc()) ]
+
+        await self._stopEvent.wait()
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions = True)
+        self._client.disconnect()
+        if self._socket is not None:
+            self._client.loop_write()
+
+    def statistics(self):
+        with self._lock:
+            pausedSeconds = self._pausedSeconds
+            if self._pausedSince is not None:
+                pausedSeconds = pausedSeconds + (time.monotonic() - self._pausedSince)
+            mailbox = self._mailbox.statistics()
+            return {
+                'received' : self._received,
+                'handled' : self._handled,
+                'queueLength' : self._queueLength,
+                'queueHighWater' : self._queueHighWater,
+                'queueSize' : self._queueSize,
+                'paused' : self._pausedSince is not None,
+                'pauses' : self._pauses,
+                'pausedSeconds' : pausedSeconds,
+                'pending' : mailbox['pending'],
+                'merged' : mailbox['merged'],
+                'dropped' : mailbox['dropped'],
+                'queueWait' : self._queueWait.summary()
+            }
@@ -0,0 +1,83 @@
+from collections import deque
+
+# Messages waiting to be handled, coalesced per topic:
+#
+#   LATEST   only the newest pending message of the topic is handled, older
+#            ones are dropped (progress and other state messages)
+#   BATCH    pending messages of the topic are handled together as one
+#            message (accumulating topics such as point data)
+#
+# Messages of other topics are queued as they are. Coalescing never changes
+# the order of messages of one group (i.e. experiment): a message is only
+# merged into the newest pending entry of its group, so a run of point data
+# is never merged across a scan iteration that clears the points. Messages
+# of topics without policy are ordering barriers for all groups.
+#
+# The mailbox holds at most maxPending messages (dropped ones don't count).
+# It is not thread safe, callers have to serialize access.
+
+LATEST = 'latest'
+BATCH = 'batch'
+
+class CoalescingMailbox:
+    def __init__(self, policies, mergeBatch, maxPending = 256):
+        # policies maps topics to (policy, group), mergeBatch(items) merges
+        # the items of a batch into one item
+        self._policies = policies
+        self._mergeBatch = mergeBatch
+        self._maxPending = maxPending
+        self._pending = 0
+        self._entries = deque()
+        self._lastOfGroup = {}
+        self._merged = {}
+        self._dropped = {}
+
+    def __len__(self):
+        return self._pending
+
+    def full(self):
+        return self._pending >= self._maxPending
+
+    def put(self, topic, item):
+        policy, group = self._policies.get(topic, (None, None))
+        if policy is None:
+            self._entries.append([ None, topic, [ item ] ])
+            self._pending = self._pending + 1
+            self._lastOfGroup = {}
+            return
+
+        last = self._lastOfGroup.get(group)
+        if (last is not None) and (last[1] == topic):
+            if policy == LATEST:
+                last[2][0] = item
+                self._dropped[topic] = self._dropped.get(topic, 0) + 1
+            else:
+                last[2].append(item)
+                self._pending = self._pending + 1
+                self._merged[topic] = self._merged.get(topic, 0) + 1
+            return
+
+        entry = [ policy, topic, [ item ] ]
+        self._entries.append(entry)
+        self._pending = self._pending + 1
+        self._lastOfGroup[group] = entry
+
+    def take(self):
+        # All pending items in order (batches merged into one item each)
+        items = []
+        while len(self._entries) > 0:
+            policy, _, entryItems = self._entries.popleft()
+            if (policy == BATCH) and (len(entryItems) > 1):
+                items.append(self._mergeBatch(entryItems))
+            else:
+                items.append(entryItems[0])
+        self._pending = 0
+        self._lastOfGroup = {}
+        return items
+
+    def statistics(self):
+        return {
+            'pending' : self._pending,
+            'merged' : dict(self._merged),
+            'dropped' : dict(self._dropped)
+        }
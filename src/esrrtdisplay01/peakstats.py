@@ -0,0 +1,385 @@
+import numpy as np
+
+# Peak messages carry a matrix with one row per current point:
+#
+#   [ I, i_1, ..., i_n, q_1, ..., q_n ]
+#
+# All statistics are calculated in one batched pass over this matrix
+# instead of iterating over points and iterations in Python.
+
+def peakMatrix(payload):
+    data = np.asarray(payload, dtype = np.float64)
+    if (data.ndim != 2) or (data.shape[1] < 1):
+        raise ValueError("Peak payload has to be a matrix with at least one column")
+    return data
+
+def peakSamples(data):
+    # Returns a view of shape (points, 2, n) - channel 0 is I, channel 1 is Q
+    n = int((data.shape[1] - 1) / 2)
+    return data[:, 1:1 + 2*n].reshape(data.shape[0], 2, n)
+
+def peakStatistics(payload):
+    data = peakMatrix(payload)
+    samples = peakSamples(data)
+    n = samples.shape[2]
+
+    if n > 0:
+        mean = samples.mean(axis = 2)
+    else:
+        mean = np.zeros((data.shape[0], 2))
+
+    err = { 'i' : None, 'q' : None }
+    if n > 1:
+        std = samples.std(axis = 2)
+        err = { 'i' : std[:, 0], 'q' : std[:, 1] }
+
+    return {
+        'I' : data[:, 0],
+        'n' : n,
+        'sig' : { 'i' : mean[:, 0], 'q' : mean[:, 1] },
+        'err' : err
+    }
+
+def peakDifference(sig, err, sigZero, errZero):
+    # Difference signal - zero signal with errors propagated in quadrature.
+    # Returns (None, None) difference dictionaries if the grids don't fit
+    sigDiff = { 'i' : None, 'q' : None }
+    errDiff = { 'i' : None, 'q' : None }
+
+    if (sig is None) or (sigZero is None) or (sig['i'] is None) or (sigZero['i'] is None):
+        return sigDiff, errDiff
+    if (len(sig['i']) != len(sigZero['i'])) or (len(sig['q']) != len(sigZero['q'])):
+        return sigDiff, errDiff
+
+    sigDiff = {
+        'i' : np.subtract(sig['i'], sigZero['i']),
+        'q' : np.subtract(sig['q'], sigZero['q'])
+    }
+
+    if (err is not None) and (err['i'] is not None) and (errZero is not None) and (errZero['i'] is not None):
+        errDiff = {
+            'i' : np.hypot(err['i'], errZero['i']),
+            'q' : np.hypot(err['q'], errZero['q'])
+        }
+
+    return sigDiff, errDiff
+
+class GridIndex:
+    # Sorted index of the current (B0) grid points seen by an average.
+    # Points of incoming peaks are matched to the nearest known grid point by
+    # binary search, points that are farther than 'tolerance' from every
+    # known point are inserted. Coarse and fine sweeps (or shifted grids)
+    # thus end up on one common grid. Without explicit tolerance it's one
+    # percent of the median step of the first peak with at least two
+    # distinct points. Until then only points equal within rounding (a
+    # relative 1e-9) are matched.
+    #
+    # Grid points are only ever inserted, never moved or removed - the
+    # accumulators sharing an index expand their per point state when the
+    # grid has grown (see _GridAverage).
+
+    def __init__(self, tolerance = None):
+        self.tolerance = tolerance
+        self.values = np.empty(0)
+
+    def __len__(self):
+        return len(self.values)
+
+    def _nearest(self, points):
+        # Index of the nearest grid point and the distance to it
+        right = np.clip(np.searchsorted(self.values, points), 0, len(self.values) - 1)
+        left = np.clip(right - 1, 0, len(self.values) - 1)
+        useLeft = np.abs(points - self.values[left]) < np.abs(points - self.values[right])
+        nearest = np.where(useLeft, left, right)
+        return nearest, np.abs(points - self.values[nearest])
+
+    def positions(self, points):
+        points = np.asarray(points, dtype = np.float64)
+
+        # Usual case - the same grid as before
+        if np.array_equal(points, self.values):
+            return np.arange(len(points))
+
+        tolerance = self.tolerance
+        if tolerance is None:
+            steps = np.diff(np.unique(points))
+            if len(steps) > 0:
+                self.tolerance = tolerance = 0.01 * float(np.median(steps))
+            else:
+                tolerance = 1e-9 * max(1.0, float(np.max(np.abs(points)))) if len(points) > 0 else 0.0
+
+        if len(self.values) > 0:
+            _, distance = self._nearest(points)
+            unmatched = points[distance > tolerance]
+        else:
+            unmatched = points
+
+        if len(unmatched) > 0:
+            # New points closer than the tolerance to each other are merged
+            unmatched = np.sort(unmatched)
+            unmatched = unmatched[np.concatenate(([ True ], np.diff(unmatched) > tolerance))]
+            self.values = np.insert(self.values, np.searchsorted(self.values, unmatched), unmatched)
+
+        nearest, _ = self._nearest(points)
+        return nearest
+
+def _uniqueRounds(positions, gridSize):
+    # Splits the rows of a peak into rounds (rows, grid points) that don't
+    # hit the same grid point twice. Usually there is only one round, a peak
+    # covering the whole grid in order is handled by plain slices
+    if (len(positions) < 2) or np.all(positions[1:] > positions[:-1]):
+        yield slice(None), (slice(None) if len(positions) == gridSize else positions)
+        return
+    remaining = np.arange(len(positions))
+    while len(remaining) > 0:
+        _, first = np.unique(positions[remaining], return_index = True)
+        yield remaining[first], positions[remaining[first]]
+        remaining = np.delete(remaining, first)
+
+class _GridAverage:
+    # Common part of the averages: per point state lives on the grid of a
+    # (possibly shared) GridIndex. Arrays listed in _pointArrays (with the
+    # grid axis given) are expanded with zeros when the grid has grown.
+    # Points without any samples yet report NaN.
+
+    _pointArrays = ()
+
+    def __init__(self, grid = None):
+        self.grid = grid if grid is not None else GridIndex()
+        self.reset()
+
+    def reset(self):
+        self.I = None
+        self.count = 0
+        self._values = np.empty(0)
+        self.counts = np.zeros(0, dtype = np.int64)
+        for name, axis, shape in self._pointArrays:
+            setattr(self, name, np.zeros(shape[:axis] + (0,) + shape[axis:]))
+
+    def _sync(self):
+        if len(self._values) == len(self.grid):
+            return
+        rows = np.searchsorted(self.grid.values, self._values)
+        for name, axis in [ ('counts', 0) ] + [ (name, axis) for name, axis, _ in self._pointArrays ]:
+            old = getattr(self, name)
+            shape = list(old.shape)
+            shape[axis] = len(self.grid)
+            new = np.zeros(shape, dtype = old.dtype)
+            index = [ slice(None) ] * len(shape)
+            index[axis] = rows
+            new[tuple(index)] = old
+            setattr(self, name, new)
+        self._values = self.grid.values
+        if self.count > 0:
+            self.I = self._values
+
+    def _match(self, data):
+        positions = self.grid.positions(data[:, 0])
+        self._sync()
+        self.I = self._values
+        return positions
+
+    def _channels(self, values):
+        values = np.where(self.counts[:, np.newaxis] > 0, values, np.nan)
+        return { 'i' : values[:, 0], 'q' : values[:, 1] }
+
+    def signal(self):
+        if self.count == 0:
+            return None
+        self._sync()
+        return self._channels(self._mean())
+
+    def error(self):
+        if self.count == 0:
+            return None
+        self._sync()
+        return self._channels(self._error())
+
+class RunningAverage(_GridAverage):
+    # Running mean and second central moment (M2) per grid point and
+    # channel. Every peak message is merged as one batch using the parallel
+    # variance combination (Chan et al.) so the cost per message only depends
+    # on the number of points, not on the number of samples seen so far.
+
+    _pointArrays = (('mean', 0, (2,)), ('m2', 0, (2,)))
+
+    def merge(self, data):
+        samples = peakSamples(data)
+        nNew = samples.shape[2]
+        if nNew == 0:
+            return False
+
+        positions = self._match(data)
+        batchMean = samples.mean(axis = 2)
+        batchM2 = np.square(samples - batchMean[:, :, np.newaxis]).sum(axis = 2)
+
+        # New arrays - signal and error handed out before stay unchanged
+        mean = self.mean.copy()
+        m2 = self.m2.copy()
+        counts = self.counts.copy()
+        for rows, target in _uniqueRounds(positions, len(self.grid)):
+            nOld = counts[target][:, np.newaxis]
+            nTotal = nOld + nNew
+            delta = batchMean[rows] - mean[target]
+            mean[target] = mean[target] + delta * (nNew / nTotal)
+            m2[target] = m2[target] + batchM2[rows] + np.square(delta) * (nOld * nNew / nTotal)
+            counts[target] = counts[target] + nNew
+
+        self.mean = mean
+        self.m2 = m2
+        self.counts = counts
+        self.count = self.count + nNew * len(positions)
+        return True
+
+    def _mean(self):
+        return self.mean
+
+    def _error(self):
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            return np.sqrt(self.m2 / self.counts[:, np.newaxis])
+
+class SlidingAverage(_GridAverage):
+    # Mean and standard deviation over all samples of the last 'window'
+    # peaks. Sample count, sum and sum of squares per grid point of every
+    # peak are kept in an array ring buffer - a new peak is added to the
+    # window totals and the peak falling out of the window subtracted, so
+    # the cost per message doesn't depend on the window size. Sums are taken
+    # relative to the first mean seen at each point to avoid cancellation,
+    # the totals are rebuilt from the ring once per window to keep rounding
+    # errors from accumulating.
+
+    def __init__(self, window, grid = None):
+        if window < 1:
+            raise ValueError("Sliding average window has to be at least one peak")
+        self.window = window
+        self._pointArrays = (
+            ('_shift', 0, (2,)),
+            ('_totalSum', 0, (2,)),
+            ('_totalSquares', 0, (2,)),
+            ('_n', 1, (window,)),
+            ('_sums', 1, (window, 2)),
+            ('_squares', 1, (window, 2))
+        )
+        super().__init__(grid)
+
+    def reset(self):
+        super().reset()
+        self._n = self._n.astype(np.int64)
+        self._head = 0
+        self._peaks = 0
+
+    def merge(self, data):
+        samples = peakSamples(data)
+        nNew = samples.shape[2]
+        if nNew == 0:
+            return False
+
+        positions = self._match(data)
+
+        # Points without samples in the window get a new reference value
+        empty = self.counts[positions] == 0
+        self._shift[positions[empty]] = samples[empty].mean(axis = 2)
+
+        shifted = samples - self._shift[positions][:, :, np.newaxis]
+        batchN = np.zeros(len(self.grid), dtype = np.int64)
+        batchSum = np.zeros((len(self.grid), 2))
+        batchSquares = np.zeros((len(self.grid), 2))
+        np.add.at(batchN, positions, nNew)
+        np.add.at(batchSum, positions, shifted.sum(axis = 2))
+        np.add.at(batchSquares, positions, np.square(shifted).sum(axis = 2))
+
+        # Replace the oldest peak in the ring (all zero while filling up)
+        self.counts = self.counts + batchN - self._n[self._head]
+        self._totalSum = self._totalSum + batchSum - self._sums[self._head]
+        self._totalSquares = self._totalSquares + batchSquares - self._squares[self._head]
+        self._n[self._head] = batchN
+        self._sums[self._head] = batchSum
+        self._squares[self._head] = batchSquares
+        self._head = (self._head + 1) % self.window
+        self._peaks = self._peaks + 1
+
+        if (self._peaks % self.window) == 0:
+            self.counts = self._n.sum(axis = 0)
+            self._totalSum = self._sums.sum(axis = 0)
+            self._totalSquares = self._squares.sum(axis = 0)
+        self.count = int(self.counts.sum())
+        return True
+
+    def _mean(self):
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            return self._shift + self._totalSum / self.counts[:, np.newaxis]
+
+    def _error(self):
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            shiftedMean = self._totalSum / self.counts[:, np.newaxis]
+            return np.sqrt(np.maximum(self._totalSquares / self.counts[:, np.newaxis] - np.square(shiftedMean), 0))
+
+class ExponentialAverage(_GridAverage):
+    # Exponentially weighted mean and variance. Every peak enters with
+    # weight alpha as one component of a mixture of the previous estimate
+    # and the samples of the peak:
+    #
+    #   mean' = mean + alpha delta
+    #   var'  = (1 - alpha) (var + alpha delta^2) + alpha batchVar
+    #
+    # with delta the difference of the peak mean to the previous mean (per
+    # grid point, points start with the first peak covering them). An alpha
+    # of 2 / (N + 1) corresponds to a window of roughly N peaks.
+
+    _pointArrays = (('mean', 0, (2,)), ('var', 0, (2,)))
+
+    def __init__(self, alpha, grid = None):
+        if not (0 < alpha <= 1):
+            raise ValueError("Exponential average weight has to be in (0, 1]")
+        self.alpha = alpha
+        super().__init__(grid)
+
+    def merge(self, data):
+        samples = peakSamples(data)
+        nNew = samples.shape[2]
+        if nNew == 0:
+            return False
+
+        positions = self._match(data)
+        batchMean = samples.mean(axis = 2)
+        batchVar = samples.var(axis = 2)
+
+        mean = self.mean.copy()
+        var = self.var.copy()
+        counts = self.counts.copy()
+        for rows, target in _uniqueRounds(positions, len(self.grid)):
+            alpha = np.where(counts[target] > 0, self.alpha, 1.0)[:, np.newaxis]
+            delta = batchMean[rows] - mean[target]
+            mean[target] = mean[target] + alpha * delta
+            var[target] = (1.0 - alpha) * (var[target] + alpha * np.square(delta)) + alpha * batchVar[rows]
+            counts[target] = counts[target] + nNew
+
+        self.mean = mean
+        self.var = var
+        self.counts = counts
+        self.count = self.count + nNew * len(positions)
+        return True
+
+    def _mean(self):
+        return self.mean
+
+    def _error(self):
+        return np.sqrt(self.var)
+
+# Averaging modes selectable for the running average. The parameter is the
+# number of peaks (window size, or span of the exponential weighting).
+# Averages that should share one grid (signal and zero peaks) get the same
+# GridIndex
+
+AVERAGE_MODES = ('cumulative', 'window', 'exponential')
+
+def createAverage(mode = 'cumulative', peaks = 20, grid = None):
+    if (mode in ('window', 'exponential')) and (int(peaks) < 1):
+        raise ValueError("The running average has to span at least one peak")
+    if mode == 'cumulative':
+        return RunningAverage(grid)
+    if mode == 'window':
+        return SlidingAverage(int(peaks), grid)
+    if mode == 'exponential':
+        return ExponentialAverage(2.0 / (float(peaks) + 1.0), grid)
+    raise ValueError("Unknown averaging mode {}".format(mode))
@@ -0,0 +1,241 @@
+import time
+
+import numpy as np
+
+# A plot that keeps its Line2D and errorbar artists alive between updates.
+# New data is pushed into the existing artists via set_data / set_segments,
+# only the data artists get re-rendered (blitted) on top of a cached
+# background and the axis limits are only touched when the data leaves the
+# current view (or occupies only a small fraction of it).
+#
+# Curves are passed as a list of (label, y, yerr) tuples. yerr may be None
+# for plain lines, label may be None for curves without legend entry.
+#
+# Data that only grows (i.e. the points of a running sweep) is passed with
+# an appendKey. As long as the key stays the same the previous data is a
+# prefix of the new one, so only the new segments of the lines are drawn
+# on top of the last frame instead of redrawing all points. A full draw is
+# only done when the view limits have to change.
+#
+# If onDrawn is set it's called with the time spent in each update (in
+# seconds) and whether a full draw has been required.
+
+class LivePlot:
+    def __init__(self, figure, axis, canvas, xlabel, ylabel, title, grid = True, blit = True, viewMargin = 0.05):
+        self.figure = figure
+        self.axis = axis
+        self.canvas = canvas
+        self.xlabel = xlabel
+        self.ylabel = ylabel
+        self.title = title
+
+        self._blit = blit and canvas.supports_blit
+        self._background = None
+        self._signature = None
+        self._artists = []
+        self._containers = []
+        self._legend = None
+        self._limits = None
+        self._extent = None
+        self._appendKey = None
+        self._drawnCount = 0
+        self._viewMargin = viewMargin
+        self.onDrawn = None
+
+        axis.set_xlabel(xlabel)
+        axis.set_ylabel(ylabel)
+        axis.set_title(title)
+        if grid:
+            axis.grid()
+
+        if self._blit:
+            self._drawEventId = canvas.mpl_connect('draw_event', self._on_draw)
+
+    def _on_draw(self, event):
+        # Any full draw (our own ones as well as resizes) refreshes the
+        # background used for blitting
+        self._background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self._drawArtists()
+
+    def _drawArtists(self):
+        for artist in self._artists:
+            self.axis.draw_artist(artist)
+
+    def _removeArtists(self):
+        for container in self._containers:
+            container.remove()
+        self._containers = []
+        self._artists = []
+        if self._legend is not None:
+            self._legend.remove()
+            self._legend = None
+
+    def _createArtists(self, x, curves):
+        for label, y, yerr in curves:
+            if yerr is None:
+                # Plain lines (e.g. fitted curves) are drawn above errorbars
+                line, = self.axis.plot(x, y, label = label, zorder = 3)
+                self._containers.append(line)
+                self._artists.append(line)
+            else:
+                container = self.axis.errorbar(x, y, yerr = yerr, label = label)
+                dataLine, caplines, barlinecols = container.lines
+                self._containers.append(container)
+                self._artists.append(dataLine)
+                self._artists.extend(caplines)
+                self._artists.extend(barlinecols)
+
+        if self._blit:
+            for artist in self._artists:
+                artist.set_animated(True)
+
+        if any(label is not None for label, _, _ in curves):
+            self._legend = self.axis.legend()
+
+    def _updateArtists(self, x, curves):
+        for container, (label, y, yerr) in zip(self._containers, curves):
+            if yerr is None:
+                container.set_data(x, y)
+            else:
+                dataLine, caplines, barlinecols = container.lines
+                dataLine.set_data(x, y)
+                lower = np.subtract(y, yerr)
+                upper = np.add(y, yerr)
+                if len(caplines) == 2:
+                    caplines[0].set_data(x, lower)
+                    caplines[1].set_data(x, upper)
+                barlinecols[0].set_segments(np.stack((
+                    np.column_stack((x, lower)),
+                    np.column_stack((x, upper))
+                ), axis = 1))
+
+    def _dataLimits(self, x, curves):
+        xs = np.asarray(x, dtype = np.float64)
+        ylow = []
+        yhigh = []
+        for _, y, yerr in curves:
+            y = np.asarray(y, dtype = np.float64)
+            if yerr is None:
+                ylow.append(y)
+                yhigh.append(y)
+            else:
+                ylow.append(y - yerr)
+                yhigh.append(y + yerr)
+
+        with np.errstate(invalid = 'ignore'):
+            ylow = np.concatenate(ylow)
+            yhigh = np.concatenate(yhigh)
+            ylow = ylow[np.isfinite(ylow)]
+            yhigh = yhigh[np.isfinite(yhigh)]
+            xs = xs[np.isfinite(xs)]
+        if (len(xs) == 0) or (len(ylow) == 0) or (len(yhigh) == 0):
+            return None
+        return (xs.min(), xs.max(), ylow.min(), yhigh.max())
+
+    def _rescale(self, limits):
+        # Returns True if the view limits had to be changed
+        if limits is None:
+            return False
+
+        xmin, xmax, ymin, ymax = limits
+        (vxmin, vxmax) = self.axis.get_xlim()
+        (vymin, vymax) = self.axis.get_ylim()
+
+        # Data without extent (a single point or constant values) is shown
+        # in a view of width one which it counts as filling
+        xextent = (xmax - xmin) if xmax > xmin else 1.0
+        yextent = (ymax - ymin) if ymax > ymin else 1.0
+
+        if self._limits is not None:
+            inside = (xmin >= vxmin) and (xmax <= vxmax) and (ymin >= vymin) and (ymax <= vymax)
+            filled = (xextent >= 0.5 * (vxmax - vxmin)) and (yextent >= 0.5 * (vymax - vymin))
+            if inside and filled:
+                return False
+
+        # Growing data (e.g. a running sweep) should not trigger a full draw
+        # on every update - the margin leaves room for the data to grow into
+        xmargin = self._viewMargin * xextent if xmax > xmin else 0.5
+        ymargin = 2 * self._viewMargin * yextent if ymax > ymin else 0.5
+        self.axis.set_xlim(xmin - xmargin, xmax + xmargin)
+        self.axis.set_ylim(ymin - ymargin, ymax + ymargin)
+        self._limits = limits
+        return True
+
+    def update(self, x, curves, appendKey = None):
+        tStart = time.perf_counter()
+        signature = tuple((label, yerr is not None) for label, _, yerr in curves)
+        count = len(x) if x is not None else 0
+
+        appending = (
+            (appendKey is not None) and (appendKey == self._appendKey) and (signature == self._signature)
+            and (count >= self._drawnCount) and self._blit and (self._background is not None)
+            and all(yerr is None for _, _, yerr in curves)
+        )
+        if appending:
+            fullDraw = self._append(x, curves, count)
+        else:
+            fullDraw = False
+            if signature != self._signature:
+                self._removeArtists()
+                self._createArtists(x, curves)
+                self._signature = signature
+                fullDraw = True
+            else:
+                self._updateArtists(x, curves)
+
+            if len(curves) > 0:
+                self._extent = self._dataLimits(x, curves)
+                if self._rescale(self._extent):
+                    fullDraw = True
+
+            self.render(fullDraw)
+
+        self._appendKey = appendKey
+        self._drawnCount = count
+        if self.onDrawn is not None:
+            self.onDrawn(time.perf_counter() - tStart, fullDraw)
+
+    def _append(self, x, curves, count):
+        # Draws the points added since the last update (starting at the last
+        # drawn one so the lines stay connected). Returns True if a full
+        # draw has been required
+        start = max(self._drawnCount - 1, 0)
+        limits = self._dataLimits(x[start:], [ (label, y[start:], None) for label, y, _ in curves ])
+        if self._extent is None:
+            self._extent = limits
+        elif limits is not None:
+            self._extent = (
+                min(self._extent[0], limits[0]), max(self._extent[1], limits[1]),
+                min(self._extent[2], limits[2]), max(self._extent[3], limits[3])
+            )
+
+        if self._rescale(self._extent):
+            self._updateArtists(x, curves)
+            self.render(True)
+            return True
+
+        if count == self._drawnCount:
+            return False
+
+        # The artists get the new segment only while drawing it, afterwards
+        # they're set to the whole data again for later full draws
+        for line, (_, y, _) in zip(self._containers, curves):
+            line.set_data(x[start:], y[start:])
+            self.axis.draw_artist(line)
+            line.set_data(x, y)
+        self.canvas.blit(self.figure.bbox)
+        return False
+
+    def clear(self):
+        self.update(None, [])
+
+    def render(self, fullDraw = True):
+        if (not self._blit) or fullDraw or (self._background is None):
+            self.canvas.draw()
+            if self._blit:
+                self.canvas.blit(self.figure.bbox)
+            return
+
+        self.canvas.restore_region(self._background)
+        self._drawArtists()
+        self.canvas.blit(self.figure.bbox)
@@ -0,0 +1,266 @@
+import bisect
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+# Append only, compressed log of routed MQTT messages
+#
+# The log file starts with a magic string followed by independently
+# compressed blocks:
+#
+#   block header   'QBLK', compressed length (u32), number of records (u32),
+#                  first and last receive timestamp (f64, f64)
+#   block body     zlib compressed records
+#   record         receive timestamp (f64), topic length (u16),
+#                  payload length (u32), topic (UTF-8), raw payload
+#
+# A sidecar index file (<log>.idx) stores (first timestamp, file offset)
+# of every block so a reader can seek to any timestamp by binary search
+# without decompressing the log. If the index is missing or incomplete
+# (i.e. after a crash) it's rebuilt from the block headers, which only
+# requires skipping over the compressed bodies. A writer appending to an
+# existing log first checks the index against the block headers: a torn
+# last block is cut off and a stale index is rewritten, so blocks that had
+# not been indexed before a crash stay reachable.
+
+LOG_MAGIC = b'QESRLOG1'
+BLOCK_MAGIC = b'QBLK'
+
+_blockHeader = struct.Struct('<4sIIdd')
+_recordHeader = struct.Struct('<dHI')
+_indexEntry = struct.Struct('<dQ')
+
+def _scanBlocks(f, position, fileSize):
+    # Index entries of all complete blocks starting at position and the end
+    # of the last complete block
+    entries = []
+    while position + _blockHeader.size <= fileSize:
+        f.seek(position)
+        magic, length, _, firstTimestamp, _ = _blockHeader.unpack(f.read(_blockHeader.size))
+        if (magic != BLOCK_MAGIC) or (position + _blockHeader.size + length > fileSize):
+            # Truncated last block (i.e. the writer got killed)
+            break
+        entries.append((firstTimestamp, position))
+        position = position + _blockHeader.size + length
+    return entries, position
+
+class MessageLogWriter:
+    def __init__(self, path, blockSize = 256 * 1024, flushInterval = 2.0, compressionLevel = 6):
+        self._path = path
+        self._blockSize = blockSize
+        self._flushInterval = flushInterval
+        self._compressionLevel = compressionLevel
+        self._lock = threading.Lock()
+
+        newFile = (not os.path.exists(path)) or (os.path.getsize(path) < len(LOG_MAGIC))
+        if newFile:
+            self._file = open(path, 'wb')
+            self._file.write(LOG_MAGIC)
+            self._file.flush()
+            self._index = open(path + ".idx", 'wb')
+        else:
+            self._recover()
+            self._file = open(path, 'ab')
+            self._index = open(path + ".idx", 'ab')
+
+        self._records = []
+        self._bufferedBytes = 0
+        self._firstTimestamp = None
+        self._lastTimestamp = None
+        self._blockStarted = None
+
+    def _recover(self):
+        with open(self._path, 'rb') as f:
+            if f.read(len(LOG_MAGIC)) != LOG_MAGIC:
+                raise ValueError("{} is not a QUAK/ESR message log".format(self._path))
+            fileSize = os.fstat(f.fileno()).st_size
+            entries, end = _scanBlocks(f, len(LOG_MAGIC), fileSize)
+        if end < fileSize:
+            logging.warning("Truncating {} bytes of an incomplete block at the end of {}".format(fileSize - end, self._path))
+            os.truncate(self._path, end)
+
+        index = b''.join(_indexEntry.pack(ts, offset) for ts, offset in entries)
+        try:
+            with open(self._path + ".idx", 'rb') as f:
+                current = f.read()
+        except FileNotFoundError:
+            current = None
+        if current != index:
+            with open(self._path + ".idx", 'wb') as f:
+                f.write(index)
+
+    def write(self, topic, payload, timestamp = None):
+        if timestamp is None:
+            timestamp = time.time()
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        topic = topic.encode('utf-8')
+
+        with self._lock:
+            if self._file is None:
+                return
+            self._records.append(_recordHeader.pack(timestamp, len(topic), len(payload)))
+            self._records.append(topic)
+            self._records.append(bytes(payload))
+            self._bufferedBytes = self._bufferedBytes + _recordHeader.size + len(topic) + len(payload)
+
+            if self._firstTimestamp is None:
+                self._firstTimestamp = timestamp
+                self._blockStarted = time.monotonic()
+            self._lastTimestamp = timestamp
+
+            if (self._bufferedBytes >= self._blockSize) or ((time.monotonic() - self._blockStarted) >= self._flushInterval):
+                self._flushBlock()
+
+    def _flushBlock(self):
+        if len(self._records) == 0:
+            return
+
+        body = zlib.compress(b''.join(self._records), self._compressionLevel)
+        offset = self._file.tell()
+        self._file.write(_blockHeader.pack(BLOCK_MAGIC, len(body), len(self._records) // 3, self._firstTimestamp, self._lastTimestamp))
+        self._file.write(body)
+        self._file.flush()
+
+        self._index.write(_indexEntry.pack(self._firstTimestamp, offset))
+        self._index.flush()
+
+        self._records = []
+        self._bufferedBytes = 0
+        self._firstTimestamp = None
+        self._lastTimestamp = None
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._flushBlock()
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            self._flushBlock()
+            self._file.close()
+            self._index.close()
+            self._file = None
+            self._index = None
+
+class MessageLogReader:
+    def __init__(self, path):
+        self._path = path
+        self._file = open(path, 'rb')
+        if self._file.read(len(LOG_MAGIC)) != LOG_MAGIC:
+            self._file.close()
+            raise ValueError("{} is not a QUAK/ESR message log".format(path))
+
+        self._blockTimestamps, self._blockOffsets = self._loadIndex()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _loadIndex(self):
+        timestamps = []
+        offsets = []
+        try:
+            with open(self._path + ".idx", 'rb') as f:
+                data = f.read()
+            for i in range(len(data) // _indexEntry.size):
+                ts, offset = _indexEntry.unpack_from(data, i * _indexEntry.size)
+                timestamps.append(ts)
+                offsets.append(offset)
+        except FileNotFoundError:
+            pass
+
+        # Index entries are only written after their blocks, so any blocks
+        # after the last indexed one (or all of them) are found by scanning
+        position = offsets[-1] if len(offsets) > 0 else len(LOG_MAGIC)
+        if len(offsets) > 0:
+            timestamps.pop()
+            offsets.pop()
+        entries, _ = _scanBlocks(self._file, position, os.fstat(self._file.fileno()).st_size)
+        for firstTimestamp, offset in entries:
+            timestamps.append(firstTimestamp)
+            offsets.append(offset)
+
+        return timestamps, offsets
+
+    def _readBlock(self, blockIndex):
+        self._file.seek(self._blockOffsets[blockIndex])
+        magic, length, nRecords, _, _ = _blockHeader.unpack(self._file.read(_blockHeader.size))
+        body = zlib.decompress(self._file.read(length))
+
+        records = []
+        position = 0
+        for _ in range(nRecords):
+            timestamp, topicLength, payloadLength = _recordHeader.unpack_from(body, position)
+            position = position + _recordHeader.size
+            topic = body[position:position + topicLength].decode('utf-8')
+            position = position + topicLength
+            payload = body[position:position + payloadLength]
+            position = position + payloadLength
+            records.append((timestamp, topic, payload))
+        return records
+
+    def __len__(self):
+        return len(self._blockOffsets)
+
+    def timeRange(self):
+        if len(self._blockOffsets) == 0:
+            return None
+        self._file.seek(self._blockOffsets[-1])
+        _, _, _, _, lastTimestamp = _blockHeader.unpack(self._file.read(_blockHeader.size))
+        return (self._blockTimestamps[0], lastTimestamp)
+
+    def messages(self, start = None):
+        # Yields (receive timestamp, topic, raw payload), optionally starting
+        # at the first message received at or after 'start'
+        firstBlock = 0
+        if start is not None:
+            firstBlock = max(0, bisect.bisect_right(self._blockTimestamps, start) - 1)
+
+        for blockIndex in range(firstBlock, len(self._blockOffsets)):
+            for record in self._readBlock(blockIndex):
+                if (start is not None) and (record[0] < start):
+                    continue
+                yield record
+
+    def __iter__(self):
+        return self.messages()
+
+    def replay(self, callback, speed = 1.0, start = None, stopEvent = None):
+        # Calls callback(timestamp, topic, payload) for every message. With a
+        # speed of 1 messages are replayed in real time, larger values replay
+        # faster; None or 0 replays as fast as possible
+        wallStart = None
+        logStart = None
+        nMessages = 0
+
+        for timestamp, topic, payload in self.messages(start):
+            if (stopEvent is not None) and stopEvent.is_set():
+                break
+
+            if speed:
+                if wallStart is None:
+                    wallStart = time.monotonic()
+                    logStart = timestamp
+                delay = (timestamp - logStart) / speed - (time.monotonic() - wallStart)
+                if delay > 0:
+                    if stopEvent is not None:
+                        if stopEvent.wait(delay):
+                            break
+                    else:
+                        time.sleep(delay)
+
+            callback(timestamp, topic, payload)
+            nMessages = nMessages + 1
+
+        return nMessages
@@ -0,0 +1,54 @@
+import time
+
+import numpy as np
+
+# Fixed capacity history of (timestamp, value) samples backed by one typed
+# array. Once the buffer is full every append overwrites the oldest sample,
+# so the samples are only handed out as copies (window()) that can be
+# published to other threads.
+
+class RingBuffer:
+    def __init__(self, capacity, dtype = np.float64):
+        if capacity < 1:
+            raise ValueError("Ring buffer capacity has to be at least 1")
+
+        self._capacity = capacity
+        self._data = np.zeros((capacity, 2), dtype = dtype)
+        self._head = 0
+        self._count = 0
+        self._total = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def total(self):
+        # Number of samples ever appended (including ones that have been dropped)
+        return self._total
+
+    def append(self, value, timestamp = None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        self._data[self._head, 0] = timestamp
+        self._data[self._head, 1] = value
+
+        self._head = (self._head + 1) % self._capacity
+        if self._count < self._capacity:
+            self._count = self._count + 1
+        self._total = self._total + 1
+
+    def window(self):
+        # Copy of the samples currently held in order, rows (timestamp, value)
+        start = (self._head - self._count) % self._capacity
+        if start + self._count <= self._capacity:
+            return self._data[start:start + self._count].copy()
+        return np.concatenate((self._data[start:], self._data[:self._head]))
+
+    def indices(self):
+        # Running sample numbers of the samples currently held
+        return np.arange(self._total - self._count, self._total)
@@ -0,0 +1,78 @@
+import time
+
+# Coalesces redraw requests into frames that are issued at most at a
+# configurable frame rate. Each task supplies a cheap check whether it has
+# something to draw and the redraw itself. The scheduler measures how long
+# each task takes to draw (exponentially weighted) and defers tasks to the
+# next frame if they would not fit into the remaining frame budget. Deferred
+# tasks are served first in the next frame so no figure starves.
+
+class RedrawScheduler:
+    def __init__(self, maxFrameRate = 20.0, frameBudget = None, costSmoothing = 0.3):
+        self._frameInterval = 1.0 / maxFrameRate
+        self._frameBudget = frameBudget if frameBudget is not None else self._frameInterval
+        self._costSmoothing = costSmoothing
+
+        self._tasks = []
+        self._nextTask = 0
+        self._lastFrame = 0
+        self._deferredFrames = 0
+
+    def addTask(self, name, needsRedraw, redraw):
+        self._tasks.append({
+            'name' : name,
+            'needsRedraw' : needsRedraw,
+            'redraw' : redraw,
+            'cost' : 0.0
+        })
+
+    def pending(self):
+        for task in self._tasks:
+            if task['needsRedraw']():
+                return True
+        return False
+
+    def timeout(self):
+        # Milliseconds until the next frame is due or None if nothing has
+        # to be drawn (i.e. the caller may block until the next event)
+        if not self.pending():
+            return None
+        remaining = self._lastFrame + self._frameInterval - time.perf_counter()
+        return max(0, int(remaining * 1000))
+
+    def frameDue(self):
+        if (time.perf_counter() - self._lastFrame) < self._frameInterval:
+            return False
+        return self.pending()
+
+    def runFrame(self):
+        frameStart = time.perf_counter()
+        self._lastFrame = frameStart
+
+        nTasks = len(self._tasks)
+        drawn = 0
+        for iTask in range(nTasks):
+            idx = (self._nextTask + iTask) % nTasks
+            task = self._tasks[idx]
+            if not task['needsRedraw']():
+                continue
+
+            # Always draw at least one task per frame so we make progress even
+            # if a single figure exceeds the budget
+            elapsed = time.perf_counter() - frameStart
+            if (drawn > 0) and (elapsed + task['cost'] > self._frameBudget):
+                self._nextTask = idx
+                self._deferredFrames = self._deferredFrames + 1
+                return False
+
+            tStart = time.perf_counter()
+            task['redraw']()
+            cost = time.perf_counter() - tStart
+            task['cost'] = task['cost'] * (1.0 - self._costSmoothing) + cost * self._costSmoothing
+            drawn = drawn + 1
+
+        self._nextTask = 0
+        return True
+
+    def deferredFrames(self):
+        return self._deferredFrames
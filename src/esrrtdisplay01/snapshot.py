@@ -0,0 +1,76 @@
+import threading
+import types
+
+import numpy as np
+
+# Single writer / many reader exchange of immutable data bundles between the
+# MQTT network thread and the GUI thread.
+#
+# The writer builds a completely new bundle and publishes it by swapping one
+# reference (together with a version number) - readers just fetch that
+# reference and never see partially updated data. Readers don't take any
+# lock, writers serialize on a lock so resets from the GUI thread don't
+# interleave with the network thread.
+#
+# Published arrays are made read only but not copied, so the writer must
+# never modify them afterwards. Ring buffer histories are therefore
+# published as copies of their window, point data as view into a growable
+# buffer whose filled rows aren't written again until it's reused.
+
+def freeze(data):
+    if isinstance(data, np.ndarray):
+        view = data.view()
+        view.flags.writeable = False
+        return view
+    if isinstance(data, (dict, types.MappingProxyType)):
+        return types.MappingProxyType({ key : freeze(value) for key, value in data.items() })
+    return data
+
+class SnapshotSlot:
+    def __init__(self, initial = None):
+        self._lock = threading.Lock()
+        self._current = (0, freeze(initial))
+
+    def latest(self):
+        return self._current
+
+    def version(self):
+        return self._current[0]
+
+    def publish(self, data):
+        with self._lock:
+            version = self._current[0] + 1
+            self._current = (version, freeze(data))
+        return version
+
+    def update(self, **changes):
+        # Copy on write of the current bundle with some keys replaced
+        with self._lock:
+            version, current = self._current
+            data = dict(current) if current is not None else {}
+            data.update(changes)
+            self._current = (version + 1, freeze(data))
+        return version + 1
+
+class SnapshotConsumer:
+    # Keeps track of the versions a consumer (i.e. one redraw method) has
+    # already seen for a set of slots
+
+    def __init__(self):
+        self._seen = {}
+
+    def changed(self, name, slot):
+        return self._seen.get(name) != slot.version()
+
+    def consume(self, name, slot):
+        version, data = slot.latest()
+        if self._seen.get(name) == version:
+            return None
+        self._seen[name] = version
+        return data
+
+    def invalidate(self, name = None):
+        if name is None:
+            self._seen = {}
+        else:
+            self._seen.pop(name, None)